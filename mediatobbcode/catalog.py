@@ -0,0 +1,312 @@
+#!/usr/bin/env python3
+# coding=utf-8
+# Copyright 2017 PayBas
+# All Rights Reserved.
+
+import logging
+import os
+import sqlite3
+import time
+from collections import OrderedDict
+
+from mediatobbcode import config, core, spill
+
+logger = logging.getLogger(__name__)
+
+catalog_version = 1  # bump when the schema changes
+
+clip_fields = ('filepath', 'filename', 'filesize', 'length', 'vcodec', 'vcodec_alt', 'vbitrate', 'vbitrate_alt',
+				'vwidth', 'vheight', 'vscantype', 'vframerate', 'vframerate_alt', 'acodec', 'abitrate', 'asample',
+				'aprofile')
+imageset_fields = ('filepath', 'filename', 'filesize', 'orig_size', 'img_count')
+image_lists = ('primary', 'alternative', 'fullsize')  # in the order of the img_match keys of core.prepare_items()
+
+# 'path' is relative to the media_dir, 'filepath' and 'filename' are the attributes of the item as they were parsed,
+# 'bytes', 'duration' and 'pixels' are the raw values the sort keys are made from (see core.set_sort_keys())
+schema = '''
+CREATE TABLE info (key TEXT PRIMARY KEY, value TEXT);
+CREATE TABLE outputs (id INTEGER PRIMARY KEY, source TEXT NOT NULL, file TEXT NOT NULL);
+CREATE TABLE directories (output_id INTEGER NOT NULL REFERENCES outputs, collection TEXT NOT NULL,
+	position INTEGER NOT NULL, path TEXT NOT NULL, PRIMARY KEY (output_id, collection, position));
+CREATE TABLE clips (output_id INTEGER NOT NULL REFERENCES outputs, position INTEGER NOT NULL, path TEXT NOT NULL,
+	{clip_fields}, bytes INTEGER, duration REAL, pixels INTEGER, PRIMARY KEY (output_id, position));
+CREATE TABLE imagesets (output_id INTEGER NOT NULL REFERENCES outputs, position INTEGER NOT NULL, path TEXT NOT NULL,
+	{imageset_fields}, width INTEGER, height INTEGER, bytes INTEGER, pixels INTEGER, PRIMARY KEY (output_id, position));
+CREATE TABLE image_matches (output_id INTEGER NOT NULL REFERENCES outputs, collection TEXT NOT NULL,
+	position INTEGER NOT NULL, image_list TEXT NOT NULL, bbimg TEXT, bburl TEXT);
+CREATE TABLE performer_tags (output_id INTEGER NOT NULL REFERENCES outputs, tag TEXT NOT NULL, count INTEGER NOT NULL,
+	PRIMARY KEY (output_id, tag));
+'''.format(clip_fields=', '.join(clip_fields), imageset_fields=', '.join(imageset_fields))
+
+# created after the bulk insert, which is quicker than keeping them up to date row by row
+indexes = '''
+CREATE INDEX clips_path ON clips (path);
+CREATE INDEX clips_codec ON clips (vcodec);
+CREATE INDEX clips_resolution ON clips (vwidth, vheight);
+CREATE INDEX imagesets_path ON imagesets (path);
+CREATE INDEX imagesets_resolution ON imagesets (width, height);
+CREATE INDEX image_matches_item ON image_matches (output_id, collection, position);
+'''
+
+
+class CatalogWriter(object):
+	"""
+	Exports everything a session generates its outputs from to an SQLite database: the Clips, ImageSets and Separators
+	(as directories) of every output, their image matches, and the performer tags. Other tools can query the library
+	without scanning it again, and the outputs can be generated again from it (see render_catalog()).
+	The whole run is written in a single transaction, to a temporary file that only replaces the catalog once the run
+	is complete, so a catalog is never left half-written.
+	"""
+	def __init__(self, session, file):
+		self.file = file
+		self.temp_file = file + '.part'
+		self.media_dir = session.opts['media_dir']
+		self.outputs = 0
+
+		if os.path.exists(self.temp_file):
+			os.remove(self.temp_file)
+		session.temp_files.add(self.temp_file)
+
+		# the file is replaced as a whole, so it doesn't need a journal
+		self.connection = sqlite3.connect(self.temp_file)
+		self.connection.executescript('PRAGMA journal_mode = OFF;\nPRAGMA synchronous = OFF;\n' + schema)
+		self.connection.executemany('INSERT INTO info VALUES (?, ?)',
+									[('version', catalog_version), ('script_version', config.version),
+									('media_dir', self.media_dir), ('created', time.strftime('%Y-%m-%dT%H:%M:%S%z'))])
+
+	def add_output(self, session, source, file_output, prepared_items):
+		"""
+		Adds the prepared items of an output (see core.prepare_items()), and the performer tags found in them.
+		"""
+		self.outputs += 1
+		output_id = self.outputs
+		execute = self.connection.executemany
+		self.connection.execute('INSERT INTO outputs VALUES (?, ?, ?)', (output_id, source, file_output))
+
+		for collection, _list in prepared_items.items():
+			if not _list:
+				continue
+
+			# the lists may be spilled to disk (see spill.py), so every table reads them again rather than collecting
+			# the rows in memory
+			execute('INSERT INTO directories VALUES (?, ?, ?, ?)',
+					((output_id, collection, position, entry.directory) for position, entry in enumerate(_list)
+					if isinstance(entry, core.Separator)))
+
+			if collection == 'clips':
+				execute('INSERT INTO clips VALUES ({})'.format(', '.join('?' * (len(clip_fields) + 6))),
+						((output_id, position, self.relative_path(entry['item']))
+						+ tuple(getattr(entry['item'], field) for field in clip_fields) + entry['item'].sort_keys[1:]
+						for position, entry in enumerate(_list) if not isinstance(entry, core.Separator)))
+			else:
+				execute('INSERT INTO imagesets VALUES ({})'.format(', '.join('?' * (len(imageset_fields) + 7))),
+						((output_id, position, self.relative_path(entry['item']))
+						+ tuple(getattr(entry['item'], field) for field in imageset_fields)
+						+ tuple(entry['item'].resolution) + (entry['item'].sort_keys[1], entry['item'].sort_keys[3])
+						for position, entry in enumerate(_list) if not isinstance(entry, core.Separator)))
+
+			execute('INSERT INTO image_matches VALUES (?, ?, ?, ?, ?, ?)',
+					((output_id, collection, position, image_list, img['bbimg'], img['bburl'])
+					for position, entry in enumerate(_list) if not isinstance(entry, core.Separator)
+					for image_list, key in zip(image_lists, ('img_match', 'img_match_alt', 'img_match_fullsize'))
+					for img in entry[key] or ()))
+
+		execute('INSERT INTO performer_tags VALUES (?, ?, ?)',
+				((output_id, tag, count) for tag, count in session.tags.items()))
+
+	def relative_path(self, item):
+		return os.path.relpath(os.path.join(item.filepath, item.filename), self.media_dir)
+
+	def commit(self, session):
+		"""
+		Finishes the catalog, and moves it into place.
+		"""
+		try:
+			self.connection.executescript(indexes)
+			self.connection.commit()
+			self.connection.close()
+			os.replace(self.temp_file, self.file)
+		except (sqlite3.Error, OSError):
+			logger.error('ERROR: Couldn\'t write catalog: %s', self.file)
+			return False
+
+		session.temp_files.discard(self.temp_file)
+		logger.info('Catalog written to: %s', self.file, extra={'event': 'catalog', 'path': self.file})
+		return True
+
+	def discard(self, session):
+		"""
+		Throws the catalog away, after the session was cancelled.
+		"""
+		self.connection.close()
+		try:
+			os.remove(self.temp_file)
+		except OSError:
+			pass
+		session.temp_files.discard(self.temp_file)
+
+
+def open_catalog(file):
+	"""
+	Opens a catalog for reading, returning the connection and the info dictionary (or None if it isn't a catalog of a
+	version we can read).
+	"""
+	try:
+		if not os.path.isfile(file):
+			raise sqlite3.OperationalError('no such file')  # connect() would create an empty database
+		connection = sqlite3.connect(file)
+		info = dict(connection.execute('SELECT key, value FROM info'))
+	except sqlite3.Error:
+		logger.error('ERROR: Couldn\'t read catalog: %s', file)
+		return None, None
+
+	if info.get('version') != str(catalog_version):
+		logger.error('ERROR: Unsupported catalog version: %s  (in %s)', info.get('version'), file)
+		connection.close()
+		return None, None
+	return connection, info
+
+
+def read_info(file):
+	"""
+	Returns the info dictionary of a catalog (with the 'media_dir' it was made from), or None if it can't be read.
+	"""
+	connection, info = open_catalog(file)
+	if connection:
+		connection.close()
+	return info
+
+
+def render_catalog(session, file):
+	"""
+	Generates the outputs of a catalog again, without touching the media files at all. The items are matched to the
+	image-lists again, so changed options, layouts, sort orders and image-lists apply.
+	Returns False if it can't be read.
+	"""
+	connection, info = open_catalog(file)
+	if not connection:
+		return False
+
+	try:
+		if not session.opts['media_dir']:
+			session.opts['media_dir'] = info['media_dir']
+
+		for output_id, source in connection.execute('SELECT id, source FROM outputs ORDER BY id').fetchall():
+			if session.cancelled:
+				break
+			core.generate_output(session, read_items(session, connection, output_id), source)
+	finally:
+		connection.close()
+
+	return True
+
+
+def read_items(session, connection, output_id):
+	"""
+	Reads the items of an output back, in the order they were output in, with their Separators. The items of each
+	directory are sorted again by the current 'sort_order' (or those of the whole output, with 'sort_library'), like
+	core.parse_files() does. The order of the directories themselves is kept.
+	"""
+	library_sort = core.sorts_library(session)
+	items = OrderedDict()
+	for collection in ('clips', 'imagesets'):
+		items[collection] = _list = core.new_item_list(session, library_sort)
+
+		directories = ((position, core.Separator(path)) for position, path in connection.execute(
+			'SELECT position, path FROM directories WHERE output_id = ? AND collection = ? ORDER BY position',
+			(output_id, collection)))
+
+		if collection == 'clips':
+			rows = connection.execute('SELECT position, {}, bytes, duration, pixels FROM clips WHERE output_id = ? '
+									'ORDER BY position'.format(', '.join(clip_fields)), (output_id,))
+			entries = ((row[0], make_item(core.Clip(*row[1:-3]), row[-3:])) for row in rows)
+		else:
+			rows = connection.execute('SELECT position, {}, width, height, bytes, pixels FROM imagesets WHERE '
+									'output_id = ? ORDER BY position'.format(', '.join(imageset_fields)), (output_id,))
+			entries = ((row[0], make_item(core.ImageSet(*row[1:-4], resolution=(row[-4], row[-3])),
+										(row[-2], 0, row[-1]))) for row in rows)
+
+		dir_items = []
+		for position, item in spill.merge((directories, entries), key=lambda entry: entry[0]):
+			if library_sort:
+				# one list across the directories, without separators
+				if not isinstance(item, core.Separator):
+					_list.append(item)
+				continue
+
+			if dir_items and (isinstance(item, core.Separator) or item.filepath != dir_items[-1].filepath):
+				_list.extend(core.sort_items(session, dir_items))
+				dir_items = []
+			if isinstance(item, core.Separator):
+				_list.append(item)
+			else:
+				dir_items.append(item)
+		_list.extend(core.sort_items(session, dir_items))
+
+	return items
+
+
+def make_item(item, sort_values):
+	core.set_sort_keys(item, *sort_values)
+	return item
+
+
+def diff_catalogs(old_file, new_file):
+	"""
+	Compares two catalogs, by the path of each item relative to its media_dir. Returns a generator of (collection,
+	status, item, changed fields) tuples, where the status is 'added', 'removed' or 'changed', and the item is the new
+	one (or the old one, if it was removed). Returns None if either can't be read.
+	Both catalogs are read in path order (using their path index), so comparing them takes linear time, and only a
+	couple of rows are in memory at any time, however large the libraries are.
+	"""
+	old_connection, old_info = open_catalog(old_file)
+	if not old_connection:
+		return
+	new_connection, new_info = open_catalog(new_file)
+	if not new_connection:
+		old_connection.close()
+		return
+
+	return diff_items(old_connection, new_connection)
+
+
+def diff_items(old_connection, new_connection):
+	try:
+		for collection in ('clips', 'imagesets'):
+			if collection == 'clips':
+				# the absolute filepath is left out, so moving the whole library doesn't change anything
+				compared = clip_fields[1:] + ('bytes', 'duration')
+			else:
+				compared = imageset_fields[1:] + ('width', 'height', 'bytes')
+			query = 'SELECT path, {}, filepath, pixels FROM {} ORDER BY path'.format(', '.join(compared), collection)
+
+			old_rows = old_connection.execute(query)
+			new_rows = new_connection.execute(query)
+			old = next(old_rows, None)
+			new = next(new_rows, None)
+
+			# a merge join, like comparing two sorted lists
+			while old or new:
+				if new is None or (old is not None and old[0] < new[0]):
+					yield collection, 'removed', make_diff_item(collection, old), ()
+					old = next(old_rows, None)
+				elif old is None or new[0] < old[0]:
+					yield collection, 'added', make_diff_item(collection, new), ()
+					new = next(new_rows, None)
+				else:
+					changed = tuple(field for field, old_value, new_value
+									in zip(compared, old[1:-2], new[1:-2]) if old_value != new_value)
+					if changed:
+						yield collection, 'changed', make_diff_item(collection, new), changed
+					old = next(old_rows, None)
+					new = next(new_rows, None)
+	finally:
+		old_connection.close()
+		new_connection.close()
+
+
+def make_diff_item(collection, row):
+	# the rows are: path, the compared fields, filepath, pixels (see diff_items())
+	if collection == 'clips':
+		return make_item(core.Clip(row[-2], *row[1:-4]), (row[-4], row[-3], row[-1]))
+	return make_item(core.ImageSet(row[-2], *row[1:-5], resolution=(row[-5], row[-4])), (row[-3], 0, row[-1]))
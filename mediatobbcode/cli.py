@@ -3,15 +3,31 @@
 # Copyright 2017 PayBas
 # All Rights Reserved.
 
+import copy
 import getopt
+import os
+import shlex
+import signal
 import sys
 
-from mediatobbcode import config, core
+from mediatobbcode import config
+from mediatobbcode.log import parse_level, setup_logging
+from mediatobbcode.session import CancelToken, run_batch
+
+short_options = 'hvm:o:rzlbifuntsawqc:x'
+long_options = ['help', 'version', 'mediadir=', 'outputdir=', 'recursive', 'zip', 'list', 'bare', 'individual', 'flat',
+				'url', 'nothumb', 'tinylink', 'suppress', 'all', 'webhtml', 'fullsize', 'config=', 'xdebug',
+				'tagsbyfreq', 'tagslimit=', 'postsize=', 'sort=', 'dirsfirst', 'sortlibrary', 'spill=', 'catalog=',
+				'renderfrom=', 'diff=', 'followlinks', 'duplicates', 'workers=', 'isolate', 'probetimeout=', 'probememory=',
+				'locality', 'devicereads=', 'readahead', 'manifest=', 'serve=', 'jobs=',
+				'profile', 'pstats=', 'slowest=', 'trace=', 'metricsjson=', 'metricsprom=',
+				'loglevel=', 'logjson=', 'progress', 'partial', 'skipunchanged', 'force']
 
 
 def main(argv):
 	"""
-	Process command-line inputs
+	Process command-line inputs. Keep the imports at the top of this module light, so that --help, --version and
+	friends return instantly. The heavy modules (core, pymediainfo, Pillow) are only imported once they are needed.
 	"""
 	# set the default opts as initial values
 	config.populate_opts()
@@ -24,20 +40,29 @@ def main(argv):
 		'- parse all media files in dir -m and output to -o\n\n'
 		'cli.py -m <media dir> -r -o <output dir>\n'
 		'- parse all media files in -m recursively and output to -o\n\n'
+		'cli.py -m <media dir> -m <media dir> ... -o <output dir>\n'
+		'- parse multiple media dirs in one go, writing an output file for each\n\n'
+		'cli.py --renderfrom <catalog> -o <output dir>\n'
+		'- generate the outputs from a catalog written with --catalog, without parsing the media files\n\n'
+		'cli.py --manifest <file>\n'
+		'- parse all media dirs listed in the manifest file (one per line, optionally followed by options)\n\n'
+		'cli.py --serve <[host:]port or socket path> [--jobs <N>]\n'
+		'- run as a local daemon, accepting scan requests over HTTP (see documentation)\n\n'
 		'cli.py -c <config file>\n'
 		'- use previously saved config file to set script options\n\n'
 		'For a full list of command-line options, see the online documentation.')
 
 	try:
-		options, args = getopt.getopt(
-			argv, 'hvm:o:rzlbifuntsawqc:x',
-			['help', 'version', 'mediadir=', 'outputdir=', 'recursive', 'zip', 'list', 'bare', 'individual', 'flat',
-			'url', 'nothumb', 'tinylink', 'suppress', 'all', 'webhtml', 'fullsize', 'config=', 'xdebug'])
-
+		options, args = getopt.getopt(argv, short_options, long_options)
 	except getopt.GetoptError:
 		print(h)
 		sys.exit(2)
 
+	media_dirs = []
+	manifests = []
+	serve_address = None
+	serve_jobs = 2
+
 	for opt, arg in options:
 		if opt in ('-h', '--help'):
 			print(h)
@@ -47,38 +72,19 @@ def main(argv):
 			sys.exit()
 
 		elif opt in ('-m', '--mediadir'):
-			config.opts['media_dir'] = arg
-		elif opt in ('-o', '--outputdir'):
-			config.opts['output_dir'] = arg
-		elif opt in ('-r', '--recursive'):
-			config.opts['recursive'] = True
-		elif opt in ('-z', '--zip'):
-			config.opts['parse_zip'] = True
-
-		elif opt in ('-l', '--list'):
-			config.opts['output_as_table'] = False
-		elif opt in ('-b', '--bare'):
-			config.opts['output_table_titles'] = False
-		elif opt in ('-i', '--individual'):
-			config.opts['output_individual'] = True
-		elif opt in ('-f', '--flat'):
-			config.opts['output_separators'] = False
-
-		elif opt in ('-u', '--url'):
-			config.opts['embed_images'] = False
-		elif opt in ('-n', '--nothumb'):
-			config.opts['output_bbcode_thumb'] = False
-		elif opt in ('-t', '--tinylink'):
-			config.opts['whole_filename_is_link'] = False
-		elif opt in ('-s', '--suppress'):
-			config.opts['suppress_img_warnings'] = True
-
-		elif opt in ('-q', '--fullsize'):
-			config.opts['use_imagelist_fullsize'] = True
-		elif opt in ('-a', '--all'):
-			config.opts['all_layouts'] = True
-		elif opt in ('-w', '--webhtml'):
-			config.opts['output_html'] = True
+			media_dirs.append(arg)
+		elif opt == '--manifest':
+			manifests.append(arg)
+		elif opt == '--serve':
+			serve_address = arg
+		elif opt == '--jobs' and arg.isdigit():
+			serve_jobs = int(arg)
+
+		# logging is set up once for the whole process, so these can't be set per media dir
+		elif opt == '--loglevel' and parse_level(arg) is not None:
+			config.opts['log_level'] = arg.upper()
+		elif opt == '--logjson':
+			config.opts['log_json_file'] = arg
 
 		elif opt in ('-c', '--config'):
 			success = config.load_config_file(arg)
@@ -86,17 +92,200 @@ def main(argv):
 				sys.exit()
 		elif opt in ('-x', '--xdebug'):
 			# if we just want to debug image-host matching for development
+			from mediatobbcode import core
+			setup_logging(config.opts)
 			config.debug_imghost_slugs = True
 			core.debug_imghost_matching()
 			sys.exit()
 
+		elif not set_option(config.opts, opt, arg):
+			print(h)
+			sys.exit(2)
+
 	if options:
 		print('Config settings updated with command-line arguments.')
 	else:
 		print('No command-line options specified. Run using default settings on local directory.')
 
+	setup_logging(config.opts)
+
+	# keep running, and handle scan requests using the options set above as defaults
+	if serve_address:
+		from mediatobbcode import daemon
+		daemon.serve(serve_address, config.opts, serve_jobs)
+		return
+
+	# every media dir gets its own copy of the options, the manifest can override options for each dir
+	opts_list = []
+	for media_dir in media_dirs:
+		opts = copy.copy(config.opts)
+		opts['media_dir'] = media_dir
+		opts_list.append(opts)
+
+	for manifest in manifests:
+		manifest_opts = read_manifest(manifest, config.opts)
+		if manifest_opts is None:
+			sys.exit(2)
+		opts_list += manifest_opts
+
+	if not opts_list:
+		opts_list.append(config.opts)
+
+	# the first Ctrl+C cancels the run cleanly (without leaving half-written output files behind, and writing the
+	# partial results if cancel_partial_output is set), the second one stops it right away
+	cancel_token = CancelToken()
+
+	def cancel(signum, frame):
+		signal.signal(signal.SIGINT, signal.default_int_handler)
+		cancel_token.cancel()
+		print('\nCancelling... (press Ctrl+C again to stop immediately)')
+	signal.signal(signal.SIGINT, cancel)
+
 	# initialize the script using the command-line arguments
-	core.set_paths_and_run()
+	run_batch(opts_list, cancel_token=cancel_token)
+
+
+def set_option(opts, opt, arg):
+	"""
+	Applies a single command-line option (that affects a parsing run) to the opts dictionary.
+	Returns False if the option is unknown, or its argument is invalid.
+	"""
+	if opt in ('-o', '--outputdir'):
+		opts['output_dir'] = arg
+	elif opt in ('-r', '--recursive'):
+		opts['recursive'] = True
+	elif opt in ('-z', '--zip'):
+		opts['parse_zip'] = True
+
+	elif opt in ('-l', '--list'):
+		opts['output_as_table'] = False
+	elif opt in ('-b', '--bare'):
+		opts['output_table_titles'] = False
+	elif opt in ('-i', '--individual'):
+		opts['output_individual'] = True
+	elif opt in ('-f', '--flat'):
+		opts['output_separators'] = False
+
+	elif opt in ('-u', '--url'):
+		opts['embed_images'] = False
+	elif opt in ('-n', '--nothumb'):
+		opts['output_bbcode_thumb'] = False
+	elif opt in ('-t', '--tinylink'):
+		opts['whole_filename_is_link'] = False
+	elif opt in ('-s', '--suppress'):
+		opts['suppress_img_warnings'] = True
+
+	elif opt in ('-q', '--fullsize'):
+		opts['use_imagelist_fullsize'] = True
+	elif opt in ('-a', '--all'):
+		opts['all_layouts'] = True
+	elif opt in ('-w', '--webhtml'):
+		opts['output_html'] = True
+
+	elif opt == '--skipunchanged':
+		opts['skip_unchanged'] = True
+	elif opt == '--force':
+		opts['skip_unchanged'] = False
+
+	elif opt == '--partial':
+		opts['cancel_partial_output'] = True
+
+	elif opt == '--progress':
+		opts['show_progress'] = True
+
+	elif opt == '--profile':
+		opts['profile'] = True
+	elif opt == '--pstats':
+		opts['profile_stats_file'] = arg
+	elif opt == '--trace':
+		opts['trace_file'] = arg
+	elif opt == '--metricsjson':
+		opts['metrics_json_file'] = arg
+	elif opt == '--metricsprom':
+		opts['metrics_prom_file'] = arg
+	elif opt == '--slowest':
+		try:
+			opts['profile_slowest'] = int(arg)
+		except ValueError:
+			return False
+
+	elif opt == '--tagsbyfreq':
+		opts['tags_by_frequency'] = True
+	elif opt == '--sort':
+		opts['sort_order'] = arg.lower()
+	elif opt == '--dirsfirst':
+		opts['sort_dirs_first'] = True
+	elif opt == '--sortlibrary':
+		opts['sort_library'] = True
+	elif opt == '--catalog':
+		opts['catalog_file'] = arg
+	elif opt == '--renderfrom':
+		opts['render_from'] = arg
+	elif opt == '--diff':
+		opts['diff_from'] = arg
+	elif opt == '--followlinks':
+		opts['follow_links'] = True
+	elif opt == '--duplicates':
+		opts['flag_duplicates'] = True
+	elif opt == '--isolate':
+		opts['probe_isolation'] = True
+	elif opt == '--locality':
+		opts['locality_order'] = True
+	elif opt == '--readahead':
+		opts['readahead'] = True
+	elif opt in ('--tagslimit', '--postsize', '--workers', '--probetimeout', '--probememory', '--devicereads', '--spill'):
+		key = {'--tagslimit': 'tags_limit', '--postsize': 'post_size_limit', '--workers': 'probe_workers',
+				'--probetimeout': 'probe_timeout', '--probememory': 'probe_memory_limit', '--devicereads': 'device_reads',
+				'--spill': 'spill_threshold'}[opt]
+		try:
+			opts[key] = int(arg)
+		except ValueError:
+			return False
+
+	else:
+		return False
+
+	return True
+
+
+def read_manifest(file, base_opts):
+	"""
+	Reads a manifest file listing media dirs to parse, one per line. Each media dir can be followed by command-line
+	options that only apply to that dir, like: "/mnt/foo/Led Zeppelin" -r -i -o ~/output
+	Relative media dirs are relative to the location of the manifest. Empty lines and lines starting with # are ignored.
+	"""
+	try:
+		with open(file, encoding='utf-8') as stream:
+			lines = stream.read().splitlines()
+	except (IOError, OSError):
+		print('ERROR: Couldn\'t open manifest file: {}'.format(file))
+		return
+
+	base_dir = os.path.dirname(os.path.abspath(file))
+	opts_list = []
+
+	for number, line in enumerate(lines, 1):
+		if not line.strip() or line.strip().startswith('#'):
+			continue
+
+		try:
+			args = shlex.split(line)
+			options, rest = getopt.getopt(args[1:], short_options, long_options)
+		except (ValueError, getopt.GetoptError) as error:
+			print('ERROR: invalid manifest line {}: {}'.format(number, error))
+			return
+
+		opts = copy.copy(base_opts)
+		opts['media_dir'] = os.path.join(base_dir, os.path.expanduser(args[0]))
+
+		for opt, arg in options:
+			if not set_option(opts, opt, arg):
+				print('ERROR: option {} can\'t be used in manifest line {}'.format(opt, number))
+				return
+
+		opts_list.append(opts)
+
+	return opts_list
 
 
 # hi there :)
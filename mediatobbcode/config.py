@@ -13,6 +13,7 @@ config = OrderedDict([
 	('iopts', OrderedDict([
 		('media_dir', ['', 'Media dir']),
 		('output_dir', ['', 'Output dir']),
+		('render_from', ['', 'Catalog']),
 		('recursive', [False, 'Recursive']),
 		('parse_zip', [False, 'Parse ZIP']),
 	])),
@@ -47,13 +48,47 @@ config = OrderedDict([
 		('tImageSets', ['IMAGE-SET DETAILS', 'text', '(when using the "Parse ZIP" option)']),
 		('tFullSizeSS', ['SCREENS (inline)', 'text', '(when using the full-size images option)']),
 		('tFullSizeShow', ['SCREENS', 'text', '(when using the full-size images option)'])
+	])),
+	('aopts', OrderedDict([
+		('tags_by_frequency', [False, 'bool', 'Sort performer tags by frequency (most common first)']),
+		('tags_limit', [0, 'int', 'Maximum number of performer tags to output (0 = no limit)']),
+		('post_size_limit', [0, 'int', 'Split the output into posts of at most this many bytes (0 = a single post)']),
+		('sort_order', ['', 'string', 'Sort the items of each directory by: name, size, duration or resolution']),
+		('sort_dirs_first', [False, 'bool', 'Output the sub-directories of a directory before its own files']),
+		('sort_library', [False, 'bool', 'Sort the items of the whole library at once, rather than per directory']),
+		('spill_threshold', [0, 'int', 'Number of parsed items to hold in memory before spilling them to disk (0 = never)']),
+		('catalog_file', ['', 'string', 'Export the parsed items to this SQLite database, to query or render from']),
+		('diff_from', ['', 'string', 'Write the items added, removed or changed since this (older) catalog to _diff.txt']),
+		('follow_links', [False, 'bool', 'Follow symlinked directories when parsing recursively (loops are skipped)']),
+		('flag_duplicates', [False, 'bool', 'List files with identical contents (quick fingerprint) in the output']),
+		('probe_workers', [1, 'int', 'Number of media files to probe in parallel']),
+		('locality_order', [False, 'bool', 'Probe the files of a directory in on-disk order (for hard disks)']),
+		('device_reads', [0, 'int', 'Maximum number of files read from the same disk at once (0 = no limit)']),
+		('readahead', [False, 'bool', 'Ask the OS to read ahead the parts of each file MediaInfo reads first']),
+		('probe_isolation', [False, 'bool', 'Probe media files in separate processes, protecting against bad files']),
+		('probe_timeout', [60, 'int', 'Seconds before an isolated probe is killed, and the file marked as failed']),
+		('probe_memory_limit', [0, 'int', 'Memory limit of each isolated probe process in MB (0 = no limit)']),
+		('profile', [False, 'bool', 'Print a profile of the time spent in each phase after parsing']),
+		('profile_slowest', [10, 'int', 'Number of slowest files to list in the profile']),
+		('profile_stats_file', ['', 'string', 'Dump cProfile stats to this file (for pstats/snakeviz)']),
+		('trace_file', ['', 'string', 'Write a Chrome/Perfetto trace of the run to this file']),
+		('metrics_json_file', ['', 'string', 'Write the metrics of the run to this JSON file']),
+		('metrics_prom_file', ['', 'string', 'Write the metrics of the run to this Prometheus textfile (.prom)']),
+		('cancel_partial_output', [False, 'bool', 'Write the results parsed so far when cancelling a run']),
+		('cancel_timeout', [10, 'int', 'Seconds the GUI waits for a cancelled run to stop, before killing it']),
+		('skip_unchanged', [False, 'bool', 'Skip outputs whose media files, image-lists and options are unchanged']),
+		('show_progress', [False, 'bool', 'Show live progress with throughput and ETA (command-line)']),
+		('log_level', ['INFO', 'string', 'Log level: DEBUG shows every file, INFO only counts and results']),
+		('log_json_file', ['', 'string', 'Also write all log messages (including DEBUG) to this file as JSON lines'])
 	]))
 ])
 
+# options that only apply to a single run, so they're never saved to (or loaded from) a config file
+transient_opts = ('render_from',)
+
 opts = dict()  # Don't touch! See populate_opts()
 opts_saved = dict()  # Don't touch! Only used to determine if opts have changed since initializing/loading/saving
 debug_imghost_slugs = False  # For debugging. Only available from the command-line.
-kill_thread = False  # Flag for killing the parsing process, since terminating a QThread is unreliable
 
 author = 'PayBas'
 author_url = 'https://github.com/PayBas'
@@ -96,7 +131,8 @@ def save_config_file(file):
 		for key, group in config.items():
 			parser[key] = {}
 			for opt in group:
-				parser[key][opt] = str(opts[opt])
+				if opt not in transient_opts:
+					parser[key][opt] = str(opts[opt])
 	except (KeyError, IndexError) as error:
 		print('ERROR: mismatch for option: {}'.format(error))
 		return
@@ -128,6 +164,10 @@ def load_config_file(file):
 		try:
 			for key, group in config.items():
 				for opt in group:
+					# options missing from the file (older config files) simply keep their current value
+					if key not in config_file or opt not in config_file[key] or opt in transient_opts:
+						continue
+
 					# since .INI files only support string values, we try to detect other datatypes
 					if isinstance(opts[opt], bool):
 						opts[opt] = config_file[key].getboolean(opt)
@@ -4,143 +4,536 @@
 # All Rights Reserved.
 
 import copy
+import heapq
+import itertools
+import logging
 import os
 import re
-import sys
+import shutil
+import tempfile
 import unicodedata
 from collections import OrderedDict
-from hashlib import md5
 from urllib.parse import urlparse
-from zipfile import ZipFile, BadZipFile
-
-from pymediainfo import MediaInfo
-from PIL import Image
 
 from mediatobbcode import config
+from mediatobbcode.iosched import advise_readahead, device_slot, order_by_locality
+from mediatobbcode.posts import PostWriter, Wrapper, end_wrapper
+from mediatobbcode.session import Session
+
+# per-file messages are logged at DEBUG, aggregated counts and results at INFO, see log.py
+logger = logging.getLogger(__name__)
 
 cERR = '#F00'  # output color for errors
 cWARN = '#F80'  # output color for warnings
-tags = []
 
+# performer tag extraction patterns, see generate_tags()
+re_tags_in_parenthesis = re.compile(r'\((?:featuring|feat.|ft.|with|w.)(.*?)\)')
+re_tags_split = re.compile(r' and |[&,;]')
+re_tags_dots = re.compile(r'\.+')
+re_natural_split = re.compile(r'(\d+)')
+ignored_tags = ('various', 'others', 'multiple', 'downloaded', 'mixed')
+
+media_ext = ('.3gp', '.amv', '.asf', '.avi', '.divx', '.f4v', '.flv', '.m2v', '.m4v', '.mkv', '.mp4', '.mpeg',
+			'.mpg', '.mov', '.mts', '.ogg', '.ogv', '.qt', '.rm', '.rmvb', '.ts', '.vob', '.webm', '.wmv')
+zip_ext = ('.zip', '.zipx')
+diff_titles = OrderedDict([('added', 'Added'), ('removed', 'Removed'), ('changed', 'Changed')])
+sort_orders = ('name', 'size', 'duration', 'resolution')  # in the order of the keys stored by set_sort_keys()
+temp_output_numbers = itertools.count()  # see open_temp_output()
 
-def set_paths_and_run():
+
+def set_paths_and_run(session=None):
 	"""
 	Sanitizes and sets the correct input and output directories, before starting the parsing process.
+	If no session is passed, a new one is created from the global config.opts.
 	"""
+	if session is None:
+		session = Session()
+
+	# when rendering from a catalog, the media_dir defaults to the one the catalog was made from
+	if session.opts['render_from'] and not session.opts['media_dir']:
+		from mediatobbcode.catalog import read_info
+		info = read_info(session.opts['render_from'])
+		if not info:
+			return
+		session.opts['media_dir'] = info['media_dir']
+
 	# set the correct output_dir
-	if not config.opts['output_dir'] and not config.opts['media_dir']:
-		print('ERROR: no media directory specified!')
+	if not session.opts['output_dir'] and not session.opts['media_dir']:
+		logger.error('ERROR: no media directory specified!')
 		return
-	elif not config.opts['output_dir']:
+	elif not session.opts['output_dir']:
 		# no output_dir specified, so we will output to the media_dir
-		config.opts['output_dir'] = os.path.normpath(os.path.expanduser(config.opts['media_dir']))
+		session.opts['output_dir'] = os.path.normpath(os.path.expanduser(session.opts['media_dir']))
 	else:
-		config.opts['output_dir'] = os.path.normpath(os.path.expanduser(config.opts['output_dir']))
+		session.opts['output_dir'] = os.path.normpath(os.path.expanduser(session.opts['output_dir']))
 
 	# set the correct media_dir
-	config.opts['media_dir'] = os.path.normpath(os.path.expanduser(config.opts['media_dir']))
-	print('using media_dir  = ' + config.opts['media_dir'])
-	print('using output_dir = ' + config.opts['output_dir'])
+	session.opts['media_dir'] = os.path.normpath(os.path.expanduser(session.opts['media_dir']))
+
+	if session.opts['sort_order'] and session.opts['sort_order'] not in sort_orders:
+		logger.error('ERROR: invalid sort order: %s  (should be one of: %s)', session.opts['sort_order'],
+					', '.join(sort_orders))
+		session.opts['sort_order'] = ''
+
+	logger.info('using media_dir  = %s', session.opts['media_dir'])
+	logger.info('using output_dir = %s', session.opts['output_dir'])
+
+	if (session.opts['show_progress'] or session.progress_callback) and not session.opts['render_from']:
+		from mediatobbcode.progress import Progress, count_files, print_progress
+
+		parse_ext = media_ext + zip_ext if session.opts['parse_zip'] else media_ext
+		total_files, total_bytes = count_files(session.opts['media_dir'], parse_ext, session.opts['recursive'],
+												session.opts['follow_links'])
+		logger.info('Found %d files to parse (%s)', total_files, readable_number(total_bytes))
+		session.progress = Progress(total_files, total_bytes, session.progress_callback or print_progress)
+
+	# the diff compares a catalog of this run to the old one, so make one if it isn't exported (or rendered from)
+	catalog_file = session.opts['catalog_file']
+	diff_from = session.opts['diff_from']
+	temp_catalogs = []
+	try:
+		if diff_from and not catalog_file and not session.opts['render_from']:
+			handle, catalog_file = tempfile.mkstemp(prefix='mediatobbcode-', suffix='.db')
+			os.close(handle)
+			temp_catalogs.append(catalog_file)
+		elif diff_from and catalog_file and is_same_file(diff_from, catalog_file):
+			# the old catalog is about to be replaced by the one of this run, so the diff needs a copy of it
+			handle, diff_from = tempfile.mkstemp(prefix='mediatobbcode-', suffix='.db')
+			os.close(handle)
+			temp_catalogs.append(diff_from)
+			shutil.copyfile(session.opts['diff_from'], diff_from)
+
+		if catalog_file:
+			from mediatobbcode.catalog import CatalogWriter
+			session.catalog = CatalogWriter(session, catalog_file)
+
+		if session.opts['render_from']:
+			from mediatobbcode.catalog import render_catalog
+			render_catalog(session, session.opts['render_from'])
+		else:
+			parse_files(session)
+
+		if session.catalog:
+			if session.cancelled:
+				session.catalog.discard(session)
+			else:
+				session.catalog.commit(session)
+			session.catalog = None
+
+		if diff_from and not session.cancelled:
+			generate_diff(session, diff_from, session.opts['render_from'] or catalog_file)
+	finally:
+		for file in temp_catalogs:
+			os.remove(file)
+
+	# write the fingerprints of the outputs written by this run
+	if 'output_manifests' in session.cache:
+		for manifest in list(session.cache['output_manifests'].values()):
+			manifest.save()
+
+	if session.progress:
+		session.progress.finish()
+
+	stats = session.stats
+	logger.info('Scanned %d files: %d probed, %d cached, %d linked, %d skipped, %d failed. Image matches: %d found, '
+				'%d missing, %d conflicting.', stats['files_scanned'], stats['files_probed'], stats['files_cached'],
+				stats['files_linked'], stats['files_skipped'], stats['files_failed'], stats['images_matched'],
+				stats['images_missing'], stats['images_conflicting'], extra={'event': 'run', 'counters': stats.snapshot()})
 
-	parse_files()
+	# the profiler may also run just to collect the phase timings for the metrics files
+	if session.profiler and (session.opts['profile'] or session.opts['profile_stats_file']):
+		logger.info(session.profiler.summary(session.opts['profile_slowest']))
 
 
-def parse_files():
+def is_same_file(file, other_file):
+	"""
+	Whether two paths point to the same (existing) file.
+	"""
+	try:
+		return os.path.samefile(file, other_file)
+	except OSError:
+		return False
+
+
+def parse_files(session):
 	"""
 	Traverses the specified media_dir directory and detects all video-clips (and image-sets if specified).
 	Depending on whether output_individual is used, it will call to output once or for each directory parsed.
 	"""
-	clips = []
-	imagesets = []
+	library_sort = sorts_library(session)
+
+	clips = new_item_list(session, library_sort)
+	imagesets = new_item_list(session, library_sort)
 	ran_at_all = False  # canary - general
 	parsed_at_all = False  # canary - for when output_individual has cleared clips[] after sending to output
 
-	media_ext = ['.3gp', '.amv', '.asf', '.avi', '.divx', '.f4v', '.flv', '.m2v', '.m4v', '.mkv', '.mp4', '.mpeg',
-				'.mpg', '.mov', '.mts', '.ogg', '.ogv', '.qt', '.rm', '.rmvb', '.ts', '.vob', '.webm', '.wmv']
-	zip_ext = ['.zip', '.zipx']
-
-	if config.opts['parse_zip']:
-		parse_ext = tuple(media_ext + zip_ext)
+	if session.opts['parse_zip']:
+		parse_ext = media_ext + zip_ext
 	else:
-		parse_ext = tuple(media_ext)
+		parse_ext = media_ext
 
-	if config.opts['recursive'] and config.opts['output_separators'] and not config.opts['output_individual']:
+	if session.opts['recursive'] and session.opts['output_separators'] and not session.opts['output_individual'] \
+			and not library_sort:
 		insert_separators = True
 	else:
 		insert_separators = False
 
 	# start directory traversal
-	for root, dirs, files in os.walk(config.opts['media_dir']):
-		print('\nSWITCH dir: {}'.format(root))
-		new_dir = True
-		new_zip_dir = True
+	for root, dirs, files in session.timed('traverse', walk_media_dir(session)):
 		ran_at_all = True
-		current_relative_dir = os.path.relpath(root, config.opts['media_dir'])
+		current_relative_dir = os.path.relpath(root, session.opts['media_dir'])
+
+		# skip files with extensions we don't want to parse
+		parse_list = [file for file in files if file.lower().endswith(parse_ext)]
+		skipped = len(files) - len(parse_list)
+
+		logger.info('\nSWITCH dir: %s  (%d files, %d skipped)', root, len(files), skipped,
+					extra={'event': 'directory', 'path': root})
+		if skipped and logger.isEnabledFor(logging.DEBUG):
+			for file in files:
+				if not file.lower().endswith(parse_ext):
+					logger.debug(' skipped file: %s', file, extra={'event': 'skipped', 'path': os.path.join(root, file)})
+
+		session.stats.add('files_scanned', len(files))
+		session.stats.add('files_skipped', skipped)
+
+		dir_clips = []
+		dir_imagesets = []
+		with session.phase('directory', root, profile=False):
+			for item in probe_files(session, root, parse_list):
+				# stop parsing as soon as the session is cancelled (by the GUI, or Ctrl+C on the command-line)
+				if session.cancelled:
+					break
+
+				# if parse_zip is enabled, ZIP files are checked to see if it's an image-set
+				if isinstance(item, ImageSet):
+					dir_imagesets.append(item)
+					report_result(session, item)
+				elif item:
+					dir_clips.append(item)
+					report_result(session, item)
+
+		# the items are sorted per directory, so sorting never requires holding more than a directory's worth of items
+		for _list, dir_items in ((clips, dir_clips), (imagesets, dir_imagesets)):
+			if not dir_items:
+				continue
+			# create a separator with the relative directory, but only if the dir has any valid files
+			if insert_separators and current_relative_dir != '.':
+				_list.append(Separator(current_relative_dir))
+			_list.extend(dir_items if library_sort else sort_items(session, dir_items))
+
+		# break after top level if we don't want recursive parsing
+		if not session.opts['recursive'] or session.cancelled:
+			break
+		elif session.opts['output_individual'] and (clips or imagesets):
+			# output each dir as a separate file, so we need to reset the clips after each successfully parsed dir
+			parsed_at_all = True
+			generate_output(session, OrderedDict([('clips', clips), ('imagesets', imagesets)]), root)
+			clips = new_item_list(session)
+			imagesets = new_item_list(session)
+
+	if session.cancelled:
+		# write what we have so far, if wanted (generate_output() discards the output otherwise)
+		if session.opts['cancel_partial_output'] and (clips or imagesets):
+			logger.warning('Cancelled, writing the partial results parsed so far')
+			source = root if session.opts['output_individual'] else session.opts['media_dir']
+			generate_output(session, OrderedDict([('clips', clips), ('imagesets', imagesets)]), source)
+		else:
+			logger.warning('Cancelled, parsing stopped')
+	elif not ran_at_all:
+		logger.error('ERROR: invalid directory for: %s', session.opts['media_dir'])
+	elif not clips and not imagesets and not parsed_at_all:
+		logger.error('ERROR: no valid media files found in: %s', session.opts['media_dir'])
+	elif not session.opts['output_individual']:
+		generate_output(session, OrderedDict([('clips', clips), ('imagesets', imagesets)]), session.opts['media_dir'])
+
+
+def walk_media_dir(session):
+	"""
+	Walks the media_dir like os.walk(), following symlinked directories if 'follow_links' is set. Each directory is
+	only visited once (by its device and inode number), so symlink loops, or links to a directory that is also in the
+	tree itself, can't make us parse the same files over and over.
+	When sorting (see sort_items()), the sub-directories are visited in natural order, and with 'sort_dirs_first'
+	(and 'recursive'), the sub-directories of a directory are returned before the directory itself.
+	"""
+	follow_links = session.opts['follow_links']
+	sort_dirs = session.opts['sort_order'] or session.opts['sort_dirs_first']
+	dirs_first = session.opts['sort_dirs_first'] and session.opts['recursive']
+	visited = set()
+	pending = []  # with dirs_first: the directories whose sub-directories haven't all been returned yet
+
+	for root, dirs, files in os.walk(session.opts['media_dir'], followlinks=follow_links):
+		if follow_links:
+			try:
+				stat = os.stat(root)
+				dir_key = (stat.st_dev, stat.st_ino)
+			except OSError:
+				dir_key = None
+
+			if dir_key in visited:
+				logger.warning('WARNING: Skipped directory, it was already parsed (symlink loop?): %s', root,
+								extra={'event': 'loop', 'path': root})
+				dirs[:] = []  # don't descend any further
+				continue
+			visited.add(dir_key)
+
+		if sort_dirs:
+			dirs.sort(key=natural_key)  # in place, so os.walk() descends in this order
+
+		if not dirs_first:
+			yield root, dirs, files
+			continue
+
+		# os.walk() goes depth-first, so a directory is done once the walk returns something outside of it
+		while pending and not root.startswith(pending[-1][0] + os.sep):
+			yield pending.pop()
+		pending.append((root, dirs, files))
+
+	while pending:
+		yield pending.pop()
+
+
+def natural_key(name):
+	"""
+	Sort key that orders the numbers in names by value, so 'clip 2' comes before 'clip 10'. Case-insensitive.
+	"""
+	# the odd parts of the split are the numbers
+	return tuple(int(part) if number % 2 else part.lower() for number, part in enumerate(re_natural_split.split(name)))
+
+
+def set_sort_keys(item, size, duration=0, pixels=0):
+	"""
+	Stores the keys for every sort order on a Clip or ImageSet when it's created, from the raw metadata (rather than
+	the formatted strings), so sorting is cheap and doesn't depend on the layout. See sort_items().
+	"""
+	try:
+		duration = float(duration or 0)
+	except (TypeError, ValueError):
+		duration = 0.0
+	item.sort_keys = (natural_key(item.filename), int(size or 0), duration, pixels)
+
+
+def sort_items(session, items):
+	"""
+	Sorts the items of a directory by the 'sort_order' option (using the keys stored by set_sort_keys()), with the
+	natural file-name order for items with equal keys. Without a 'sort_order', the file system order is kept.
+	"""
+	if not session.opts['sort_order']:
+		return items
+
+	return sorted(items, key=sort_key(session))
+
+
+def sorts_library(session):
+	# sorting the whole library at once only makes sense when all of it ends up in the same output
+	return bool(session.opts['sort_library'] and session.opts['sort_order'] and not session.opts['output_individual'])
+
+
+def sort_key(session):
+	index = sort_orders.index(session.opts['sort_order'])
+	return lambda item: (item.sort_keys[index], item.sort_keys[0])
+
+
+def new_item_list(session, library_sort=False):
+	"""
+	Returns a list to collect the items (or prepared rows) of an output in. That's a plain list, unless the items have
+	to be sorted across the whole library ('sort_library'), or more than 'spill_threshold' of them shouldn't be held in
+	memory at once. Then it's a SpillList, which writes them to temporary files as needed (see spill.py).
+	"""
+	key = sort_key(session) if library_sort else None
+	if not key and not session.opts['spill_threshold']:
+		return []
+
+	from mediatobbcode.spill import SpillList
+	return SpillList(session.opts['spill_threshold'], key, session.stats)
+
+
+def probe_files(session, root, files):
+	"""
+	Parses all the files of a single directory, in order. When the session has a probe pool, the files are parsed in
+	parallel (MediaInfo releases the GIL while it's working), but the results are still returned in the same order.
+	With 'locality_order', the files are parsed in the order they're stored on disk instead (see iosched.py), but
+	the results are still returned in the original order.
+	"""
+	order = None
+	if session.opts['locality_order'] and len(files) > 1:
+		order = order_by_locality(root, files)
+
+	if session.pool and len(files) > 1:
+		return probe_files_pooled(session, root, files, order)
+	elif order:
+		return probe_files_ordered(session, root, files, order)
+	else:
+		return (probe_file(session, root, file) for file in files)
+
 
+def probe_files_ordered(session, root, files, order):
+	"""
+	Parses the files one by one in the given order, and then yields the results in the original order.
+	"""
+	results = {file: probe_file(session, root, file) for file in order}
+	for file in files:
+		yield results[file]
+
+
+def probe_files_pooled(session, root, files, order=None):
+	"""
+	Submits the files of a directory to the probe pool (in the given order, if any), and yields the results in the
+	original order. While waiting for a result, the cancellation token is checked every 0.1 s. Once cancelled, the
+	files that haven't started yet are cancelled, and a file stuck in MediaInfo is abandoned (its worker finishes it in
+	the background), so we stop in bounded time.
+	"""
+	from concurrent.futures import TimeoutError
+
+	# other names for a file submitted already (hardlinks) aren't submitted themselves, or both could be probed at the
+	# same time: they wait for that file instead, and then get a copy of its result from the inodes cache
+	submitted = {}
+	originals = {}  # file: the file submitted for its inode
+	inodes = {}
+	for file in order or files:
+		try:
+			key = inode_key(os.stat(os.path.join(root, file)))
+		except (IOError, OSError):
+			key = None
+		if key in inodes:
+			originals[file] = inodes[key]
+			continue
+		elif key:
+			inodes[key] = file
+		submitted[file] = session.pool.submit(probe_file, session, root, file)
+
+	try:
 		for file in files:
-			# help the GUI to terminate the thread
-			if config.kill_thread:
-				config.kill_thread = False
+			future = submitted[originals.get(file, file)]
+			while not session.cancelled:
+				try:
+					result = future.result(timeout=0.1)
+				except TimeoutError:
+					continue
+				yield probe_file(session, root, file) if file in originals else result
+				break
+			else:
 				return
+	finally:
+		for future in submitted.values():
+			future.cancel()
 
-			# skip files with extensions we don't want to parse
-			if not file.lower().endswith(parse_ext):
-				print(' skipped file: {}'.format(file))
-				continue
 
-			# if parse_zip is enabled, check ZIP files to see if it's an image-set
-			if config.opts['parse_zip'] and file.lower().endswith(tuple(zip_ext)):
-				imgset = parse_zip_file(root, file)
-				if imgset:
-					# create a separator with the relative directory, but only if it's the first valid file in the dir
-					if new_zip_dir and insert_separators and current_relative_dir is not '.':
-						imagesets.append(Separator(current_relative_dir))
-					new_zip_dir = False
+def probe_file(session, root, file):
+	"""
+	Parses a single media file (or ZIP archive), returning a cleaned-up Clip (or ImageSet). Results are kept in the
+	metadata cache of the session (keyed by path, mtime and size), so unchanged files are only parsed once per cache.
+	Each physical file is only parsed once: other names for it (hardlinks, or paths through symlinks) get a copy of
+	the same result, found by device and inode number.
+	"""
+	path = os.path.join(root, file)
+	size = 0
+	device = None
+
+	if session.cancelled:
+		return
 
-					imagesets.append(imgset)
-				continue
+	try:
+		stat = os.stat(path)
+		size = stat.st_size
+		device = stat.st_dev
+		cache_key = (os.path.abspath(path), stat.st_mtime, stat.st_size)
+		# (looked up with get(), as a bounded cache may drop the item any moment, see cache_item())
+		item = session.cache['metadata'].get(cache_key)
+		if item:
+			logger.debug(' cached file : %s', file, extra={'event': 'cached', 'path': path})
+			session.stats.add('files_cached')
+			session.advance(size)
+			return item
+
+		inode = inode_key(stat)
+		item = session.cache['inodes'].get(inode) if inode else None
+		if item:
+			item = copy.copy(item)
+			item.filepath = root
+			item.filename = file
+			item.sort_keys = (natural_key(file),) + item.sort_keys[1:]
+			logger.debug(' linked file : %s', file, extra={'event': 'linked', 'path': path})
+			session.stats.add('files_linked')
+			cache_item(session, 'metadata', cache_key, item)
+			session.advance(size)
+			return item
+	except (IOError, OSError):
+		cache_key = inode = None
 
-			# parse media file
-			clip = parse_media_file(root, file)
-			if clip:
-				# create a separator with the relative directory, but only if it's the first valid file in the dir
-				if new_dir and insert_separators and current_relative_dir is not '.':
-					clips.append(Separator(current_relative_dir))
-				new_dir = False
+	session.stats.add('files_probed')
+	session.stats.add('bytes_probed', size)
 
-				clips.append(metadata_cleanup(clip))
+	# limit the number of files read from the same disk at once (if set), independent of the number of probe workers
+	with device_slot(session, device):
+		if session.opts['readahead']:
+			advise_readahead(path, size)
 
-		# break after top level if we don't want recursive parsing
-		if not config.opts['recursive']:
-			break
-		elif config.opts['output_individual'] and (clips or imagesets):
-			# output each dir as a separate file, so we need to reset the clips after each successfully parsed dir
-			parsed_at_all = True
-			generate_output(OrderedDict([('clips', clips), ('imagesets', imagesets)]), root)
-			clips = []
-			imagesets = []
+		if file.lower().endswith(zip_ext):
+			with session.phase('zip', path, size):
+				item = parse_zip_file(session, root, file)
+		else:
+			with session.phase('probe', path, size):
+				if session.prober:
+					item = session.prober.probe(session, root, file, session.opts['probe_timeout'])
+				else:
+					item = parse_media_file(session, root, file)
+
+	if isinstance(item, Clip):
+		with session.phase('cleanup'):
+			item = metadata_cleanup(item)
+
+	if not item:
+		session.stats.add('files_failed')
+	elif cache_key:
+		cache_item(session, 'metadata', cache_key, item)
+		if inode:
+			cache_item(session, 'inodes', inode, item)
+
+	session.advance(size)
+	return item
+
+
+def inode_key(stat):
+	# not every file system has inode numbers (they're 0 then)
+	return (stat.st_dev, stat.st_ino, stat.st_mtime, stat.st_size) if stat.st_ino else None
 
-	if not ran_at_all:
-		print('ERROR: invalid directory for: {}'.format(config.opts['media_dir']))
-	elif not clips and not imagesets and not parsed_at_all:
-		print('ERROR: no valid media files found in: {}'.format(config.opts['media_dir']))
-	elif not config.opts['output_individual']:
-		generate_output(OrderedDict([('clips', clips), ('imagesets', imagesets)]), config.opts['media_dir'])
 
+def cache_item(session, name, key, item):
+	"""
+	Stores a parsed item in one of the session caches. With 'spill_threshold' set, a cache holds no more than that
+	many items (the oldest are dropped first), so the caches don't grow with the size of the library either.
+	"""
+	cache = session.cache[name]
+	cache[key] = item
+
+	limit = session.opts['spill_threshold']
+	while limit and len(cache) > limit:
+		try:
+			# the caches are OrderedDicts (see Session), so the first item is the oldest
+			cache.popitem(last=False)
+		except KeyError:
+			# another session emptied it in the meantime
+			break
 
-def parse_media_file(root, file):
+
+def parse_media_file(session, root, file):
 	"""
 	Uses the pymediainfo module to parse each file and extract media information from each video-clip.
 	"""
+	# imported on first use, loading libmediainfo is expensive and not needed for every run
+	from pymediainfo import MediaInfo
+
+	path = os.path.join(root, file)
+
 	try:
-		print(' attempt file: {}'.format(file))
-		media_info = MediaInfo.parse(os.path.join(root, file))
+		logger.debug(' attempt file: %s', file)
+		media_info = MediaInfo.parse(path)
 	except OSError as error:
-		print(error)
+		logger.error('ERROR parsing: %s  -  %s', file, error, extra={'event': 'failed', 'path': path})
 		return
 	except:
-		(errortype, value, traceback) = sys.exc_info()
-		sys.excepthook(errortype, value, traceback)
+		logger.exception('ERROR parsing: %s', file, extra={'event': 'failed', 'path': path})
 		return
 
 	track_general = track_video = track_audio = None
@@ -181,34 +574,44 @@ def parse_media_file(root, file):
 				asample = track_audio.sampling_rate
 				aprofile = track_audio.format_profile
 
-			print(' parsed file : {}'.format(file))
+			logger.debug(' parsed file : %s', file, extra={'event': 'parsed', 'path': path, 'size': filesize})
 			# create Clip object for easier manipulation and passing around
 			return Clip(filepath, filename, filesize, length, vcodec, vcodec_alt, vbitrate, vbitrate_alt, vwidth,
 						vheight, vscantype, vframerate, vframerate_alt, acodec, abitrate, asample, aprofile)
 		else:
-			print('ERROR parsing: {}  -  no video track detected'.format(file))
+			logger.error('ERROR parsing: %s  -  no video track detected', file, extra={'event': 'failed', 'path': path})
 
 	except AttributeError:
-		print('ERROR parsing: {}  -  malformed video file?'.format(file))
+		logger.error('ERROR parsing: %s  -  malformed video file?', file, extra={'event': 'failed', 'path': path})
 
 
-def parse_zip_file(root, file):
+def parse_zip_file(session, root, file):
 	"""
 	Processes a compressed archive and attempts to get information on the image-set located therein.
 	We could have used MediaInfo for this too, but Pillow is easier and more reliable.
 	Additionally, pymediainfo (and perhaps the MediaInfo lib itself) require an actual file-url to parse an object.
 	This would require us to create a tempfile for each read/extracted image, before being able to parse it.
 	"""
+	# imported on first use, only needed when parse_zip is enabled
+	from zipfile import ZipFile, BadZipFile
+	from PIL import Image
+
+	path = os.path.join(root, file)
+
 	try:
-		print(' attempt archive: {}'.format(file))
+		logger.debug(' attempt archive: %s', file)
 		# each archive is an entire image-set, so we'll get some basic information on the set
-		with ZipFile(os.path.join(root, file)) as archive:
+		with ZipFile(path) as archive:
 			img_count = 0
 			max_resolution = (0, 0)
-			filesize = os.path.getsize(os.path.join(root, file))
+			filesize = os.path.getsize(path)
 			orig_size = 0
 
 			for member in archive.infolist():
+				# big archives can take a while, so check for cancellation after each image
+				if session.cancelled:
+					return
+
 				orig_size += member.file_size
 				# parse each image in the archive to determine the highest image-resolution present
 				with archive.open(member) as img:
@@ -223,151 +626,385 @@ def parse_zip_file(root, file):
 						continue
 
 			if img_count:
-				filesize = readable_number(filesize)
+				readable_size = readable_number(filesize)
 				orig_size = readable_number(orig_size)
-				print(' parsed archive : {}'.format(file))
-				return ImageSet(root, file, filesize, orig_size, img_count, max_resolution)
+				logger.debug(' parsed archive : %s', file, extra={'event': 'parsed', 'path': path, 'size': readable_size})
+				imageset = ImageSet(root, file, readable_size, orig_size, img_count, max_resolution)
+				set_sort_keys(imageset, filesize, 0, max_resolution[0] * max_resolution[1])
+				return imageset
 			else:
-				print(' ERROR parsing  : {}  -  no image files in archive?'.format(file))
+				logger.error(' ERROR parsing  : %s  -  no image files in archive?', file,
+							extra={'event': 'failed', 'path': path})
 
 	except BadZipFile:
-		print(' ERROR parsing  : {}  -  unsupported archive type?'.format(file))
+		logger.error(' ERROR parsing  : %s  -  unsupported archive type?', file, extra={'event': 'failed', 'path': path})
 
 
-def generate_output(items, source):
+def generate_output(session, items, source):
 	"""
 	Takes the items (Clips and/or ImageSets) generated from a dir parsing session and determines the formatting to use.
 	"""
-	global tags
 
 	# no items (clips/image-sets)? something is wrong
 	if not items:
-		print('ERROR: No media clips found! The script shouldn\'t even have gotten this far. o_O')
+		logger.error('ERROR: No media clips found! The script shouldn\'t even have gotten this far. o_O')
 		return
 
 	# stop if this combination is active, it will produce a mess
-	if config.opts['whole_filename_is_link'] and config.opts['embed_images'] and not config.opts['output_as_table']:
-		print('Using the parameters "whole_filename_is_link" and "embed_images" and not "output_as_table"'
-			' is the only invalid combination\n\n')
+	if invalid_layout(session):
 		return
 
 	# setup some file locations for input/output
-	if config.opts['output_individual']:
+	if session.opts['output_individual']:
 		# When creating an output file for each parsed directory, we don't want to have to create directories to
 		# the same depth as the source files (in order to keep the file structure). So for directories deeper than
 		# media_dir + 1, we concatenate the dir-names into a long string.
-		relpath = os.path.relpath(source, config.opts['media_dir'])
+		relpath = os.path.relpath(source, session.opts['media_dir'])
 
 		if relpath == '.':
-			working_file = os.path.join(config.opts['output_dir'], os.path.basename(source))
+			working_file = os.path.join(session.opts['output_dir'], os.path.basename(source))
 		else:
-			working_file = os.path.join(config.opts['output_dir'], relpath.replace('\\', '__').replace('/', '__'))
+			working_file = os.path.join(session.opts['output_dir'], relpath.replace('\\', '__').replace('/', '__'))
 	else:
-		working_file = os.path.join(config.opts['output_dir'], os.path.basename(source))
+		working_file = os.path.join(session.opts['output_dir'], os.path.basename(source))
 
 	file_output = working_file + '_output.txt'
 	file_output_html = working_file + '_output.html'
+	img_list_files = get_img_list_files(session, working_file)
+
+	# get the image data for later use
+	img_data, img_data_alt, img_data_fullsize = get_img_data(session, *img_list_files)
+	has_alts = True if img_data_alt else False
+
+	# skip the output entirely if it was written from exactly the same inputs before (see output_manifest.py), unless
+	# a catalog is exported, which needs the image matches of every output
+	manifest = input_fingerprint = None
+	if session.opts['skip_unchanged']:
+		from mediatobbcode import output_manifest
+
+		# ImageBam images are matched by the hash of the local screenshots, so those are inputs too
+		screenshots = any('imagebam' in data['host'] for data in (img_data, img_data_alt, img_data_fullsize) if data)
+		manifest = output_manifest.get_manifest(session)
+		input_fingerprint = output_manifest.fingerprint(session, items, img_list_files, screenshots)
+		extra_files = (file_output_html,) if session.opts['output_html'] else ()
+		if not session.catalog and manifest.unchanged(file_output, input_fingerprint, extra_files):
+			logger.info('Output unchanged, skipped: %s', file_output, extra={'event': 'unchanged', 'path': file_output})
+			session.unchanged.append(file_output)
+			if session.results_callback:
+				for _list in items.values():
+					for item in _list:
+						if not isinstance(item, Separator):
+							report_result(session, item, 'unchanged')
+			return
+
+	# make output file, it's written under a temporary name first and only renamed once complete, so a cancelled
+	# (or crashed) run never leaves a half-written output file behind
+	output, temp_output = open_temp_output(session, file_output)
+	if not output:
+		return
+	writer = PostWriter(output, session.opts['post_size_limit'])
+
+	# look for copies of the same file, before the items are converted below (not when rendering from a catalog, it
+	# has no fingerprints, and rendering mustn't touch the media files)
+	duplicates = None
+	if session.opts['flag_duplicates'] and not session.opts['render_from']:
+		duplicates = find_duplicates(session, items)
+
+	# convert the dictionary of lists of objects, to a dictionary of lists of object/lists (with image data)
+	prepared_items = prepare_items(session, items, img_data, img_data_alt, img_data_fullsize)
+	if not prepared_items:
+		discard_output(session, output, temp_output)
+		return
+
+	if session.catalog:
+		session.catalog.add_output(session, source, file_output, prepared_items)
+
+	with session.phase('format'):
+		# create a list of all the full-sized images (if present) for fast single-click browsing
+		if session.opts['use_imagelist_fullsize']:
+			for _type, _list in prepared_items.items():
+				if not _list:
+					continue
+				writer.writelines(format_fullsize_section(session, _list))
+
+		# everything is set up, now we can finally output something useful
+		if session.opts['all_layouts']:
+			generate_all_layouts(session, writer, prepared_items, has_alts)
+		else:
+			for _type, _list in prepared_items.items():
+				if not _list:
+					continue
+				with session.phase('collection', _type, profile=False):
+					writer.writelines(format_collection(session, _type, _list, has_alts))
+
+	if session.stopping:
+		discard_output(session, output, temp_output)
+		return
+
+	# append the generated performer tags to the output
+	if session.tags:
+		writer.write('PERFORMER TAGS:  ' + ' '.join(select_tags(session)) + '\n\n')
+		session.tags = OrderedDict()  # reset tags for next run (particularly in recursive/individual mode)
+		logger.info('Performer tags added')
+
+	# list the files with identical contents
+	if duplicates:
+		writer.write('DUPLICATE FILES:\n' + ''.join('  ' + ' = '.join(paths) + '\n' for paths in duplicates) + '\n')
+
+	# finished succesfully
+	output.close()
+	try:
+		os.replace(temp_output, file_output)
+	except (IOError, OSError):
+		logger.error('ERROR: Couldn\'t create output file: %s  (invalid directory?)', file_output)
+		return
+	session.temp_files.discard(temp_output)
+	session.outputs.append(file_output)
+	logger.info('Output written to: %s', file_output, extra={'event': 'output', 'path': file_output})
+
+	# convert the final output to HTML code for quicker testing
+	if session.opts['output_html']:
+		from mediatobbcode import output_html
+		output_html.format_html_output(session, file_output, file_output_html)
+
+	if manifest:
+		manifest.record(file_output, input_fingerprint)
+
+
+def generate_diff(session, old_catalog, new_catalog):
+	"""
+	Writes the differences between two catalogs (see catalog.diff_catalogs()) to a _diff.txt file in the output_dir:
+	the items that were added, removed and changed (like a clip re-encoded at a different bit-rate). Each section is
+	formatted like a regular output, with the image-lists of the (non-individual) output of the media_dir.
+	"""
+	from mediatobbcode.catalog import diff_catalogs
+
+	if invalid_layout(session):
+		return
+
+	differences = diff_catalogs(old_catalog, new_catalog)
+	if differences is None:
+		return
+
+	sections = OrderedDict()
+	for status in diff_titles:
+		sections[status] = OrderedDict([('clips', new_item_list(session)), ('imagesets', new_item_list(session))])
+
+	for collection, status, item, changed in differences:
+		sections[status][collection].append(item)
+		if changed:
+			path = os.path.join(item.filepath, item.filename)
+			logger.info('Changed: %s  (%s)', path, ', '.join(changed), extra={'event': 'changed', 'path': path})
+
+	working_file = os.path.join(session.opts['output_dir'], os.path.basename(session.opts['media_dir']))
+	file_output = working_file + '_diff.txt'
+	img_data, img_data_alt, img_data_fullsize = get_img_data(session, *get_img_list_files(session, working_file))
+	has_alts = True if img_data_alt else False
+
+	# a session of its own, so the image matches of the diff don't count towards the results and metrics of the run
+	diff_session = Session(session.opts, session.cache, cancel_token=session.cancel_token)
 
-	if config.opts['imagelist_primary']:
-		file_img_list = config.opts['imagelist_primary']
+	output, temp_output = open_temp_output(session, file_output)
+	if not output:
+		return
+	writer = PostWriter(output, session.opts['post_size_limit'])
+
+	total = 0
+	for status, items in sections.items():
+		count = sum(len(_list) for _list in items.values())
+		if not count:
+			continue
+		total += count
+
+		prepared_items = prepare_items(diff_session, items, img_data, img_data_alt, img_data_fullsize)
+		if not prepared_items:
+			discard_output(session, output, temp_output)
+			return
+
+		writer.write('[size=3][b]{} ({})[/b][/size]\n\n'.format(diff_titles[status], count))
+		for _type, _list in prepared_items.items():
+			if _list:
+				writer.writelines(format_collection(diff_session, _type, _list, has_alts))
+
+	if not total:
+		writer.write('[size=3][b]No changes[/b][/size]\n\n')
+
+	output.close()
+	try:
+		os.replace(temp_output, file_output)
+	except (IOError, OSError):
+		logger.error('ERROR: Couldn\'t create output file: %s  (invalid directory?)', file_output)
+		return
+	session.temp_files.discard(temp_output)
+	session.outputs.append(file_output)
+	logger.info('Differences (%d) written to: %s', total, file_output, extra={'event': 'output', 'path': file_output})
+
+
+def invalid_layout(session):
+	if session.opts['whole_filename_is_link'] and session.opts['embed_images'] and not session.opts['output_as_table']:
+		logger.error('Using the parameters "whole_filename_is_link" and "embed_images" and not "output_as_table"'
+					' is the only invalid combination\n\n')
+		return True
+	return False
+
+
+def get_img_list_files(session, working_file):
+	"""
+	Returns the primary, alternative and full-size image-list files for an output (unless specified in the options).
+	"""
+	if session.opts['imagelist_primary']:
+		file_img_list = session.opts['imagelist_primary']
 	else:
 		file_img_list = working_file + '.txt'
 
-	if config.opts['imagelist_alternative']:
-		file_img_list_alt = config.opts['imagelist_alternative']
+	if session.opts['imagelist_alternative']:
+		file_img_list_alt = session.opts['imagelist_alternative']
 	else:
 		file_img_list_alt = working_file + '_alt.txt'
 
-	if config.opts['imagelist_fullsize']:
-		file_img_list_fullsize = config.opts['imagelist_fullsize']
+	if session.opts['imagelist_fullsize']:
+		file_img_list_fullsize = session.opts['imagelist_fullsize']
 	else:
 		file_img_list_fullsize = working_file + '_fullsize.txt'
 
-	# make output file
-	try:
-		output = open(file_output, 'w+', encoding='utf-8')
-	except (IOError, OSError):
-		print('ERROR: Couldn\'t create output file: {}  (invalid directory?)'.format(file_output))
-		return
+	return file_img_list, file_img_list_alt, file_img_list_fullsize
 
-	# get the image data for later use
-	img_data = get_img_list(file_img_list)
-	if not img_data:
-		# just in case users use the script wrong (by only providing _fullsize.txt containing direct links)
-		img_data = get_img_list(file_img_list_fullsize)
 
-	# get a second set of image data to provide alternative image-links in case the primary image-host should die
-	img_data_alt = get_img_list(file_img_list_alt, True)
-	has_alts = True if img_data_alt else False
+def get_img_data(session, file_img_list, file_img_list_alt, file_img_list_fullsize):
+	"""
+	Reads the image data of the image-lists of an output (see get_img_list()).
+	"""
+	with session.phase('img_list'):
+		img_data = get_img_list(session, file_img_list)
+		if not img_data:
+			# just in case users use the script wrong (by only providing _fullsize.txt containing direct links)
+			img_data = get_img_list(session, file_img_list_fullsize)
 
-	# get the full-size image data (see format_fullsize_section())
-	img_data_fullsize = None
-	if config.opts['use_imagelist_fullsize'] and not config.opts['use_primary_as_fullsize']:
-		img_data_fullsize = get_img_list(file_img_list_fullsize)
+		# get a second set of image data to provide alternative image-links in case the primary image-host should die
+		img_data_alt = get_img_list(session, file_img_list_alt, True)
 
-	# convert the dictionary of lists of objects, to a dictionary of lists of object/lists (with image data)
-	prepared_items = prepare_items(items, img_data, img_data_alt, img_data_fullsize)
+		# get the full-size image data (see format_fullsize_section())
+		img_data_fullsize = None
+		if session.opts['use_imagelist_fullsize'] and not session.opts['use_primary_as_fullsize']:
+			img_data_fullsize = get_img_list(session, file_img_list_fullsize)
 
-	# create a list of all the full-sized images (if present) for fast single-click browsing
-	if config.opts['use_imagelist_fullsize']:
-		for _type, _list in prepared_items.items():
-			if not _list:
+	return img_data, img_data_alt, img_data_fullsize
+
+
+def find_duplicates(session, items):
+	"""
+	Finds the items (clips and image-sets) whose files have identical contents, judged by a quick fingerprint (see
+	quick_fingerprint()). Different names of the same physical file (hardlinks, symlinks) are not duplicates.
+	Returns a list with a list of paths (relative to the media_dir) for each set of duplicates.
+	"""
+	groups = OrderedDict()  # fingerprint: {(device, inode): path}
+	for _list in items.values():
+		for item in _list:
+			if isinstance(item, Separator):
 				continue
-			output.write(format_fullsize_section(_list))
 
-	# everything is set up, now we can finally output something useful
-	if config.opts['all_layouts']:
-		generate_all_layouts(output, prepared_items, has_alts)
-	else:
-		for _type, _list in prepared_items.items():
-			if not _list:
+			path = os.path.join(item.filepath, item.filename)
+			try:
+				stat = os.stat(path)
+				fingerprint = quick_fingerprint(session, path, stat)
+			except (IOError, OSError):
 				continue
-			output.write(format_collection(_type, _list, has_alts))
+			groups.setdefault(fingerprint, OrderedDict()).setdefault((stat.st_dev, stat.st_ino), path)
 
-	# append the generated performer tags to the output
-	if tags:
-		output.write('PERFORMER TAGS:  ' + ' '.join(tags) + '\n\n')
-		tags = []  # reset global tags for next run (particularly in recursive/individual mode)
-		print('Performer tags added')
+	duplicates = []
+	for files in groups.values():
+		if len(files) > 1:
+			paths = [os.path.relpath(path, session.opts['media_dir']) for path in files.values()]
+			logger.warning('WARNING: Duplicate files: %s', ' = '.join(paths), extra={'event': 'duplicate', 'paths': paths})
+			duplicates.append(paths)
 
-	# finished succesfully
-	output.close()
-	print('Output written to: {}'.format(file_output))
+	return duplicates
 
-	# convert the final output to HTML code for quicker testing
-	if config.opts['output_html']:
-		import output_html
-		output_html.format_html_output(file_output, file_output_html)
 
+def quick_fingerprint(session, path, stat, block=65536):
+	"""
+	Returns the size of a file, and the SHA-1 hash of its first and last 64 KiB. Much cheaper than hashing everything,
+	and good enough to tell copies of media files apart from different files. Cached in the session by inode.
+	"""
+	from hashlib import sha1
+
+	cache = session.cache.setdefault('fingerprints', {})
+	cache_key = (stat.st_dev, stat.st_ino, stat.st_mtime, stat.st_size)
+	if cache_key in cache and stat.st_ino:
+		return cache[cache_key]
+
+	digest = sha1()
+	with open(path, 'rb') as stream:
+		digest.update(stream.read(block))
+		if stat.st_size > block:
+			stream.seek(max(stat.st_size - block, block))
+			digest.update(stream.read(block))
 
-def prepare_items(items, img_data, img_data_alt, img_data_fullsize):
+	fingerprint = (stat.st_size, digest.hexdigest())
+	cache[cache_key] = fingerprint
+	return fingerprint
+
+
+def open_temp_output(session, file_output):
 	"""
-	Combine media items with image data (from 3 different image-list sources).
+	Opens a temporary file to write an output file to, renamed to the output file once complete. Each output that is
+	written gets a name of its own, so sessions writing the same output file at the same time can't mix their data
+	(the last one to finish wins). Returns the open file and its path, or (None, None) if it can't be created.
 	"""
-	global tags
+	temp_output = '{}.{}-{}.part'.format(file_output, os.getpid(), next(temp_output_numbers))
+	try:
+		output = open(temp_output, 'w+', encoding='utf-8')
+	except (IOError, OSError):
+		logger.error('ERROR: Couldn\'t create output file: %s  (invalid directory?)', file_output)
+		return None, None
+	session.temp_files.add(temp_output)
+	return output, temp_output
+
+
+def discard_output(session, output, temp_output):
+	"""
+	Throws away an unfinished output file, after the session was cancelled.
+	"""
+	output.close()
+	os.remove(temp_output)
+	session.temp_files.discard(temp_output)
+	logger.warning('Cancelled, no output written')
+
+
+def prepare_items(session, items, img_data, img_data_alt, img_data_fullsize):
+	"""
+	Combine media items with image data (from 3 different image-list sources), into new lists of the same kind (see
+	new_item_list()). Returns None if the session was cancelled halfway (and no partial output is wanted).
+	"""
+	prepared_items = OrderedDict()
 
 	for _type, _list in items.items():
+		prepared_items[_type] = prepared_list = new_item_list(session)
 		if not _list:
 			continue
 
 		# iterate over each item, and add corresponding image data
-		for _id, item in enumerate(_list):
+		for item in _list:
 
 			# separators don't require any processing
 			if isinstance(item, Separator):
+				prepared_list.append(item)
 				continue
 
+			if session.stopping:
+				return
+
 			img_match = img_match_alt = img_match_fullsize = None
 
 			# get thumbnail data from image-list, alternative/backup image-list, and full-size image-list
 			for _set, idata in enumerate([img_data, img_data_alt, img_data_fullsize]):
 				if idata:
 					if 'imagebam' in idata['host']:
-						file_slug = get_screenshot_hash(item.filename, item.filepath, 'md5', 6)
+						file_slug = get_screenshot_hash(session, item.filename, item.filepath, 'md5', 6)
 					else:
 						file_slug = slugify(item.filename, idata['host'])
 
-					match = match_slug(idata['img_list'], file_slug, idata['file'])  # list, can be multiple!
+					match = match_slug(session, idata['img_list'], file_slug, idata['file'])  # list, can be multiple!
 
 					if _set == 0:
 						img_match = match
@@ -376,38 +1013,71 @@ def prepare_items(items, img_data, img_data_alt, img_data_fullsize):
 					elif _set == 2:
 						img_match_fullsize = match
 
-			if config.opts['use_imagelist_fullsize'] and config.opts['use_primary_as_fullsize']:
+			if session.opts['use_imagelist_fullsize'] and session.opts['use_primary_as_fullsize']:
 				img_match_fullsize = img_match
 
 			# try to generate performer tags for presentation, see generate_tags()
-			generate_tags(item.filename)
+			generate_tags(session, item.filename)
+
+			if session.results_callback:
+				report_result(session, item, match_status(img_match))
 
 			# convert the item object to a list, combining the object with its image matches
-			items[_type][_id] = {'item': item,
+			prepared_list.append({'item': item,
 								'img_match': img_match,
 								'img_match_alt': img_match_alt,
-								'img_match_fullsize': img_match_fullsize}
+								'img_match_fullsize': img_match_fullsize})
+
+	return prepared_items
+
+
+def match_status(img_match):
+	if not img_match:
+		return 'missing'
+	return 'matched' if len(img_match) == 1 else 'conflict'
+
+
+def report_result(session, item, status='pending'):
+	"""
+	Passes a row with the details of a parsed item (and the status of its image match) to the results callback of the
+	session, for the results table of the GUI. Rows are identified by their 'path', the 'keys' are used for sorting.
+	"""
+	if not session.results_callback:
+		return
+
+	path = os.path.join(item.filepath, item.filename)
+	size = item.sort_keys[sort_orders.index('size')]  # the raw size in bytes, without touching the file again
+
+	if isinstance(item, Clip):
+		columns = [item.filename, item.filesize, item.length, item.vcodec,
+					'{0}×{1}'.format(item.vwidth, item.vheight), status]
+		pixels = (item.vwidth or 0) * (item.vheight or 0)
+	else:
+		columns = [item.filename, item.filesize, '{} images'.format(item.img_count), 'ZIP',
+					'{0}×{1}'.format(item.resolution[0], item.resolution[1]), status]
+		pixels = item.resolution[0] * item.resolution[1]
 
-	return items
+	keys = [item.filename.lower(), size, columns[2] or '', columns[3] or '', pixels, status]
+	session.results_callback({'path': path, 'columns': columns, 'keys': keys})
 
 
-def format_collection(_type, _list, has_alts):
+def format_collection(session, _type, _list, has_alts):
 	"""
-	Sets up the output for a collection (Clips or ImageSets).
+	Sets up the output for a collection (Clips or ImageSets). The output is yielded in parts (a row at a time), so the
+	output of a large library is never held in memory as a whole, and can be split into posts (see posts.py).
 	"""
 	column_names = None
-	output = ''
 
 	# if we choose to output the data as a table, we need to set up the table headers before the data first row
-	if config.opts['output_as_table']:
+	if session.opts['output_as_table']:
 
 		# setup columns
-		column_names = ['Filename{}'.format(' + IMG' if config.opts['embed_images'] else '')]
+		column_names = ['Filename{}'.format(' + IMG' if session.opts['embed_images'] else '')]
 		if _type == 'clips':
-			title = config.opts['tFileDetails']
+			title = session.opts['tFileDetails']
 			column_names += ['Size', 'Length', 'Codec', 'Resolution', 'Audio']
 		elif _type == 'imagesets':
-			title = config.opts['tImageSets']
+			title = session.opts['tImageSets']
 			column_names += ['Images', 'Resolution', 'Size', 'Unpacked']
 		else:
 			title = '?'
@@ -415,19 +1085,19 @@ def format_collection(_type, _list, has_alts):
 			column_names += ['Alt.']
 
 		# output table title
-		if config.opts['output_table_titles']:
+		if session.opts['output_table_titles']:
 			tt = ('[table=100%][tr][td={1}][bg={2}][align=center][font={4}][size=5][color={3}]'
 				'[b]{0}[/b][/color][/size][/font][/align][/bg][/td][/tr][/table]'
-				.format(title, config.opts['cTHBD'], config.opts['cTHBG'], config.opts['cTHF'], config.opts['fTH']))
-			output += tt
+				.format(title, session.opts['cTHBD'], session.opts['cTHBG'], session.opts['cTHF'], session.opts['fTH']))
+			yield tt
 
 		# setup the main table
-		th = '[size=0][align=center][table=100%,{}]\n[tr]'.format(config.opts['cTBBG'])
+		th = '[size=0][align=center][table=100%,{}]\n[tr]'.format(session.opts['cTBBG'])
 		th += '[th][align=left]{}[/align][/th]'.format(column_names[0])
 		for name in column_names[1:]:
 			th += '[th]{}[/th]'.format(name)
 		th += '[/tr]\n'
-		output += th
+		yield Wrapper(th, '[/table][/align][/size]')
 
 	items_parsed = 0
 
@@ -435,25 +1105,24 @@ def format_collection(_type, _list, has_alts):
 	for item in _list:
 
 		if isinstance(item, Separator):
-			output += format_row_separator(item, column_names)
+			yield format_row_separator(session, item, column_names)
 			continue
 		else:
 			# don't count separators towards the final output
 			items_parsed += 1
 
 		# generate the item's content row
-		output += format_row_common(item['item'], item['img_match'], item['img_match_alt'], has_alts)
+		yield format_row_common(session, item['item'], item['img_match'], item['img_match_alt'], has_alts)
 
 	# if we choose to output the data as a table, we need to set up the table footer after the last data row
-	if config.opts['output_as_table']:
-		output += '[/table][/align][/size]'
+	if session.opts['output_as_table']:
+		yield end_wrapper
 
-	output += ('[size=0][align=right]File information for {} items generated by MediaInfo. {}[/align][/size]\n\n'
-				.format(items_parsed, config.credits_bbcode))
-	return output
+	yield ('[size=0][align=right]File information for {} items generated by MediaInfo. {}[/align][/size]\n\n'
+			.format(items_parsed, config.credits_bbcode))
 
 
-def format_row_common(item, img_match, img_match_alt, has_alts=False):
+def format_row_common(session, item, img_match, img_match_alt, has_alts=False):
 	"""
 	Generate the row output based on the input item (a Clip or an ImageSet). Here we mainly do all operations that are
 	common to both 'table' and 'list' outputs, before calling the functions dealing with their differences.
@@ -461,10 +1130,10 @@ def format_row_common(item, img_match, img_match_alt, has_alts=False):
 	if img_match and len(img_match) == 1:
 		# format the image link (and thumbnail) into correct BBCode for display
 		img_match = img_match[0]
-		if config.opts['embed_images']:
+		if session.opts['embed_images']:
 			if img_match['bburl']:
 				img_code = '[url={1}][img]{0}[/img][/url]'.format(img_match['bbimg'], img_match['bburl'])
-			elif config.opts['output_bbcode_thumb']:
+			elif session.opts['output_bbcode_thumb']:
 				img_code = '[thumb]{0}[/thumb]'.format(img_match['bbimg'])
 			else:
 				img_code = '[img]{0}[/img]'.format(img_match['bbimg'])
@@ -495,33 +1164,33 @@ def format_row_common(item, img_match, img_match_alt, has_alts=False):
 		img_code_alt = False
 		img_msg_alt = ''
 
-	if config.opts['output_as_table']:
+	if session.opts['output_as_table']:
 		# output BBCode as a table row
-		output = format_row_table(item, img_code, img_msg, img_code_alt, img_msg_alt, has_alts)
+		output = format_row_table(session, item, img_code, img_msg, img_code_alt, img_msg_alt, has_alts)
 	else:
 		# output BBCode as a normal list row
-		output = format_row_list(item, img_code, img_msg, img_code_alt, img_msg_alt)
+		output = format_row_list(session, item, img_code, img_msg, img_code_alt, img_msg_alt)
 
 	return output
 
 
-def format_row_table(item, img_code, img_msg, img_code_alt, img_msg_alt, has_alts):
+def format_row_table(session, item, img_code, img_msg, img_code_alt, img_msg_alt, has_alts):
 	"""
 	Formats the output BBCode for an individual item (row) in the resulting table.
 	"""
 	if img_code:
 		# make the entire file-name a spoiler link
-		if config.opts['embed_images'] and config.opts['whole_filename_is_link']:
+		if session.opts['embed_images'] and session.opts['whole_filename_is_link']:
 			bbsafe_filename = item.filename.replace('[', '{').replace(']', '}')
 			col1 = '[spoiler={0}]{1}{2}[/spoiler]'.format(bbsafe_filename, img_code, img_msg_alt)
 		# inline spoiler BBCode pushes trailing text to the bottom, so if we embed images, they have to be at the end
-		elif config.opts['embed_images']:
+		elif session.opts['embed_images']:
 			col1 = '{0}     [spoiler=IMG]{1}{2}[/spoiler]'.format(item.filename, img_code, img_msg_alt)
-		elif config.opts['whole_filename_is_link']:
+		elif session.opts['whole_filename_is_link']:
 			col1 = '[b][url={1}]{0}[/url][/b]'.format(item.filename, img_code)
 		else:
 			col1 = '[b][b][url={1}]IMG[/url][/b]  {0}[/b]'.format(item.filename, img_code)
-	elif config.opts['suppress_img_warnings']:
+	elif session.opts['suppress_img_warnings']:
 		col1 = item.filename
 	else:
 		col1 = '{0}     {1}'.format(item.filename, img_msg)
@@ -541,7 +1210,7 @@ def format_row_table(item, img_code, img_msg, img_code_alt, img_msg_alt, has_alt
 		col5 = '[td]{}[/td]'.format(item.orig_size)
 		col6 = ''
 	else:
-		print('ERROR: script tried to parse an unknown object! This should never happen.')
+		logger.error('ERROR: script tried to parse an unknown object! This should never happen.')
 		return ''
 
 	if has_alts:
@@ -557,7 +1226,7 @@ def format_row_table(item, img_code, img_msg, img_code_alt, img_msg_alt, has_alt
 	return '[tr]{0}{1}{2}{3}{4}{5}{6}[/tr]\n'.format(col1, col2, col3, col4, col5, col6, col7)
 
 
-def format_row_list(item, img_code, img_msg, img_code_alt, img_msg_alt):
+def format_row_list(session, item, img_code, img_msg, img_code_alt, img_msg_alt):
 	"""
 	Formats the output BBCode for an individual item (row) in the resulting list.
 	This is messier to look at, but more flexible with images (and BBCode support).
@@ -565,9 +1234,9 @@ def format_row_list(item, img_code, img_msg, img_code_alt, img_msg_alt):
 	filename = item.filename
 
 	if img_code:
-		if config.opts['embed_images']:
+		if session.opts['embed_images']:
 			img_code = ' [spoiler=:]{0}{1}[/spoiler]'.format(img_code, img_msg_alt)
-		elif config.opts['whole_filename_is_link']:
+		elif session.opts['whole_filename_is_link']:
 			filename = '[url={1}]{0}[/url]'.format(filename, img_code)
 			if img_code_alt:
 				filename += '  ([url={}]alt.[/url])'.format(img_code_alt)
@@ -578,7 +1247,7 @@ def format_row_list(item, img_code, img_msg, img_code_alt, img_msg_alt):
 			else:
 				filename = '[b][url={1}]IMG[/url][/b]  {0}'.format(filename, img_code)
 			img_code = ''
-	elif config.opts['suppress_img_warnings']:
+	elif session.opts['suppress_img_warnings']:
 		img_code = ''
 	else:
 		img_code = '     {0}'.format(img_msg)
@@ -599,23 +1268,23 @@ def format_row_list(item, img_code, img_msg, img_code_alt, img_msg_alt):
 		return '[b]{1}[/b][size=0] {0} {3} {0} {4} [/size]{2}\n' \
 			.format(sep, filename, img_code, fmeta, fsize)
 	else:
-		print('ERROR: script tried to parse an unknown object! This should never happen.')
+		logger.error('ERROR: script tried to parse an unknown object! This should never happen.')
 		return ''
 
 
-def format_row_separator(separator, column_names):
+def format_row_separator(session, separator, column_names):
 	"""
 	Formats a separator row with the current parsing directory. For prettier organizing of rows.
 	"""
 	dir_name = separator.directory
 
-	if config.opts['output_as_table']:
+	if session.opts['output_as_table']:
 		td_opts = 'nb'  # TODO nb support is common?
-		if config.opts['cTSEPF']:
-			td_inner = '[size=3][color={1}][b]{0}[/b][/color][/size]'.format(dir_name, config.opts['cTSEPF'])
+		if session.opts['cTSEPF']:
+			td_inner = '[size=3][color={1}][b]{0}[/b][/color][/size]'.format(dir_name, session.opts['cTSEPF'])
 		else:
 			td_inner = '[size=3][b]{0}[/b][/size]'.format(dir_name)
-		tr = ('[tr={1}][td={2}][align=left]{0}[/align][/td]'.format(td_inner, config.opts['cTSEPBG'], td_opts))
+		tr = ('[tr={1}][td={2}][align=left]{0}[/align][/td]'.format(td_inner, session.opts['cTSEPBG'], td_opts))
 		for name in column_names[1:]:
 			tr += '[td={1}]{0}[/td]'.format(name, td_opts)
 		tr += '[/tr]\n'
@@ -625,49 +1294,49 @@ def format_row_separator(separator, column_names):
 		return '[size=2]- [b][i]{}[/i][/b][/size]\n'.format(dir_name)
 
 
-def format_fullsize_section(_list):
+def format_fullsize_section(session, _list):
 	"""
 	Create a list of all the full-sized images for fast single-click browsing. But requires support for [spoiler] tags.
+	Yielded in parts, like format_collection().
 	"""
-	output = ''
 
 	# set up the table header title before the actual content
-	if config.opts['output_as_table'] and config.opts['output_table_titles']:
-		output += ('[table=100%][tr][td={1}][bg={2}][align=center][font={4}][size=5][color={3}]'
+	if session.opts['output_as_table'] and session.opts['output_table_titles']:
+		yield ('[table=100%][tr][td={1}][bg={2}][align=center][font={4}][size=5][color={3}]'
 					'[b]{0}[/b][/color][/size][/font][/align][/bg][/td][/tr][/table]'
-					.format(config.opts['tFullSizeSS'], config.opts['cTHBD'], config.opts['cTHBG'],
-							config.opts['cTHF'], config.opts['fTH']))
+					.format(session.opts['tFullSizeSS'], session.opts['cTHBD'], session.opts['cTHBG'],
+							session.opts['cTHF'], session.opts['fTH']))
+
+	yield Wrapper('[bg={}]\n[align=center][size=2]'.format(session.opts['cTBBG']), '[/size][/align]\n[/bg]')
 
-	content = ''
 	previous_item_was_separator = False
 	for _id, item in enumerate(_list):
 		if isinstance(item, Separator):
 			if _id > 0:
-				content += '[/spoiler]\n\n'
-			content += '[spoiler={}]'.format(item.directory)
+				yield end_wrapper
+				yield '\n\n'
+			yield Wrapper('[spoiler={}]'.format(item.directory), '[/spoiler]')
 			previous_item_was_separator = True
 			continue
 		elif _id == 0:
-			content += '[spoiler={}]'.format(config.opts['tFullSizeShow'])
+			yield Wrapper('[spoiler={}]'.format(session.opts['tFullSizeShow']), '[/spoiler]')
 			previous_item_was_separator = True
 
-		if not previous_item_was_separator:
-			content += '\n'
+		# the line break goes with the image, so a post never starts with one
+		line_break = '' if previous_item_was_separator else '\n'
 
 		previous_item_was_separator = False
 		img_match = item['img_match_fullsize']
 		if img_match and len(img_match) == 1:
-			content += '[img]{0}[/img]'.format(img_match[0]['bbimg'])
+			yield line_break + '[img]{0}[/img]'.format(img_match[0]['bbimg'])
 		elif img_match:
-			content += '[color={}]Image conflict for: {}![/color]'.format(cWARN, item['item'].filename)
+			yield line_break + '[color={}]Image conflict for: {}![/color]'.format(cWARN, item['item'].filename)
 		else:
-			content += '[color={}]Image missing for: {}![/color]'.format(cERR, item['item'].filename)
+			yield line_break + '[color={}]Image missing for: {}![/color]'.format(cERR, item['item'].filename)
 
-	content += '[/spoiler]'
-
-	output += ('[bg={1}]\n[align=center][size=2]{0}[/size][/align]\n[/bg]\n\n'.format(content, config.opts['cTBBG']))
-
-	return output
+	yield end_wrapper
+	yield end_wrapper
+	yield '\n\n'
 
 
 def metadata_cleanup(clip):
@@ -675,6 +1344,13 @@ def metadata_cleanup(clip):
 	Performs various steps in order to check the integrity of the data, as well as cleaning up ugly inputs.
 	All this is very specific to MediaInfo, and might even break with versions other than MediaInfo 0.7.93. YMMV
 	"""
+	# while the metadata is still raw
+	try:
+		pixels = int(clip.vwidth or 0) * int(clip.vheight or 0)
+	except (TypeError, ValueError):
+		pixels = 0
+	set_sort_keys(clip, clip.filesize, clip.length, pixels)
+
 	# some missing meta-data cleanup
 	if clip.vbitrate_alt and (not clip.vbitrate or len(str(clip.vbitrate)) <= 5):
 		setattr(clip, 'vbitrate', clip.vbitrate_alt)
@@ -793,11 +1469,32 @@ def readable_number(num, suffix='iB', base=1024.0, ceiling=1024.0, decimals=2):
 	return "%.1f %s%s" % (num, 'Yi', suffix)
 
 
-def get_img_list(file_img_list, is_alt=False):
+def get_img_list(session, file_img_list, is_alt=False):
 	"""
 	Generates an image-list based on a txt file provided by the user. The txt file's content should be copy-pasted
 	from the output of the image-hosting website (after uploading the images as a batch). It should work, whether the
 	output is BBCode or just a plain list of image-URLs. As requested, some more dubious image-hosts have been added ;).
+	Parsed image-lists are cached in the session (keyed by path, mtime and size), so unchanged files are only read once.
+	"""
+	try:
+		stat = os.stat(file_img_list)
+		cache_key = (os.path.abspath(file_img_list), stat.st_mtime, stat.st_size)
+		if cache_key in session.cache['img_lists']:
+			return session.cache['img_lists'][cache_key]
+	except (IOError, OSError):
+		cache_key = None
+
+	with session.phase('img_list_file', file_img_list, cache_key[2] if cache_key else 0, profile=False):
+		img_data = read_img_list(file_img_list, is_alt)
+
+	if img_data and cache_key:
+		session.cache['img_lists'][cache_key] = img_data
+	return img_data
+
+
+def read_img_list(file_img_list, is_alt=False):
+	"""
+	Reads and parses a single image-list file (see get_img_list()).
 	"""
 	try:
 		file = open(file_img_list)
@@ -805,15 +1502,15 @@ def get_img_list(file_img_list, is_alt=False):
 		if is_alt:
 			# We always check for the _alt.txt image-list. But if there doesn't appear to be a file to parse,
 			# we should assume that the user simply doesn't with to use this feature, and just ignore it.
-			print('NOTICE: No corresponding alternative image-list found. Looked for: {}'.format(file_img_list))
+			logger.info('NOTICE: No corresponding alternative image-list found. Looked for: %s', file_img_list)
 		else:
-			print('WARNING: No corresponding image-list found! Looked for: {}'.format(file_img_list))
+			logger.warning('WARNING: No corresponding image-list found! Looked for: %s', file_img_list)
 		return
 
 	img_items = file.read().split()
 
 	if not img_items:
-		print('WARNING: Image-list file ({}) seems to be empty!'.format(file_img_list))
+		logger.warning('WARNING: Image-list file (%s) seems to be empty!', file_img_list)
 		return
 
 	if 'imagebam.' in img_items[0]:
@@ -833,9 +1530,9 @@ def get_img_list(file_img_list, is_alt=False):
 	elif 'fapping.empornium.' in img_items[0]:
 		img_host = 'fapping'
 	else:
-		print('WARNING: Unsupported image-host used in {}!\n'
-			'Only use imagebam.com, pixhost.org, postimg.org, imagetwist.com, imagevenue.com, imgchili.net, '
-			'pixxxels.org, jerking.empornium.ph or fapping.empornium.sx'.format(file_img_list))
+		logger.warning('WARNING: Unsupported image-host used in %s!\n'
+					'Only use imagebam.com, pixhost.org, postimg.org, imagetwist.com, imagevenue.com, imgchili.net, '
+					'pixxxels.org, jerking.empornium.ph or fapping.empornium.sx', file_img_list)
 		if config.debug_imghost_slugs:
 			img_host = 'unknown image-host'
 		else:
@@ -883,17 +1580,46 @@ def get_img_list(file_img_list, is_alt=False):
 	file.close()
 
 	if not img_list:
-		print('WARNING: No valid image data in image-list! Check the contents of: {}'.format(file_img_list))
+		logger.warning('WARNING: No valid image data in image-list! Check the contents of: %s', file_img_list)
 	else:
 		return {'host': img_host, 'img_list': img_list, 'file': file_img_list}
 
 
-def get_screenshot_hash(filename, filepath, algorithm, strlen):
+def get_screenshot_hash(session, filename, filepath, algorithm, strlen):
 	"""
 	Most image-hosts like ImageBam randomize the image's file-name after uploading, making the matching of video-clip
 	file-names with the online image location very difficult or completely impossible. Luckily, some of them use (parts)
 	of the file-hash to generate the file-name. We can exploit this and still match files.
 	"""
+	ss_found = find_screenshot(session, filename, filepath)
+
+	# generate the hash for the found image
+	if ss_found:
+		from hashlib import md5
+
+		with session.phase('hash', ss_found) as phase:
+			try:
+				with open(ss_found, 'rb') as img:
+					data = img.read()
+			except (IOError, OSError):
+				logger.error('ERROR: Couldn\'t open the following image to calculate hash: %s', ss_found)
+				return
+
+			phase.add_bytes(len(data))
+			session.stats.add('bytes_hashed', len(data))
+
+		if 'md5' in algorithm:
+			logger.debug('calculating MD5 hash for: %s', ss_found, extra={'event': 'hashed', 'path': ss_found})
+			return md5(data).hexdigest()[:strlen]
+	else:
+		logger.warning('WARNING: Couldn\'t find screenshot file for: %s', filename,
+						extra={'event': 'missing', 'path': os.path.join(filepath, filename)})
+
+
+def find_screenshot(session, filename, filepath):
+	"""
+	Returns the path of the local screenshot of a media file (or None), searching the usual places for it.
+	"""
 	# screenshot generators can sometimes strip the clip file-extension, so we have to check both variants
 	filename_variants = [os.path.splitext(filename)[0], filename]
 
@@ -914,42 +1640,30 @@ def get_screenshot_hash(filename, filepath, algorithm, strlen):
 		search_dirs.append(os.path.join(filepath, ss_subdir))
 
 	# path of video relative to master path
-	relpath = os.path.relpath(filepath, config.opts['media_dir'])
+	relpath = os.path.relpath(filepath, session.opts['media_dir'])
 	if relpath is not '.':
 		for ss_subdir in common_ss_subdirs:
 			# for when screenshots are located at the top level dir, but have the same dir structure as the clips
-			search_dirs.append(os.path.join(config.opts['media_dir'], ss_subdir, relpath))
+			search_dirs.append(os.path.join(session.opts['media_dir'], ss_subdir, relpath))
 
 	for ss_subdir in common_ss_subdirs:
 		# commonly named sub-dirs of the top level media_dir (when recursive clip searching is used)
-		search_dirs.append(os.path.join(config.opts['media_dir'], ss_subdir))
+		search_dirs.append(os.path.join(session.opts['media_dir'], ss_subdir))
 
 	# perform the actual search by traversing all the directories listed, and test all file-name variants in those dirs
 	ss_found = None
-	for path in search_dirs:
-		for variant in search_variants:
-			img_path = os.path.join(path, variant)
-			if os.path.isfile(img_path):
-				ss_found = img_path
-				break
-		else:
-			continue
-		break
-
-	# generate the hash for the found image
-	if ss_found:
-		try:
-			with open(ss_found, 'rb') as img:
-				data = img.read()
-		except (IOError, OSError):
-			print('ERROR: Couldn\'t open the following image to calculate hash: {}'.format(ss_found))
-			return
+	with session.phase('ss_search'):
+		for path in search_dirs:
+			for variant in search_variants:
+				img_path = os.path.join(path, variant)
+				if os.path.isfile(img_path):
+					ss_found = img_path
+					break
+			else:
+				continue
+			break
 
-		if 'md5' in algorithm:
-			print('calculating MD5 hash for: {}'.format(ss_found))
-			return md5(data).hexdigest()[:strlen]
-	else:
-		print('WARNING: Couldn\'t find screenshot file for: {}'.format(filename))
+	return ss_found
 
 
 def slugify(filename, img_host):
@@ -997,38 +1711,50 @@ def slugify(filename, img_host):
 	return slug
 
 
-def match_slug(img_list, file_slug, file_img_list):
+def match_slug(session, img_list, file_slug, file_img_list):
 	"""
 	Lookup the online url(s) for the corresponding slug in the local image list (see get_img_list()).
 	Returns (all) matches, including false-positives unfortunately.
 	"""
 	# file slugs can be None when get_screenshot_hash() isn't successful
 	if not file_slug:
+		session.stats.add('images_missing')
 		return
 
 	matches = []
-	for img in img_list:
-		try:
-			match_pos = img['slug'].index(file_slug)
-			img['match_pos'] = match_pos
-			matches.append(img)
-		except ValueError:
-			continue
+	with session.phase('match'):
+		for img in img_list:
+			try:
+				match_pos = img['slug'].index(file_slug)
+				img['match_pos'] = match_pos
+				matches.append(img)
+			except ValueError:
+				continue
 
 	if len(matches) > 1:
-		print('WARNING: Multiple corresponding image-urls found for "{}" in: {}'.format(file_slug, file_img_list))
+		logger.warning('WARNING: Multiple corresponding image-urls found for "%s" in: %s', file_slug, file_img_list,
+						extra={'event': 'conflicting', 'slug': file_slug, 'path': file_img_list})
+		session.stats.add('images_conflicting')
 		return matches
 	elif matches:
+		session.stats.add('images_matched')
+		logger.debug('matched "%s" in: %s', file_slug, file_img_list,
+					extra={'event': 'matched', 'slug': file_slug, 'path': file_img_list})
 		return matches
 	else:
-		print('WARNING: No corresponding image-url found for "{}" in: {}'.format(file_slug, file_img_list))
+		session.stats.add('images_missing')
+		logger.warning('WARNING: No corresponding image-url found for "%s" in: %s', file_slug, file_img_list,
+						extra={'event': 'missing', 'slug': file_slug, 'path': file_img_list})
 
 
-def debug_imghost_matching(_dir='../tests/image-hosts/'):
+def debug_imghost_matching(_dir='../tests/image-hosts/', session=None):
 	"""
 	Debug method for easier testing of image-host output. Compares a the file-names of a collection of images to 
 	the output of various image-hosts and provides digestible information on how the slugs are formed.
 	"""
+	if session is None:
+		session = Session()
+
 	img_dir = os.path.normpath(os.path.join(_dir, 'images'))
 
 	# from: https://svn.blender.org/svnroot/bf-blender/trunk/blender/build_files/scons/tools/bcolors.py
@@ -1059,7 +1785,7 @@ def debug_imghost_matching(_dir='../tests/image-hosts/'):
 		if host_file.lower().endswith('.txt'):
 			print('\n{1}TEST HOST{2}  : {0}'.format(host_file, c['HEAD'], c['ENDC']))
 
-			img_data = get_img_list(os.path.join(_dir, host_file))
+			img_data = get_img_list(session, os.path.join(_dir, host_file))
 			if not img_data:
 				continue
 
@@ -1070,7 +1796,7 @@ def debug_imghost_matching(_dir='../tests/image-hosts/'):
 
 				# get the file-name slug
 				if 'imagebam' in img_data['host']:
-					file_slug = get_screenshot_hash(name, img_dir, 'md5', 6)
+					file_slug = get_screenshot_hash(session, name, img_dir, 'md5', 6)
 				else:
 					file_slug = slugify(name, img_data['host'])
 
@@ -1102,7 +1828,7 @@ def debug_imghost_matching(_dir='../tests/image-hosts/'):
 					img_list = img_data['img_list']
 
 				# do the matching, and output something understandable (hopefully)
-				matches = match_slug(img_list, file_slug, host_file)
+				matches = match_slug(session, img_list, file_slug, host_file)
 
 				if matches and len(matches) == 1:
 					print('file-slug  : {1}{0}'.format(file_slug, ' ' * matches[0]['match_pos']))
@@ -1121,14 +1847,14 @@ def debug_imghost_matching(_dir='../tests/image-hosts/'):
 				index += 1
 
 
-def generate_tags(filename):
+def generate_tags(session, filename):
 	"""
 	Generates tags for all performers present in the file-names as a whole (YMMV).
 	This is handy for music videos, which often have credited performers in the file-name rather than the meta-data.
 	All tags will be common format. So "Michael Jackson ft. Bruno Mars - Song" outputs "michael.jackson bruno.mars"
 	Note that this will NOT capture "avicii" in something like: Performer - Song (Avicii Remix)
+	Tags are kept in an insertion-ordered dictionary, together with the number of items they were found in.
 	"""
-	global tags
 	segments = []
 
 	# find the names located before the movie title (everything before the " - " separator)
@@ -1138,33 +1864,48 @@ def generate_tags(filename):
 			segments.append(match_begin)
 
 	# find the names located in parenthesis using the "(w. ###)" or "(ft. ###)" or "(feat. ###)" format
-	match_in_parenthesis = re.findall('\((?:featuring|feat.|ft.|with|w.)(.*?)\)', filename)
-	if match_in_parenthesis:
-		for match in match_in_parenthesis:
-			segments.append(match)
+	segments.extend(re_tags_in_parenthesis.findall(filename))
 
 	if segments:
-		segments = ', '.join(segments)
-		segments = re.split(' and |[&,;]', segments)
+		segments = re_tags_split.split(', '.join(segments))
+		found = set()  # only count each tag once per item
 		for tag in segments:
 			if len(tag) > 2:
-				tag = re.sub('\.+', '.', tag.strip().lower().replace(' ', '.'))
-				ignored_tags = ('various', 'others', 'multiple', 'downloaded', 'mixed')
+				tag = re_tags_dots.sub('.', tag.strip().lower().replace(' ', '.'))
 
 				# some tags to exclude, and performers generally don't have underscores in their names
-				if '_' in tag:
+				if '_' in tag or tag in found:
 					continue
 				elif any(test in tag for test in ignored_tags):
 					continue
-				elif tag not in tags:
-					tags.append(tag)
+
+				found.add(tag)
+				session.tags[tag] = session.tags.get(tag, 0) + 1
+
+
+def select_tags(session):
+	"""
+	Returns the performer tags to output. Either in order of appearance, or sorted by frequency (most common first,
+	ties keep their order of appearance), optionally capped at 'tags_limit'.
+	"""
+	limit = session.opts['tags_limit']
+
+	if session.opts['tags_by_frequency']:
+		if limit > 0:
+			# nlargest() is stable for ties, just like sorted(reverse=True)
+			return [tag for tag, count in heapq.nlargest(limit, session.tags.items(), key=lambda t: t[1])]
+		return [tag for tag, count in sorted(session.tags.items(), key=lambda t: t[1], reverse=True)]
+	elif limit > 0:
+		return list(session.tags)[:limit]
+	else:
+		return list(session.tags)
 
 
-def generate_all_layouts(output, prepared_items, has_alts):
+def generate_all_layouts(session, writer, prepared_items, has_alts):
 	"""
 	Runs format_collection() multiple times with differing settings to generate all possible layouts.
 	"""
-	original_opts = copy.copy(config.opts)
+	original_opts = copy.copy(session.opts)
 
 	variants = [[True, True, True],
 				[True, False, True],
@@ -1175,27 +1916,28 @@ def generate_all_layouts(output, prepared_items, has_alts):
 				[False, False, False]]
 
 	for opts in variants:
-		config.opts['output_as_table'] = opts[0]
-		config.opts['embed_images'] = opts[1]
-		config.opts['whole_filename_is_link'] = opts[2]
+		session.opts['output_as_table'] = opts[0]
+		session.opts['embed_images'] = opts[1]
+		session.opts['whole_filename_is_link'] = opts[2]
 
 		# output the corresponding command-line options if we are doing an all_layouts loop, for easy reference
 		command_line_options = ''
-		if not config.opts['output_as_table']:
+		if not session.opts['output_as_table']:
 			command_line_options += '-l '
-		if not config.opts['embed_images']:
+		if not session.opts['embed_images']:
 			command_line_options += '-u '
-		if not config.opts['whole_filename_is_link']:
+		if not session.opts['whole_filename_is_link']:
 			command_line_options += '-t '
 
-		output.write('\n\nCommand-line options: [size=3][b]{}[/b][/size]\n\n'.format(command_line_options))
+		writer.write('\n\nCommand-line options: [size=3][b]{}[/b][/size]\n\n'.format(command_line_options))
 
 		for _type, _list in prepared_items.items():
 			if not _list:
 				continue
-			output.write(format_collection(_type, _list, has_alts))
+			with session.phase('collection', _type, profile=False):
+				writer.writelines(format_collection(session, _type, _list, has_alts))
 
-	config.opts = original_opts
+	session.opts = original_opts
 
 
 class Clip(object):
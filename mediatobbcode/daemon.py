@@ -0,0 +1,292 @@
+#!/usr/bin/env python3
+# coding=utf-8
+# Copyright 2017 PayBas
+# All Rights Reserved.
+
+import copy
+import json
+import logging
+import os
+import signal
+import socketserver
+import stat
+import threading
+import time
+from collections import deque
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from urllib.parse import urlparse, parse_qs
+
+from mediatobbcode import config
+from mediatobbcode.session import Session, make_pool, make_prober
+
+logger = logging.getLogger(__name__)
+
+# the options a scan request may override: how the files are parsed, and how the output is formatted. The rest (the
+# files the daemon reads or writes, like logs, traces, metrics, catalogs and image-lists, and its resources) always
+# keep the values the daemon was started with
+request_opts = frozenset(list(config.config['oopts']) + list(config.config['dopts']) + [
+	'recursive', 'parse_zip', 'use_imagelist_fullsize', 'use_primary_as_fullsize', 'tags_by_frequency', 'tags_limit',
+	'post_size_limit', 'sort_order', 'sort_dirs_first', 'sort_library', 'follow_links', 'flag_duplicates',
+	'skip_unchanged'])
+
+
+class ScanDaemon(object):
+	"""
+	Keeps the probe pool (and isolated probe workers), metadata cache and image-list cache resident between scan
+	requests, so every request after the first one only pays for the files that actually changed. Requests are
+	handled concurrently, but at most 'jobs' scans run at the same time, the rest wait in line (the queue depth
+	reported by metrics()). Scans writing to the same output dir wait for each other, so each request gets back the
+	outputs it wrote itself.
+	"""
+	def __init__(self, base_opts, jobs=2):
+		self.base_opts = copy.copy(base_opts)
+		self.cache = {}
+		self.pool = make_pool(base_opts['probe_workers']) if base_opts['probe_workers'] > 1 else None
+		self.prober = make_prober([base_opts], base_opts['probe_workers'])
+		self.job_slots = threading.BoundedSemaphore(max(1, jobs))
+
+		self.lock = threading.Lock()
+		self.output_locks = {}  # output dir: lock held while scanning into it
+		self.started = time.time()
+		self.waiting = 0
+		self.running = 0
+		self.requests_total = 0
+		self.requests_failed = 0
+		self.latencies = deque(maxlen=1000)  # in seconds, only the most recent scans
+
+	def make_opts(self, request):
+		"""
+		Builds the options for a scan request: the options of the daemon, with the overrides of the request applied.
+		Raises ValueError for malformed requests, unknown options, options that can't be overridden (see request_opts)
+		or values of the wrong type.
+		"""
+		if not isinstance(request, dict) or not request.get('media_dir'):
+			raise ValueError('a scan request must be a JSON object with at least a "media_dir"')
+
+		overrides = request.get('opts', {})
+		if not isinstance(overrides, dict):
+			raise ValueError('"opts" must be a JSON object')
+
+		opts = copy.copy(self.base_opts)
+		opts['media_dir'] = str(request['media_dir'])
+		opts['output_dir'] = str(request.get('output_dir', self.base_opts['output_dir']))
+
+		for opt, value in overrides.items():
+			if opt not in opts or opt in ('media_dir', 'output_dir'):
+				raise ValueError('unknown option: {}'.format(opt))
+			elif opt not in request_opts:
+				raise ValueError('option can\'t be set by a scan request: {}'.format(opt))
+
+			# JSON types map nicely onto our option types, as long as we keep bools and ints apart
+			default = self.base_opts[opt]
+			if isinstance(default, bool) != isinstance(value, bool) or not isinstance(value, type(default)):
+				raise ValueError('invalid value for option {}: {!r}'.format(opt, value))
+			opts[opt] = value
+
+		return opts
+
+	def scan(self, request):
+		"""
+		Runs a single scan request, and returns a list of (output path, BBCode) for all the output files written by it.
+		Raises ValueError for invalid requests.
+		"""
+		opts = self.make_opts(request)
+		start = time.time()
+
+		output_dir = os.path.abspath(os.path.expanduser(opts['output_dir'] or opts['media_dir']))
+		with self.lock:
+			self.waiting += 1
+			output_lock = self.output_locks.setdefault(output_dir, threading.Lock())
+
+		try:
+			with output_lock:
+				with self.job_slots:
+					with self.lock:
+						self.waiting -= 1
+						self.running += 1
+					try:
+						session = Session(opts, self.cache, self.pool, prober=self.prober)
+						session.run()
+					finally:
+						with self.lock:
+							self.running -= 1
+
+				outputs = []
+				# unchanged outputs weren't written again, but the client still wants their contents
+				for file_output in session.outputs + session.unchanged:
+					with open(file_output, encoding='utf-8') as stream:
+						outputs.append((file_output, stream.read()))
+		except:
+			with self.lock:
+				self.requests_total += 1
+				self.requests_failed += 1
+			raise
+
+		with self.lock:
+			self.requests_total += 1
+			if not outputs:
+				self.requests_failed += 1
+			self.latencies.append(time.time() - start)
+
+		return outputs
+
+	def metrics(self):
+		"""
+		Returns the current queue depth, request counters, cache sizes and scan latencies (in seconds).
+		"""
+		with self.lock:
+			latencies = sorted(self.latencies)
+
+			return {
+				'uptime': round(time.time() - self.started, 3),
+				'queue_depth': self.waiting,
+				'running': self.running,
+				'requests_total': self.requests_total,
+				'requests_failed': self.requests_failed,
+				'cached_files': len(self.cache.get('metadata', {})),
+				'cached_img_lists': len(self.cache.get('img_lists', {})),
+				'latency': {
+					'count': len(latencies),
+					'avg': round(sum(latencies) / len(latencies), 6) if latencies else 0,
+					'p50': round(percentile(latencies, 50), 6),
+					'p95': round(percentile(latencies, 95), 6),
+					'max': round(latencies[-1], 6) if latencies else 0
+				}
+			}
+
+	def close(self):
+		if self.pool:
+			self.pool.shutdown()
+		if self.prober:
+			self.prober.shutdown()
+
+
+class ScanRequestHandler(BaseHTTPRequestHandler):
+	"""
+	POST /scan     {"media_dir": "...", "output_dir": "...", "opts": {"recursive": true}}
+	               returns JSON, or just the BBCode when using /scan?format=bbcode
+	GET  /metrics  returns JSON with the queue depth, request counters and latencies
+	GET  /health   returns {"status": "ok"}
+	"""
+	def do_GET(self):
+		path = urlparse(self.path).path
+
+		if path == '/metrics':
+			self.send_json(200, self.server.scan_daemon.metrics())
+		elif path == '/health':
+			self.send_json(200, {'status': 'ok'})
+		else:
+			self.send_json(404, {'error': 'unknown endpoint: {}'.format(path)})
+
+	def do_POST(self):
+		url = urlparse(self.path)
+
+		if url.path != '/scan':
+			self.send_json(404, {'error': 'unknown endpoint: {}'.format(url.path)})
+			return
+
+		start = time.time()
+		try:
+			length = int(self.headers.get('Content-Length', 0))
+			request = json.loads(self.rfile.read(length).decode('utf-8'))
+			outputs = self.server.scan_daemon.scan(request)
+		except ValueError as error:
+			self.send_json(400, {'error': str(error)})
+			return
+		except Exception as error:
+			self.send_json(500, {'error': '{}: {}'.format(type(error).__name__, error)})
+			raise
+
+		if not outputs:
+			self.send_json(422, {'error': 'no output generated, check the daemon log for details'})
+		elif parse_qs(url.query).get('format') == ['bbcode']:
+			self.send_text(200, ''.join(content for file_output, content in outputs))
+		else:
+			self.send_json(200, {
+				'media_dir': request['media_dir'],
+				'outputs': [{'file': file_output, 'bbcode': content} for file_output, content in outputs],
+				'duration': round(time.time() - start, 6)
+			})
+
+	def send_json(self, code, data):
+		self.send_text(code, json.dumps(data, indent=1), 'application/json')
+
+	def send_text(self, code, text, content_type='text/plain'):
+		body = text.encode('utf-8')
+		self.send_response(code)
+		self.send_header('Content-Type', '{}; charset=utf-8'.format(content_type))
+		self.send_header('Content-Length', str(len(body)))
+		self.end_headers()
+		self.wfile.write(body)
+
+	def address_string(self):
+		# Unix socket clients don't have an address
+		if isinstance(self.client_address, tuple):
+			return super().address_string()
+		return 'unix-socket'
+
+
+class ThreadingHTTPServer(socketserver.ThreadingMixIn, HTTPServer):
+	daemon_threads = True
+
+
+class ThreadingUnixHTTPServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+	daemon_threads = True
+
+
+def percentile(values, percent):
+	"""
+	Nearest-rank percentile of an already sorted list.
+	"""
+	if not values:
+		return 0
+	rank = max(0, int(round(percent / 100 * len(values))) - 1)
+	return values[min(rank, len(values) - 1)]
+
+
+def make_server(address, scan_daemon):
+	"""
+	Creates the HTTP server for an address. Addresses containing a path separator (or ending with .sock) are Unix
+	socket paths, anything else is a [host:]port combination (the host defaults to localhost).
+	"""
+	if os.sep in address or address.endswith('.sock'):
+		# remove a stale socket file from a previous run, but don't remove anything that isn't a socket
+		if os.path.exists(address) and stat.S_ISSOCK(os.stat(address).st_mode):
+			os.remove(address)
+		server = ThreadingUnixHTTPServer(address, ScanRequestHandler)
+	else:
+		host, separator, port = address.rpartition(':')
+		server = ThreadingHTTPServer((host or '127.0.0.1', int(port)), ScanRequestHandler)
+
+	server.scan_daemon = scan_daemon
+	return server
+
+
+def serve(address, base_opts, jobs=2):
+	"""
+	Runs the daemon until it is interrupted (Ctrl+C).
+	"""
+	scan_daemon = ScanDaemon(base_opts, jobs)
+
+	try:
+		server = make_server(address, scan_daemon)
+	except (IOError, OSError, OverflowError, ValueError) as error:
+		logger.error('ERROR: Couldn\'t start the daemon on %s: %s', address, error)
+		scan_daemon.close()
+		return
+
+	# treat SIGTERM like Ctrl+C, so the socket file and pool are cleaned up when running as a service
+	def stop(signum, frame):
+		raise KeyboardInterrupt
+	signal.signal(signal.SIGTERM, stop)
+
+	logger.info('Serving scan requests on: %s  (Ctrl+C to stop)', address)
+	try:
+		server.serve_forever()
+	except KeyboardInterrupt:
+		logger.info('Stopping daemon.')
+	finally:
+		server.server_close()
+		scan_daemon.close()
+		if isinstance(server, ThreadingUnixHTTPServer) and os.path.exists(address):
+			os.remove(address)
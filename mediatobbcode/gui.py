@@ -3,28 +3,38 @@
 # Copyright 2017 PayBas
 # All Rights Reserved.
 
+import multiprocessing
 import os
 import re
 import sys
+import threading
 import webbrowser
 
-from PyQt5.QtCore import Qt, QObject, QThread, pyqtSignal, pyqtSlot
+from PyQt5.QtCore import (Qt, QObject, QThread, QTimer, QAbstractTableModel, QModelIndex, QSortFilterProxyModel,
+	pyqtSignal, pyqtSlot)
 from PyQt5.QtGui import QColor, QFont, QIcon, QTextCursor
 from PyQt5.QtWidgets import (QApplication, QMainWindow, QWidget, QGridLayout, QHBoxLayout, QGroupBox, QTabWidget,
-	QLabel, QLineEdit, QPlainTextEdit, QCheckBox, QPushButton, QFrame, QFileDialog, QColorDialog, QMessageBox)
-from dottorrentGUI import gui as dott_gui
+	QLabel, QLineEdit, QPlainTextEdit, QCheckBox, QPushButton, QFrame, QFileDialog, QColorDialog, QMessageBox,
+	QProgressBar, QTableView, QHeaderView, QVBoxLayout, QAbstractItemView)
 
-from mediatobbcode import config, core
+from mediatobbcode import config
+from mediatobbcode.log import setup_logging
+from mediatobbcode.progress import format_progress
+from mediatobbcode.session import Session
 
 
 # noinspection PyArgumentList, PyUnresolvedReferences, PyTypeChecker, PyCallByClass
 class QtGUI(QMainWindow):
+	log_interval = 100  # ms between updates of the log widget
+	log_max_lines = 10000  # older lines are dropped from the log widget
+
 	def __init__(self):
 		super().__init__()
 
 		self.widgets = {}  # dictionary of some mutable widgets, for easier manipulation
 		self.parse_thread = None  # defined here just to appease PEP
 		self.parse_worker = None  # defined here just to appease PEP
+		self.session = None  # the parsing session currently (or last) running
 
 		central_widget = QWidget(self)
 		central_layout = QGridLayout(central_widget)
@@ -41,6 +51,10 @@ class QtGUI(QMainWindow):
 		label_odir.setAlignment(Qt.AlignRight | Qt.AlignVCenter)
 		layout_iops.addWidget(label_odir, 1, 0)
 
+		label_catalog = QLabel(config.config['iopts']['render_from'][1], frame_iops)
+		label_catalog.setAlignment(Qt.AlignRight | Qt.AlignVCenter)
+		layout_iops.addWidget(label_catalog, 2, 0)
+
 		self.widgets['media_dir'] = QLineEdit(frame_iops)
 		self.widgets['media_dir'].editingFinished.connect(self.update_gui_mopts)
 		layout_iops.addWidget(self.widgets['media_dir'], 0, 1)
@@ -49,6 +63,10 @@ class QtGUI(QMainWindow):
 		self.widgets['output_dir'].editingFinished.connect(self.update_gui_mopts)
 		layout_iops.addWidget(self.widgets['output_dir'], 1, 1)
 
+		self.widgets['render_from'] = QLineEdit(frame_iops)
+		self.widgets['render_from'].setPlaceholderText('(optional) render the outputs from this catalog')
+		layout_iops.addWidget(self.widgets['render_from'], 2, 1)
+
 		button_mdir = QPushButton('Browse', frame_iops)
 		button_mdir.clicked.connect(lambda event: self.select_dir('media_dir'))
 		layout_iops.addWidget(button_mdir, 0, 2)
@@ -57,6 +75,10 @@ class QtGUI(QMainWindow):
 		button_odir.clicked.connect(lambda event: self.select_dir('output_dir'))
 		layout_iops.addWidget(button_odir, 1, 2)
 
+		button_catalog = QPushButton('Browse', frame_iops)
+		button_catalog.clicked.connect(lambda event: self.select_file('render_from'))
+		layout_iops.addWidget(button_catalog, 2, 2)
+
 		self.widgets['recursive'] = QCheckBox(config.config['iopts']['recursive'][1], frame_iops)
 		self.widgets['recursive'].stateChanged.connect(self.update_gui_oopts)
 		self.widgets['recursive'].stateChanged.connect(self.update_gui_mopts)
@@ -177,6 +199,27 @@ class QtGUI(QMainWindow):
 
 		tabs.addTab(tab_dopts, 'Display options')
 
+		# ADVANCED OPTIONS
+		tab_aopts = QWidget(tabs)
+		layout_aopts = QGridLayout(tab_aopts)
+
+		row = 0
+		for aopt, values in config.config['aopts'].items():
+			if 'bool' in values[1]:
+				self.widgets[aopt] = QCheckBox(values[2], tab_aopts)
+				layout_aopts.addWidget(self.widgets[aopt], row, 0, 1, 2)
+			else:
+				self.widgets[aopt] = QLineEdit(tab_aopts)
+				layout_aopts.addWidget(self.widgets[aopt], row, 0)
+
+				label = QLabel(values[2], tab_aopts)
+				layout_aopts.addWidget(label, row, 1)
+
+			row += 1
+
+		layout_aopts.setRowStretch(row, 10)
+		tabs.addTab(tab_aopts, 'Advanced')
+
 		# SAVE/LOAD CONFIG
 		tab_config = QWidget(tabs)
 		layout_config = QHBoxLayout(tab_config)
@@ -266,7 +309,50 @@ class QtGUI(QMainWindow):
 		self.log_text.setReadOnly(True)
 		# self.log_text.setLineWrapMode(QPlainTextEdit.NoWrap)
 		self.log_text.ensureCursorVisible()
-		central_layout.addWidget(self.log_text, 3, 0)
+		self.log_text.setMaximumBlockCount(self.log_max_lines)  # drops the oldest lines, to keep memory bounded
+
+		# RESULTS TABLE
+		# rows are added in batches while parsing (see results_flush()), the proxy sorts and filters them without
+		# touching the model, and the view only renders the visible rows, so it stays responsive with 100k+ rows
+		frame_results = QWidget(central_widget)
+		layout_results = QVBoxLayout(frame_results)
+		layout_results.setContentsMargins(0, 0, 0, 0)
+
+		self.results_model = QtGUI.ResultsModel(frame_results)
+		self.results_proxy = QSortFilterProxyModel(frame_results)
+		self.results_proxy.setSourceModel(self.results_model)
+		self.results_proxy.setSortRole(Qt.UserRole)
+		self.results_proxy.setFilterKeyColumn(-1)  # match the filter against all columns
+		self.results_proxy.setFilterCaseSensitivity(Qt.CaseInsensitive)
+
+		results_filter = QLineEdit(frame_results)
+		results_filter.setPlaceholderText('Filter results (e.g. a file name, codec or "missing")')
+		results_filter.textChanged.connect(self.results_proxy.setFilterFixedString)
+		layout_results.addWidget(results_filter)
+
+		results_view = QTableView(frame_results)
+		results_view.setModel(self.results_proxy)
+		results_view.setSortingEnabled(True)
+		results_view.setSelectionBehavior(QAbstractItemView.SelectRows)
+		results_view.setWordWrap(False)
+		results_view.verticalHeader().setSectionResizeMode(QHeaderView.Fixed)  # no per-row size calculations
+		results_view.verticalHeader().setDefaultSectionSize(results_view.fontMetrics().height() + 4)
+		results_view.horizontalHeader().setSectionResizeMode(0, QHeaderView.Stretch)
+		results_view.sortByColumn(-1, Qt.AscendingOrder)  # keep the parsing order until a column is clicked
+		layout_results.addWidget(results_view)
+
+		self.results_buffer = QtGUI.ResultsBuffer()
+
+		output_tabs = QTabWidget(central_widget)
+		output_tabs.addTab(self.log_text, 'Log')
+		output_tabs.addTab(frame_results, 'Results')
+		central_layout.addWidget(output_tabs, 3, 0)
+
+		# PROGRESS BAR
+		self.progress_bar = QProgressBar(central_widget)
+		self.progress_bar.setTextVisible(True)
+		self.progress_bar.setFormat('')
+		central_layout.addWidget(self.progress_bar, 4, 0)
 
 		# MAIN GUI OPTIONS
 		self.setWindowTitle(config.script)
@@ -279,6 +365,7 @@ class QtGUI(QMainWindow):
 		central_layout.setRowStretch(1, 0)
 		central_layout.setRowStretch(2, 0)
 		central_layout.setRowStretch(3, 10)
+		central_layout.setRowStretch(4, 0)
 		self.setCentralWidget(central_widget)
 
 		# SET INITIAL STATE
@@ -290,13 +377,19 @@ class QtGUI(QMainWindow):
 		self.update_gui_dopts()
 
 		# REDIRECT STDOUT
-		sys.stdout = QtGUI.StdoutRedirector(writeSignal=self.log_append)
-		sys.stderr = QtGUI.StdoutRedirector(writeSignal=self.log_append)
+		# both share a single buffer (so messages stay in order), which is flushed to the log widget on a timer
+		self.log_buffer = QtGUI.StdoutRedirector()
+		sys.stdout = self.log_buffer
+		sys.stderr = self.log_buffer
+		self.log_timer = QTimer(self)
+		self.log_timer.timeout.connect(self.log_flush)
+		self.log_timer.timeout.connect(self.results_flush)
+		self.log_timer.start(self.log_interval)
 
 	def set_gui_values(self):
 		for opt, widget in self.widgets.items():
 			if isinstance(widget, QLineEdit):
-				self.widgets[opt].setText(config.opts[opt])
+				self.widgets[opt].setText(str(config.opts[opt]))
 			elif isinstance(widget, QCheckBox):
 				self.widgets[opt].setChecked(config.opts[opt])
 
@@ -304,9 +397,18 @@ class QtGUI(QMainWindow):
 		for opt, widget in self.widgets.items():
 			if isinstance(widget, QLineEdit):
 				if widget.isEnabled() or allow_disabled:
-					config.opts[opt] = widget.text()
+					value = widget.text()
 				else:
-					config.opts[opt] = ''
+					value = ''
+
+				# some of the text fields hold numbers, keep the datatype of the option intact
+				if isinstance(config.opts[opt], int) and not isinstance(config.opts[opt], bool):
+					try:
+						value = int(value or 0)
+					except ValueError:
+						value = config.opts[opt]
+
+				config.opts[opt] = value
 			elif isinstance(widget, QCheckBox):
 				if widget.isEnabled() or allow_disabled:
 					config.opts[opt] = widget.isChecked()
@@ -494,11 +596,19 @@ class QtGUI(QMainWindow):
 	def run_start(self):
 		self.get_gui_values()
 		self.log_text.clear()
-		config.kill_thread = False
 
+		self.session = Session(config.opts)
+		setup_logging(self.session.opts)
 		self.parse_thread = QThread()
-		self.parse_worker = self.ParseWorker()
+		self.parse_worker = self.ParseWorker(self.session)
 		self.parse_worker.moveToThread(self.parse_thread)
+		self.parse_worker.progress.connect(self.progress_update)
+		self.session.progress_callback = self.parse_worker.progress.emit
+		self.results_buffer.take()  # drop the leftovers of a terminated run
+		self.results_model.clear()
+		self.session.results_callback = self.results_buffer.add
+		self.progress_bar.setRange(0, 0)  # busy indicator, until the files have been counted
+		self.progress_bar.setFormat('Counting files...')
 		self.parse_worker.finished.connect(self.run_finish)
 		self.parse_thread.started.connect(self.parse_worker.run)
 		self.parse_thread.finished.connect(self.run_finish)
@@ -512,15 +622,37 @@ class QtGUI(QMainWindow):
 	def run_finish(self):
 		self.parse_thread.quit()
 
+		# stop the busy indicator if the run ended before the files were counted
+		if self.progress_bar.maximum() == 0:
+			self.progress_bar.setRange(0, 1)
+			self.progress_bar.setFormat('')
+
 		self.button_run.setText('Run')
+		self.button_run.setEnabled(True)
 		self.button_run.clicked.disconnect()
 		self.button_run.clicked.connect(self.run_start)
 
 	@pyqtSlot()
 	def run_terminate(self):
+		"""
+		Asks the session to stop, and only kills the parse thread if it doesn't stop within 'cancel_timeout' seconds.
+		"""
 		if self.parse_thread.isRunning():
-			config.kill_thread = True
-			self.parse_thread.terminate()
+			self.session.cancel()
+			self.button_run.setEnabled(False)
+			self.button_run.setText('Stopping...')
+			print('Cancelling...')
+
+			parse_thread = self.parse_thread
+			session = self.session
+			QTimer.singleShot(max(0, self.session.opts['cancel_timeout']) * 1000,
+							lambda: self.run_kill(parse_thread, session))
+
+	def run_kill(self, parse_thread, session):
+		if parse_thread.isRunning():
+			parse_thread.terminate()
+			parse_thread.wait()
+			session.cleanup()
 			print('Thread terminated!')
 
 	@pyqtSlot()
@@ -529,6 +661,9 @@ class QtGUI(QMainWindow):
 
 		# noinspection PyBroadException
 		try:
+			# only import dottorrent when actually creating a torrent, it is rather slow to load
+			from dottorrentGUI import gui as dott_gui
+
 			dott_window = QMainWindow(self)
 			ui = dott_gui.DottorrentGUI()
 			ui.setupUi(dott_window)
@@ -556,10 +691,24 @@ class QtGUI(QMainWindow):
 			(errortype, value, traceback) = sys.exc_info()
 			sys.excepthook(errortype, value, traceback)
 
-	@pyqtSlot(str)
-	def log_append(self, text):
-		self.log_text.moveCursor(QTextCursor.End)
-		self.log_text.insertPlainText(text)
+	@pyqtSlot(dict)
+	def progress_update(self, state):
+		self.progress_bar.setRange(0, max(state['total_files'], 1))
+		self.progress_bar.setValue(state['files'] if state['total_files'] else 1)
+		self.progress_bar.setFormat(format_progress(state))
+
+	@pyqtSlot()
+	def results_flush(self):
+		rows = self.results_buffer.take()
+		if rows:
+			self.results_model.add_rows(rows)
+
+	@pyqtSlot()
+	def log_flush(self):
+		text = self.log_buffer.take()
+		if text:
+			self.log_text.moveCursor(QTextCursor.End)
+			self.log_text.insertPlainText(text)
 
 	def closeEvent(self, event):
 		self.get_gui_values(True)
@@ -582,12 +731,17 @@ class QtGUI(QMainWindow):
 		http://stackoverflow.com/a/6789205
 		"""
 		finished = pyqtSignal()
+		progress = pyqtSignal(dict)  # emitted from the parse thread (and probe pool), throttled by Progress
+
+		def __init__(self, session):
+			super().__init__()
+			self.session = session
 
 		@pyqtSlot()
 		def run(self):
 			# noinspection PyBroadException
 			try:
-				core.set_paths_and_run()
+				self.session.run()
 				self.finished.emit()
 			except:
 				(errortype, value, traceback) = sys.exc_info()
@@ -596,15 +750,112 @@ class QtGUI(QMainWindow):
 
 	# redirect stdout (print) to a widget
 	# adapted from http://stackoverflow.com/a/22582213
-	class StdoutRedirector(QObject):
-		writeSignal = pyqtSignal(str)
+	class StdoutRedirector(object):
+		"""
+		Collects everything written to stdout/stderr (by any thread), until log_flush() inserts it into the log widget
+		in one go. Emitting a signal for every write froze the GUI, and slowed down the parse thread on large runs.
+		"""
+		def __init__(self):
+			self.lock = threading.Lock()
+			self.chunks = []
 
 		def write(self, text):
-			self.writeSignal.emit(str(text))
+			with self.lock:
+				self.chunks.append(str(text))
 
 		def flush(self):
 			pass
 
+		def take(self):
+			with self.lock:
+				text = ''.join(self.chunks)
+				self.chunks = []
+			return text
+
+	class ResultsBuffer(object):
+		"""
+		Collects the result rows reported by the parse thread, until results_flush() adds them to the model in one go.
+		"""
+		def __init__(self):
+			self.lock = threading.Lock()
+			self.rows = []
+
+		def add(self, row):
+			with self.lock:
+				self.rows.append(row)
+
+		def take(self):
+			with self.lock:
+				rows = self.rows
+				self.rows = []
+			return rows
+
+	class ResultsModel(QAbstractTableModel):
+		"""
+		Table model of the parsed items. Rows are identified by path: a row reported again (once its images have been
+		matched) replaces the existing one. Qt.UserRole returns the sort key of a cell (like the size in bytes).
+		"""
+		headers = ['Filename', 'Size', 'Length', 'Codec', 'Resolution', 'Image']
+
+		def __init__(self, parent=None):
+			super().__init__(parent)
+			self.rows = []
+			self.paths = {}  # path: row number
+
+		def rowCount(self, parent=QModelIndex()):
+			return 0 if parent.isValid() else len(self.rows)
+
+		def columnCount(self, parent=QModelIndex()):
+			return 0 if parent.isValid() else len(self.headers)
+
+		def data(self, index, role=Qt.DisplayRole):
+			if not index.isValid():
+				return None
+			row = self.rows[index.row()]
+			if role == Qt.DisplayRole:
+				value = row['columns'][index.column()]
+				return '' if value is None else str(value)
+			elif role == Qt.UserRole:
+				return row['keys'][index.column()]
+			elif role == Qt.ForegroundRole and index.column() == 5 and row['columns'][5] in ('missing', 'conflict'):
+				return QColor('#F00' if row['columns'][5] == 'missing' else '#F80')
+			return None
+
+		def headerData(self, section, orientation, role=Qt.DisplayRole):
+			if role == Qt.DisplayRole and orientation == Qt.Horizontal:
+				return self.headers[section]
+			return None
+
+		def clear(self):
+			self.beginResetModel()
+			self.rows = []
+			self.paths = {}
+			self.endResetModel()
+
+		def add_rows(self, rows):
+			"""
+			Adds a batch of rows (and updates the ones already present), with a single insert notification.
+			"""
+			new_rows = []
+			changed = []
+			for row in rows:
+				number = self.paths.get(row['path'])
+				if number is None:
+					self.paths[row['path']] = len(self.rows) + len(new_rows)
+					new_rows.append(row)
+				elif number >= len(self.rows):
+					new_rows[number - len(self.rows)] = row
+				else:
+					self.rows[number] = row
+					changed.append(number)
+
+			if new_rows:
+				self.beginInsertRows(QModelIndex(), len(self.rows), len(self.rows) + len(new_rows) - 1)
+				self.rows.extend(new_rows)
+				self.endInsertRows()
+			if changed:
+				self.dataChanged.emit(self.index(min(changed), 0), self.index(max(changed), len(self.headers) - 1))
+
 
 def resource_path(relative_path):
 	"""
@@ -631,4 +882,6 @@ def main():
 
 # hi there :)
 if __name__ == '__main__':
+	# needed for the probe worker processes (see isolation.py) when frozen into a Windows executable
+	multiprocessing.freeze_support()
 	main()
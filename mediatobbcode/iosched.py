@@ -0,0 +1,115 @@
+#!/usr/bin/env python3
+# coding=utf-8
+# Copyright 2017 PayBas
+# All Rights Reserved.
+
+import os
+import struct
+import threading
+
+# Linux FS_IOC_FIEMAP ioctl, see linux/fiemap.h
+FS_IOC_FIEMAP = 0xC020660B
+fiemap_header = struct.Struct('=QQLLLL')  # fm_start, fm_length, fm_flags, fm_mapped_extents, fm_extent_count, reserved
+fiemap_extent_size = 56  # fe_logical, fe_physical, fe_length, 2x reserved (u64), fe_flags, 3x reserved (u32)
+
+slots_lock = threading.Lock()
+
+
+def first_extent(path):
+	"""
+	Returns the physical offset (in bytes) of the first extent of a file on its disk, or None where FIEMAP isn't
+	supported (anything but Linux, and some file systems like tmpfs or network shares).
+	"""
+	try:
+		import fcntl
+	except ImportError:
+		return
+
+	request = bytearray(fiemap_header.pack(0, 0xFFFFFFFFFFFFFFFF, 0, 0, 1, 0) + bytes(fiemap_extent_size))
+	try:
+		fd = os.open(path, os.O_RDONLY)
+	except OSError:
+		return
+
+	try:
+		fcntl.ioctl(fd, FS_IOC_FIEMAP, request)
+	except (OSError, ValueError):
+		return
+	finally:
+		os.close(fd)
+
+	if not fiemap_header.unpack_from(request)[3]:
+		return  # empty file (or sparse), nothing mapped
+	return struct.unpack_from('=Q', request, fiemap_header.size + 8)[0]
+
+
+def order_by_locality(root, files):
+	"""
+	Returns the files of a directory in the order they're (most likely) stored on disk: by device, and then by the
+	physical offset of their first extent, or their inode number when that isn't available. Reading them in this
+	order saves a hard disk from seeking back and forth all the time.
+	"""
+	keys = {}
+	for file in files:
+		path = os.path.join(root, file)
+		try:
+			stat = os.stat(path)
+		except OSError:
+			keys[file] = (0, 2, 0)  # can't be probed anyway, so last
+			continue
+
+		offset = first_extent(path)
+		keys[file] = (stat.st_dev, 0, offset) if offset is not None else (stat.st_dev, 1, stat.st_ino)
+
+	return sorted(files, key=lambda file: keys[file])
+
+
+class NoSlot(object):
+	def __enter__(self):
+		pass
+
+	def __exit__(self, *args):
+		pass
+
+
+no_slot = NoSlot()
+
+
+def device_slot(session, device):
+	"""
+	Returns a context manager that holds one of the read slots of a device (st_dev) while a file on it is probed, so
+	no more than 'device_reads' files are read from the same disk at once, however many probe workers there are.
+	The slots are kept in the (possibly shared) session cache, as sessions running side by side share the disks too.
+	"""
+	limit = session.opts['device_reads']
+	if not limit or device is None:
+		return no_slot
+
+	with slots_lock:
+		slots = session.cache.setdefault('device_slots', {})
+		if (device, limit) not in slots:
+			slots[(device, limit)] = threading.BoundedSemaphore(limit)
+		return slots[(device, limit)]
+
+
+def advise_readahead(path, size, length=1 << 20):
+	"""
+	Tells the kernel to start reading the parts of a file that MediaInfo reads first: the start of the file, and the
+	end of it (where the index of MP4 files usually is). Only a hint, nothing happens where it isn't supported.
+	"""
+	if not hasattr(os, 'posix_fadvise'):
+		return
+
+	try:
+		fd = os.open(path, os.O_RDONLY)
+	except OSError:
+		return
+
+	try:
+		os.posix_fadvise(fd, 0, min(length, size), os.POSIX_FADV_WILLNEED)
+		if size > length:
+			os.posix_fadvise(fd, max(size - length, length), 0, os.POSIX_FADV_WILLNEED)
+	except OSError:
+		pass
+	finally:
+		os.close(fd)
@@ -0,0 +1,197 @@
+#!/usr/bin/env python3
+# coding=utf-8
+# Copyright 2017 PayBas
+# All Rights Reserved.
+
+import logging
+import multiprocessing
+import os
+import queue
+import signal
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+
+class ProbeWorker(object):
+	"""
+	A single worker process, probing one media file at a time for the parent. Talks to the parent over a pipe.
+	"""
+	def __init__(self, context, opts, memory_limit, log_level):
+		self.connection, child_connection = context.Pipe()
+		self.process = context.Process(target=worker_main, args=(child_connection, opts, memory_limit, log_level),
+									name='probe-worker', daemon=True)
+		self.process.start()
+		child_connection.close()
+
+	def stop(self):
+		"""
+		Asks the worker to exit, and kills it if it doesn't do so in time (when stuck in MediaInfo).
+		"""
+		try:
+			self.connection.send(None)
+		except (IOError, OSError):
+			pass
+		self.process.join(1)
+		self.kill()
+
+	def kill(self):
+		if self.process.is_alive():
+			# SIGKILL where available (Python 3.7+), that also works on a stopped process
+			getattr(self.process, 'kill', self.process.terminate)()
+		# a process stuck in the kernel (like on a dead network share) can't be killed, so don't wait for it forever
+		self.process.join(5)
+		self.connection.close()
+
+
+class IsolatedProber(object):
+	"""
+	A supervised pool of worker processes that run MediaInfo on behalf of the probe threads (see core.probe_file()),
+	so a corrupt file that makes libmediainfo hang or crash can only take down a worker, never the run itself.
+	A worker that crashes, runs out of memory or takes longer than the timeout is killed (if needed), the file is
+	recorded as failed, and a fresh worker is started for the next file. Each probe thread checks out a worker for the
+	duration of a single file, so with 'probe_workers' threads, the same number of worker processes are used.
+	"""
+	def __init__(self, workers, opts, memory_limit=0):
+		# spawn rather than fork, forking a process with running threads (or a Qt GUI) isn't safe
+		self.context = multiprocessing.get_context('spawn')
+		self.opts = opts
+		self.memory_limit = memory_limit
+		self.log_level = logging.getLogger('mediatobbcode').getEffectiveLevel()
+		self.lock = threading.Lock()
+		self.workers = set()  # all running workers, idle or not
+
+		# idle workers, None is a slot for a worker that hasn't been started yet (or was killed)
+		self.idle = queue.Queue()
+		for slot in range(max(workers, 1)):
+			self.idle.put(None)
+
+	def start_worker(self):
+		worker = ProbeWorker(self.context, self.opts, self.memory_limit, self.log_level)
+		with self.lock:
+			self.workers.add(worker)
+		return worker
+
+	def kill_worker(self, worker):
+		with self.lock:
+			self.workers.discard(worker)
+		worker.kill()
+
+	def probe(self, session, root, file, timeout=0):
+		"""
+		Parses a single media file in a worker process, returning the Clip (or None if it failed, timed out or the
+		session was cancelled). Waits for an idle worker first, if all of them are busy.
+		"""
+		path = os.path.join(root, file)
+		worker = self.idle.get()
+		try:
+			if worker is None:
+				worker = self.start_worker()
+
+			worker.connection.send((root, file))
+			deadline = time.monotonic() + timeout if timeout else None
+
+			while not worker.connection.poll(0.1):
+				if session.cancelled:
+					# the result isn't needed anymore, and the worker may well be stuck on this file
+					error = None
+				elif not worker.process.is_alive():
+					error = 'probe worker crashed (exit code {})'.format(worker.process.exitcode)
+				elif deadline and time.monotonic() > deadline:
+					error = 'timed out after {} s'.format(timeout)
+				else:
+					continue
+
+				if error:
+					logger.error('ERROR parsing: %s  -  %s, restarting the probe worker', file, error,
+								extra={'event': 'failed', 'path': path})
+				self.kill_worker(worker)
+				worker = None
+				return
+
+			item, records = worker.connection.recv()
+		except (EOFError, IOError, OSError):
+			# the worker died while sending its result, or before we could even send it the file
+			logger.error('ERROR parsing: %s  -  probe worker crashed, restarting the probe worker', file,
+						extra={'event': 'failed', 'path': path})
+			if worker:
+				self.kill_worker(worker)
+			worker = None
+			return
+		finally:
+			self.idle.put(worker)
+
+		# pass on the messages of the worker, as if the file was parsed in this process
+		for record in records:
+			logging.getLogger(record.name).handle(record)
+		return item
+
+	def shutdown(self):
+		with self.lock:
+			workers = list(self.workers)
+			self.workers.clear()
+		for worker in workers:
+			worker.stop()
+
+
+class RecordingHandler(logging.Handler):
+	"""
+	Collects the log records of a worker process, to be sent to the parent with the result of the file.
+	"""
+	def __init__(self):
+		super().__init__()
+		self.records = []
+
+	def emit(self, record):
+		# the arguments and traceback may not be picklable, so send the formatted message instead
+		record.msg = record.getMessage()
+		record.args = None
+		if record.exc_info:
+			record.exc_text = logging.Formatter().formatException(record.exc_info)
+			record.exc_info = None
+		self.records.append(record)
+
+	def take(self):
+		records = self.records
+		self.records = []
+		return records
+
+
+def worker_main(connection, opts, memory_limit, log_level):
+	"""
+	Main loop of a worker process: parses the media files it receives, until it receives None.
+	"""
+	# Ctrl+C is handled by the parent, which kills the workers if needed
+	signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+	if memory_limit:
+		try:
+			import resource
+			limit = memory_limit * 1024 * 1024
+			resource.setrlimit(resource.RLIMIT_AS, (limit, limit))
+		except (ImportError, ValueError, OSError):
+			# not available on Windows
+			pass
+
+	handler = RecordingHandler()
+	package_logger = logging.getLogger('mediatobbcode')
+	package_logger.addHandler(handler)
+	package_logger.setLevel(log_level)
+	package_logger.propagate = False
+
+	from mediatobbcode import core
+	from mediatobbcode.session import Session
+	session = Session(opts)
+
+	while True:
+		try:
+			request = connection.recv()
+		except EOFError:
+			break
+		if request is None:
+			break
+
+		root, file = request
+		item = core.parse_media_file(session, root, file)
+		connection.send((item, handler.take()))
@@ -0,0 +1,92 @@
+#!/usr/bin/env python3
+# coding=utf-8
+# Copyright 2017 PayBas
+# All Rights Reserved.
+
+import json
+import logging
+import sys
+
+logger = logging.getLogger(__name__)
+
+# the attributes every LogRecord has, anything else was passed in using extra={...}
+record_attributes = set(vars(logging.LogRecord('', 0, '', 0, '', (), None))) | {'message', 'asctime'}
+
+
+class ConsoleHandler(logging.StreamHandler):
+	"""
+	Writes to whatever sys.stdout is at the time of logging, so the messages end up in the log window of the GUI
+	(which redirects stdout) just like the print() output used to.
+	"""
+	def __init__(self):
+		super().__init__(sys.stdout)
+
+	def emit(self, record):
+		self.stream = sys.stdout
+		super().emit(record)
+
+
+class JsonLinesFormatter(logging.Formatter):
+	"""
+	Formats each record as a single line of JSON, including the structured fields passed using extra={...}
+	(like 'event', 'path' and the counters), so tooling can consume the results of a run without parsing prose.
+	"""
+	def format(self, record):
+		entry = {
+			'time': round(record.created, 3),
+			'level': record.levelname,
+			'logger': record.name,
+			'message': record.getMessage().strip()
+		}
+		for key, value in vars(record).items():
+			if key not in record_attributes:
+				entry[key] = value
+		if record.exc_info:
+			entry['exception'] = self.formatException(record.exc_info)
+
+		return json.dumps(entry, default=str)
+
+
+def parse_level(level):
+	"""
+	Returns the numeric logging level for a level name (like 'debug' or 'INFO'), or None if it's not a valid name.
+	"""
+	value = logging.getLevelName(str(level).upper())
+	return value if isinstance(value, int) else None
+
+
+def setup_logging(opts):
+	"""
+	Configures the 'mediatobbcode' logger for the CLI and GUI: plain messages to stdout at the 'log_level' of the
+	options, and every message (including the per-file DEBUG ones) to the 'log_json_file' as JSON lines, if set.
+	Can be called again for every run, the handlers of a previous call are replaced.
+	"""
+	package_logger = logging.getLogger('mediatobbcode')
+	for handler in list(package_logger.handlers):
+		package_logger.removeHandler(handler)
+		handler.close()
+
+	level = parse_level(opts['log_level']) or logging.INFO
+	console = ConsoleHandler()
+	console.setLevel(level)
+	package_logger.addHandler(console)
+	package_logger.setLevel(level)
+	package_logger.propagate = False
+
+	# reported once the console handler is in place
+	if parse_level(opts['log_level']) is None:
+		logger.error('ERROR: invalid log level: %s  (using INFO)', opts['log_level'])
+
+	if opts['log_json_file']:
+		try:
+			json_handler = logging.FileHandler(opts['log_json_file'], encoding='utf-8')
+		except (IOError, OSError):
+			logger.error('ERROR: Couldn\'t open JSON log file: %s', opts['log_json_file'])
+		else:
+			json_handler.setFormatter(JsonLinesFormatter())
+			package_logger.addHandler(json_handler)
+			level = logging.DEBUG
+
+	# the logger itself only drops what none of the handlers want, so disabled DEBUG messages cost next to nothing
+	package_logger.setLevel(level)
+	return package_logger
@@ -0,0 +1,154 @@
+#!/usr/bin/env python3
+# coding=utf-8
+# Copyright 2017 PayBas
+# All Rights Reserved.
+
+import json
+import logging
+import os
+import threading
+from collections import OrderedDict
+
+logger = logging.getLogger(__name__)
+
+
+class RunStats(object):
+	"""
+	Thread-safe counters for a single run: what happened to the files found, how the screenshots matched the
+	image-lists, and how many bytes were read. Always collected, incrementing a counter costs next to nothing.
+	"""
+	names = ('files_scanned', 'files_skipped', 'files_probed', 'files_cached', 'files_linked', 'files_failed',
+			'images_matched', 'images_missing', 'images_conflicting', 'bytes_probed', 'bytes_hashed',
+			'items_spilled')
+
+	def __init__(self):
+		self.lock = threading.Lock()
+		self.counters = OrderedDict((name, 0) for name in self.names)
+
+	def add(self, name, count=1):
+		with self.lock:
+			self.counters[name] += count
+
+	def __getitem__(self, name):
+		return self.counters[name]
+
+	def snapshot(self):
+		with self.lock:
+			return OrderedDict(self.counters)
+
+
+class MetricsWriter(object):
+	"""
+	Writes the metrics of one or more runs to a JSON file and/or a Prometheus textfile (for the textfile collector of
+	node_exporter). Every run added rewrites the files, so a batch of runs ends up in the same files, one entry (or
+	media_dir label) per run. The files are replaced atomically, so a scraper never reads half a file.
+	"""
+	def __init__(self, json_file='', prom_file=''):
+		self.json_file = json_file
+		self.prom_file = prom_file
+		self.runs = []
+
+	def add(self, run):
+		self.runs.append(run)
+
+		if self.json_file:
+			write_atomic(self.json_file, json.dumps({'runs': self.runs}, indent=1))
+		if self.prom_file:
+			write_atomic(self.prom_file, format_prometheus(self.runs))
+
+
+def run_metrics(session, started, duration):
+	"""
+	Collects the metrics of a finished (or cancelled) session run, with the per-phase timings of its profiler.
+	"""
+	phases = OrderedDict()
+	if session.profiler:
+		with session.profiler.lock:
+			for name, (calls, wall, cpu, size) in session.profiler.phases.items():
+				phases[name] = {'calls': calls, 'wall': round(wall, 6), 'cpu': round(cpu, 6), 'bytes': size}
+
+	return OrderedDict([
+		('media_dir', session.opts['media_dir']),
+		('timestamp', round(started, 3)),
+		('duration', round(duration, 6)),
+		('cancelled', session.cancelled),
+		('outputs', list(session.outputs)),
+		('unchanged', list(session.unchanged)),
+		('counters', session.stats.snapshot()),
+		('phases', phases)
+	])
+
+
+def format_prometheus(runs):
+	"""
+	Formats the metrics of the runs in the Prometheus text exposition format, labelled by media_dir.
+	"""
+	metrics = OrderedDict()  # name: (help, [(labels, value)])
+
+	def add(name, description, labels, value):
+		metrics.setdefault(name, (description, []))[1].append((labels, value))
+
+	for run in runs:
+		media_dir = [('media_dir', run['media_dir'])]
+		counters = run['counters']
+
+		add('run_timestamp_seconds', 'Unix time at which the run started.', media_dir, run['timestamp'])
+		add('run_duration_seconds', 'Wall time of the run.', media_dir, run['duration'])
+		add('run_cancelled', 'Whether the run was cancelled before finishing.', media_dir, int(run['cancelled']))
+		add('outputs_written', 'Number of output files written.', media_dir, len(run['outputs']))
+		add('outputs_unchanged', 'Number of output files skipped, because their inputs were unchanged.', media_dir,
+			len(run['unchanged']))
+
+		for state in ('scanned', 'skipped', 'probed', 'cached', 'linked', 'failed'):
+			add('files', 'Number of files by state: every file found is scanned, and then skipped (unsupported '
+				'extension), probed, taken from the cache or linked (another name of a file already probed). Probed '
+				'files that could not be parsed have failed.',
+				media_dir + [('state', state)], counters['files_' + state])
+
+		for result in ('matched', 'missing', 'conflicting'):
+			add('images', 'Number of image-list lookups by result (conflicting means multiple image-urls matched).',
+				media_dir + [('result', result)], counters['images_' + result])
+
+		for source in ('probed', 'hashed'):
+			add('bytes', 'Size of the media files probed and bytes read to hash screenshots.',
+				media_dir + [('source', source)], counters['bytes_' + source])
+
+		add('items_spilled', 'Number of parsed items written to temporary files, to keep the memory used flat.', media_dir,
+			counters['items_spilled'])
+
+		for phase, stats in run['phases'].items():
+			labels = media_dir + [('phase', phase)]
+			add('phase_seconds', 'Wall time spent in each phase of the run.', labels, stats['wall'])
+			add('phase_cpu_seconds', 'CPU time spent in each phase of the run.', labels, stats['cpu'])
+			add('phase_calls', 'Number of calls of each phase of the run.', labels, stats['calls'])
+
+	lines = []
+	for name, (description, samples) in metrics.items():
+		lines.append('# HELP mediatobbcode_{} {}'.format(name, description))
+		lines.append('# TYPE mediatobbcode_{} gauge'.format(name))
+		for labels, value in samples:
+			label_text = ','.join('{}="{}"'.format(label, escape_label(str(text))) for label, text in labels)
+			lines.append('mediatobbcode_{}{{{}}} {}'.format(name, label_text, value))
+
+	return '\n'.join(lines) + '\n'
+
+
+def escape_label(value):
+	return value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def write_atomic(file, content):
+	"""
+	Writes to a temporary file next to the target, and then renames it over the target.
+	"""
+	temp_file = file + '.tmp'
+	try:
+		with open(temp_file, 'w', encoding='utf-8') as stream:
+			stream.write(content)
+		os.replace(temp_file, file)
+	except (IOError, OSError):
+		logger.error('ERROR: Couldn\'t write metrics file: %s', file)
+		return False
+
+	logger.info('Metrics written to: %s', file)
+	return True
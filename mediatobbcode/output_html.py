@@ -3,18 +3,25 @@
 # Copyright 2017 PayBas
 # All Rights Reserved.
 
+import logging
+import os
 import webbrowser
 
+from mediatobbcode import core
 
-def format_html_output(file_output, file_output_html):
+logger = logging.getLogger(__name__)
+
+
+def format_html_output(session, file_output, file_output_html):
 	"""
 	Converts the BBCode output directly to HTML. This can be useful for rapid testing purposes.
+	The HTML file is written under a temporary name first, like the output file itself (see core.open_temp_output()).
 	requires bbcode module ( http://bbcode.readthedocs.io/ )
 	"""
 	try:
 		import bbcode
 	except ImportError:
-		print('ERROR: Couldn\'t import bbcode module! No HTML output will be generated.')
+		logger.error('ERROR: Couldn\'t import bbcode module! No HTML output will be generated.')
 		return
 
 	try:
@@ -22,13 +29,7 @@ def format_html_output(file_output, file_output_html):
 			content = bbcinput.read()
 			content = content.replace('\'', '±')  # temporary replacement, parser doesn't like '
 	except (IOError, OSError):
-		print('ERROR: Couldn\'t reopen file for conversion to HTML: {}'.format(file_output))
-		return
-
-	try:
-		html_file = open(file_output_html, 'w+', encoding='utf-8')
-	except (IOError, OSError):
-		print('ERROR: Couldn\'t create HTML output file: {}  (invalid directory?)'.format(file_output_html))
+		logger.error('ERROR: Couldn\'t reopen file for conversion to HTML: %s', file_output)
 		return
 
 	# only simple width and background-color options supported for now
@@ -137,11 +138,20 @@ def format_html_output(file_output, file_output_html):
 		'.bq {display: none;}\n'
 		'.thumb {max-width: 400px;}\n'
 		'a.sp:focus ~ .bq, .bq:focus {display: block;}\n')
+	html_file, temp_output = core.open_temp_output(session, file_output_html)
+	if not html_file:
+		return
 	html_file.write('<!DOCTYPE html>\n<html>\n<head>\n<meta charset="UTF-8">\n<title>Test</title>\n'
 					'<style type="text/css">\n{1}\n</style>\n</head>\n<body>\n{0}\n</body>\n</html>\n'
 					.format(html_content, html_css))
-	print('HTML output written to: {}'.format(file_output_html))
-
 	html_file.close()
 
+	try:
+		os.replace(temp_output, file_output_html)
+	except (IOError, OSError):
+		logger.error('ERROR: Couldn\'t create HTML output file: %s  (invalid directory?)', file_output_html)
+		return
+	session.temp_files.discard(temp_output)
+	logger.info('HTML output written to: %s', file_output_html)
+
 	webbrowser.open(file_output_html, new=2)
@@ -0,0 +1,180 @@
+#!/usr/bin/env python3
+# coding=utf-8
+# Copyright 2017 PayBas
+# All Rights Reserved.
+
+import hashlib
+import json
+import logging
+import os
+import threading
+import time
+
+from mediatobbcode import config, core
+
+logger = logging.getLogger(__name__)
+
+manifest_name = '.mediatobbcode-outputs.json'
+manifest_version = 1  # bump when the fingerprint changes, so all outputs are written again
+
+# options that don't change the contents of the output files
+ignored_opts = ('output_dir', 'render_from', 'probe_workers', 'locality_order', 'device_reads', 'readahead',
+				'probe_isolation', 'probe_timeout', 'probe_memory_limit', 'profile', 'profile_slowest',
+				'profile_stats_file', 'trace_file', 'metrics_json_file', 'metrics_prom_file', 'cancel_partial_output',
+				'cancel_timeout', 'show_progress', 'log_level', 'log_json_file', 'skip_unchanged', 'spill_threshold',
+				'catalog_file', 'diff_from')
+
+manifests_lock = threading.Lock()
+
+
+class OutputManifest(object):
+	"""
+	Records a fingerprint of the inputs of every output file written to an output dir (in a hidden JSON file in that
+	dir), with the size and modification time of the output file. When the inputs of an output haven't changed, and
+	the output file itself hasn't been touched, the output doesn't need to be written again. Sessions writing to the
+	same output dir share a manifest (see get_manifest()), so it can be used from multiple threads.
+	"""
+	save_interval = 10  # seconds, so a crashed run loses at most the entries of the last few outputs
+
+	def __init__(self, output_dir):
+		self.lock = threading.Lock()
+		self.file = os.path.join(output_dir, manifest_name)
+		self.entries = {}  # output file name: {'fingerprint', 'size', 'mtime_ns'}
+		self.dirty = False
+		self.saved = time.monotonic()
+
+		try:
+			with open(self.file, encoding='utf-8') as stream:
+				manifest = json.load(stream)
+			if manifest.get('version') == manifest_version:
+				self.entries = manifest['outputs']
+		except (IOError, OSError, ValueError, KeyError):
+			# missing or unreadable, everything will be written again
+			pass
+
+	def unchanged(self, file_output, fingerprint, extra_files=()):
+		"""
+		Returns True if the output file was written from the same inputs before, and is still there untouched.
+		"""
+		with self.lock:
+			entry = self.entries.get(os.path.basename(file_output))
+
+		if not entry or entry['fingerprint'] != fingerprint:
+			return False
+
+		try:
+			stat = os.stat(file_output)
+		except OSError:
+			return False
+
+		if (stat.st_size, stat.st_mtime_ns) != (entry['size'], entry['mtime_ns']):
+			return False
+		return all(os.path.exists(file) for file in extra_files)
+
+	def record(self, file_output, fingerprint):
+		try:
+			stat = os.stat(file_output)
+		except OSError:
+			return
+
+		with self.lock:
+			self.entries[os.path.basename(file_output)] = {'fingerprint': fingerprint, 'size': stat.st_size,
+															'mtime_ns': stat.st_mtime_ns}
+			self.dirty = True
+			due = time.monotonic() - self.saved > self.save_interval
+
+		if due:
+			self.save()
+
+	def save(self):
+		"""
+		Writes the manifest (if anything changed) to a temporary file, and renames it over the old one.
+		"""
+		with self.lock:
+			if not self.dirty:
+				return True
+			content = json.dumps({'version': manifest_version, 'outputs': self.entries}, indent=1, sort_keys=True)
+			self.dirty = False
+			self.saved = time.monotonic()
+
+			temp_file = self.file + '.tmp'
+			try:
+				with open(temp_file, 'w', encoding='utf-8') as stream:
+					stream.write(content)
+				os.replace(temp_file, self.file)
+			except (IOError, OSError):
+				logger.error('ERROR: Couldn\'t write output manifest: %s', self.file)
+				return False
+
+		return True
+
+
+def get_manifest(session):
+	"""
+	Returns the manifest of the output dir of the session, which is kept in the (possibly shared) session cache.
+	"""
+	output_dir = os.path.abspath(session.opts['output_dir'])
+	with manifests_lock:
+		manifests = session.cache.setdefault('output_manifests', {})
+		if output_dir not in manifests:
+			manifests[output_dir] = OutputManifest(output_dir)
+		return manifests[output_dir]
+
+
+def fingerprint(session, items, img_list_files, screenshots=False):
+	"""
+	Returns a hash of everything an output file is generated from: the metadata of the items (clips, image-sets and
+	separators), the contents of the image-lists, the options that affect the output, and the script version.
+	With 'screenshots' (for image-hosts matched by the hash of the screenshots, like ImageBam), the path, size and
+	modification time of the local screenshot of every item are included as well.
+	"""
+	digest = hashlib.sha256()
+
+	opts = {opt: value for opt, value in session.opts.items() if opt not in ignored_opts}
+	digest.update(json.dumps([manifest_version, config.version, opts], sort_keys=True, default=str).encode('utf-8'))
+
+	for _type, _list in items.items():
+		digest.update(_type.encode('utf-8'))
+		for item in _list:
+			digest.update(json.dumps([type(item).__name__, vars(item)], sort_keys=True, default=str).encode('utf-8'))
+			if screenshots and not isinstance(item, core.Separator):
+				digest.update(json.dumps(screenshot_stat(session, item)).encode('utf-8'))
+
+	for file in img_list_files:
+		digest.update(json.dumps([file, file_hash(session, file)]).encode('utf-8'))
+
+	return digest.hexdigest()
+
+
+def screenshot_stat(session, item):
+	screenshot = core.find_screenshot(session, item.filename, item.filepath)
+	try:
+		stat = os.stat(screenshot) if screenshot else None
+	except OSError:
+		stat = None
+	return [screenshot, stat.st_mtime_ns, stat.st_size] if stat else None
+
+
+def file_hash(session, file):
+	"""
+	Returns the SHA-256 hash of a file's contents (or None if it doesn't exist). The hashes are cached in the session,
+	keyed by (path, mtime, size) like the other caches, so a shared image-list is only hashed once.
+	"""
+	try:
+		stat = os.stat(file)
+	except OSError:
+		return
+
+	cache = session.cache.setdefault('file_hashes', {})
+	cache_key = (os.path.abspath(file), stat.st_mtime, stat.st_size)
+	if cache_key not in cache:
+		digest = hashlib.sha256()
+		try:
+			with open(file, 'rb') as stream:
+				for block in iter(lambda: stream.read(1 << 20), b''):
+					digest.update(block)
+		except (IOError, OSError):
+			return
+		cache[cache_key] = digest.hexdigest()
+
+	return cache[cache_key]
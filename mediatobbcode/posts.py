@@ -0,0 +1,101 @@
+#!/usr/bin/env python3
+# coding=utf-8
+# Copyright 2017 PayBas
+# All Rights Reserved.
+
+import logging
+
+logger = logging.getLogger(__name__)
+
+post_separator = '\n\n------------ post {} ------------\n\n'
+
+
+class Wrapper(object):
+	"""
+	The BBCode opening a block that wraps rows (like a table, with its header row) and the BBCode closing it again.
+	The format_*() functions of core.py yield these around their rows (and end_wrapper where the block ends), so the
+	output can be split into posts between rows, without having to parse the BBCode.
+	"""
+	def __init__(self, opening, closing):
+		self.opening = opening
+		self.closing = closing
+
+
+end_wrapper = object()
+
+
+class PostWriter(object):
+	"""
+	Writes the parts yielded by the format_*() functions of core.py to an output file, starting a new post (after a
+	separator line) whenever the next row would make the current post larger than 'limit' bytes (UTF-8 encoded).
+	The blocks that are open at that point are closed at the end of the post, and opened again at the start of the
+	next one, so every post is valid BBCode on its own. A block is only opened together with its first row, so a post
+	never ends with an empty block. Rows themselves are never split. With a limit of 0, everything is written as a
+	single post.
+	"""
+	def __init__(self, stream, limit=0):
+		self.stream = stream
+		self.limit = limit
+		self.wrappers = []  # the blocks open right now, outermost first
+		self.pending = []  # the blocks started, but not opened yet (until their first row)
+		self.size = 0  # bytes written to the current post
+		self.closing_size = 0  # bytes needed to close the open blocks
+		self.rows = 0  # rows written to the current post
+		self.posts = 1
+
+	def write(self, part):
+		if part is end_wrapper:
+			# a block without any rows is written as it is, after the blocks around it were opened
+			self.open_pending()
+			wrapper = self.wrappers.pop()
+			self.closing_size -= self.measure(wrapper.closing)
+			self.add(wrapper.closing)
+			return
+		elif isinstance(part, Wrapper):
+			self.pending.append(part)
+			return
+
+		size = self.measure(part)
+		# the blocks waiting for this row are opened along with it, so they have to fit too
+		needed = size + sum(self.measure(wrapper.opening) + self.measure(wrapper.closing) for wrapper in self.pending)
+		if self.limit and self.size + needed + self.closing_size > self.limit:
+			if self.rows:
+				self.split()
+			if self.size + needed + self.closing_size > self.limit:
+				logger.warning('WARNING: A single row is larger than the post size limit (%d bytes)', self.limit)
+
+		self.open_pending()
+		self.add(part, size)
+		self.rows += 1
+
+	def open_pending(self):
+		# outermost first
+		for wrapper in self.pending:
+			self.wrappers.append(wrapper)
+			self.closing_size += self.measure(wrapper.closing)
+			self.add(wrapper.opening)
+		self.pending = []
+
+	def writelines(self, parts):
+		for part in parts:
+			self.write(part)
+
+	def add(self, text, size=None):
+		self.stream.write(text)
+		if self.limit:
+			self.size += self.measure(text) if size is None else size
+
+	def measure(self, text):
+		return len(text.encode('utf-8')) if self.limit else 0
+
+	def split(self):
+		for wrapper in reversed(self.wrappers):
+			self.stream.write(wrapper.closing)
+
+		self.posts += 1
+		self.stream.write(post_separator.format(self.posts))
+		self.size = 0
+		self.rows = 0
+
+		for wrapper in self.wrappers:
+			self.add(wrapper.opening)
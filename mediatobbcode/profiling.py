@@ -0,0 +1,125 @@
+#!/usr/bin/env python3
+# coding=utf-8
+# Copyright 2017 PayBas
+# All Rights Reserved.
+
+import threading
+import time
+from collections import OrderedDict
+
+# per-thread CPU time is much more useful when probing with a pool, but only available in Python 3.7+
+cpu_time = getattr(time, 'thread_time', time.process_time)
+
+
+class NullPhase(object):
+	"""
+	Does nothing. Returned by Session.phase() when profiling and tracing are disabled, so the instrumentation costs
+	next to nothing.
+	"""
+	def __enter__(self):
+		return self
+
+	def __exit__(self, *exc):
+		return False
+
+	def add_bytes(self, size):
+		pass
+
+
+null_phase = NullPhase()
+
+
+class Phase(object):
+	"""
+	Times a single call of a phase (wall and CPU time), and reports it to the profiler and/or tracer when done.
+	"""
+	def __init__(self, profiler, name, path, size, tracer=None):
+		self.profiler = profiler
+		self.tracer = tracer
+		self.name = name
+		self.path = path
+		self.size = size
+
+	def __enter__(self):
+		self.wall = time.perf_counter()
+		self.cpu = cpu_time()
+		return self
+
+	def __exit__(self, *exc):
+		wall = time.perf_counter() - self.wall
+		if self.profiler:
+			self.profiler.record(self.name, wall, cpu_time() - self.cpu, self.size, self.path)
+		if self.tracer:
+			self.tracer.record(self.name, self.wall, wall, self.size, self.path)
+		return False
+
+	def add_bytes(self, size):
+		self.size += size
+
+
+class Profiler(object):
+	"""
+	Collects the wall time, CPU time, call count and bytes read for each phase of a run (traversal, probing, hashing,
+	matching, formatting, etc.), and for each individual file.
+	"""
+	def __init__(self):
+		self.lock = threading.Lock()
+		self.started = time.perf_counter()
+		self.phases = OrderedDict()  # name: [calls, wall, cpu, bytes]
+		self.files = {}  # path: [wall, cpu, bytes, phase]
+
+	def phase(self, name, path=None, size=0, tracer=None):
+		return Phase(self, name, path, size, tracer)
+
+	def iterate(self, name, iterable):
+		"""
+		Times each step of an iterable (like os.walk()) as a call of the phase.
+		"""
+		iterator = iter(iterable)
+		while True:
+			with self.phase(name):
+				try:
+					item = next(iterator)
+				except StopIteration:
+					return
+			yield item
+
+	def record(self, name, wall, cpu, size=0, path=None):
+		with self.lock:
+			stats = self.phases.setdefault(name, [0, 0.0, 0.0, 0])
+			stats[0] += 1
+			stats[1] += wall
+			stats[2] += cpu
+			stats[3] += size
+
+			if path:
+				stats = self.files.setdefault(path, [0.0, 0.0, 0, name])
+				stats[0] += wall
+				stats[1] += cpu
+				stats[2] += size
+
+	def slowest_files(self, count):
+		with self.lock:
+			return sorted(self.files.items(), key=lambda file: file[1][0], reverse=True)[:count]
+
+	def summary(self, slowest=10):
+		"""
+		Returns a printable table with the totals of each phase, followed by the slowest files.
+		"""
+		total = time.perf_counter() - self.started
+		lines = ['\nPROFILE  (total wall time: {:.3f} s)'.format(total),
+				'{:<12} {:>9} {:>10} {:>10} {:>7} {:>12} {:>9}'.format(
+					'phase', 'calls', 'wall s', 'cpu s', 'wall %', 'bytes', 'MB/s')]
+
+		with self.lock:
+			for name, (calls, wall, cpu, size) in self.phases.items():
+				rate = '{:.1f}'.format(size / wall / 1000000) if size and wall else '-'
+				lines.append('{:<12} {:>9} {:>10.3f} {:>10.3f} {:>6.1f}% {:>12} {:>9}'.format(
+					name, calls, wall, cpu, wall / total * 100 if total else 0, size, rate))
+
+		if slowest > 0 and self.files:
+			lines.append('\nSLOWEST {} FILES'.format(min(slowest, len(self.files))))
+			for path, (wall, cpu, size, name) in self.slowest_files(slowest):
+				lines.append('{:>9.3f} s  {:<6} {}'.format(wall, name, path))
+
+		return '\n'.join(lines) + '\n'
@@ -0,0 +1,135 @@
+#!/usr/bin/env python3
+# coding=utf-8
+# Copyright 2017 PayBas
+# All Rights Reserved.
+
+import os
+import sys
+import threading
+import time
+
+
+def count_files(media_dir, extensions, recursive=True, follow_links=False):
+	"""
+	Cheap pre-count of the files a run will parse (and their total size), walking the tree the same way
+	core.walk_media_dir() does in parse_files(), but without probing anything. Returns (file count, total bytes).
+	"""
+	files = size = 0
+	directories = [media_dir]
+	visited = set()
+
+	while directories:
+		directory = directories.pop()
+		try:
+			if follow_links:
+				# every directory only once, like walk_media_dir()
+				stat = os.stat(directory)
+				if (stat.st_dev, stat.st_ino) in visited:
+					continue
+				visited.add((stat.st_dev, stat.st_ino))
+			names = os.listdir(directory)
+		except OSError:
+			continue
+
+		for name in names:
+			path = os.path.join(directory, name)
+			try:
+				if os.path.isdir(path):
+					if recursive and (follow_links or not os.path.islink(path)):
+						directories.append(path)
+				elif name.lower().endswith(extensions):
+					files += 1
+					size += os.path.getsize(path)
+			except OSError:
+				continue
+
+	return files, size
+
+
+class Progress(object):
+	"""
+	Tracks the files (and bytes) done out of the pre-counted totals, and reports the progress to a callback, at most
+	once every 'interval' seconds, so reporting never slows down the scan itself. Can be advanced from any thread.
+	"""
+	def __init__(self, total_files, total_bytes, callback, interval=0.25):
+		self.lock = threading.Lock()
+		self.total_files = total_files
+		self.total_bytes = total_bytes
+		self.done_files = 0
+		self.done_bytes = 0
+		self.callback = callback
+		self.interval = interval
+		self.started = time.perf_counter()
+		self.reported = 0.0
+
+	def advance(self, size=0):
+		with self.lock:
+			self.done_files += 1
+			self.done_bytes += size
+
+			now = time.perf_counter()
+			if now - self.reported < self.interval:
+				return
+			self.reported = now
+			state = self.state(now)
+
+		self.callback(state)
+
+	def finish(self):
+		with self.lock:
+			state = self.state(time.perf_counter())
+			state['finished'] = True
+
+		self.callback(state)
+
+	def state(self, now):
+		"""
+		Returns the files/bytes done and total, the throughput (files/s and bytes/s) and the ETA (seconds, or None).
+		"""
+		elapsed = max(now - self.started, 0.000001)
+		files_rate = self.done_files / elapsed
+		bytes_rate = self.done_bytes / elapsed
+
+		# estimate by bytes when possible, most of the time goes into reading the files
+		if self.total_bytes and bytes_rate:
+			eta = max(self.total_bytes - self.done_bytes, 0) / bytes_rate
+		elif files_rate:
+			eta = max(self.total_files - self.done_files, 0) / files_rate
+		else:
+			eta = None
+
+		return {'files': self.done_files, 'total_files': self.total_files, 'bytes': self.done_bytes,
+				'total_bytes': self.total_bytes, 'files_rate': files_rate, 'bytes_rate': bytes_rate,
+				'elapsed': elapsed, 'eta': eta, 'finished': False}
+
+
+def format_progress(state):
+	"""
+	Formats a progress state as a single (tqdm-style) line of text.
+	"""
+	total = state['total_files']
+	percent = state['files'] / total * 100 if total else 100.0
+
+	if state['finished']:
+		timing = 'elapsed ' + format_duration(state['elapsed'])
+	else:
+		timing = 'ETA ' + (format_duration(state['eta']) if state['eta'] is not None else '?')
+
+	return '{:5.1f}% {}/{} files  {:.1f}/{:.1f} MB  {:.1f} files/s  {:.1f} MB/s  {}'.format(
+		percent, state['files'], total, state['bytes'] / 1000000, state['total_bytes'] / 1000000,
+		state['files_rate'], state['bytes_rate'] / 1000000, timing)
+
+
+def format_duration(seconds):
+	minutes, seconds = divmod(int(seconds), 60)
+	hours, minutes = divmod(minutes, 60)
+	return '{}:{:02}:{:02}'.format(hours, minutes, seconds)
+
+
+def print_progress(state):
+	"""
+	Progress callback for the command-line, which keeps rewriting a single line on stderr.
+	"""
+	# pad the line, so nothing of a longer previous line is left behind
+	sys.stderr.write('\r' + format_progress(state).ljust(79) + ('\n' if state['finished'] else ''))
+	sys.stderr.flush()
@@ -0,0 +1,300 @@
+#!/usr/bin/env python3
+# coding=utf-8
+# Copyright 2017 PayBas
+# All Rights Reserved.
+
+import copy
+import logging
+import os
+import threading
+import time
+from collections import OrderedDict
+
+from mediatobbcode import config
+from mediatobbcode.metrics import RunStats
+from mediatobbcode.profiling import Phase, null_phase
+
+logger = logging.getLogger(__name__)
+
+
+class CancelToken(object):
+	"""
+	Thread-safe flag used to ask a running session to stop. Replaces the old global config.kill_thread.
+	"""
+	def __init__(self):
+		self._event = threading.Event()
+
+	def cancel(self):
+		self._event.set()
+
+	def is_cancelled(self):
+		return self._event.is_set()
+
+
+class Session(object):
+	"""
+	A single parsing job. It carries the options, caches, performer tags and cancellation token through the whole
+	parse_files() -> generate_output() -> format_*() chain, so several sessions can run side by side in one process
+	(in threads, or an asyncio loop using run_in_executor). Nothing in here is shared with other sessions, unless
+	a cache dictionary, probe pool and/or isolated prober is explicitly passed in (see run_batch()).
+	"""
+	def __init__(self, opts=None, cache=None, pool=None, cancel_token=None, prober=None):
+		# take a private copy of the options, so the caller (or another session) can't change them mid-run
+		self.opts = copy.copy(config.opts if opts is None else opts)
+		self.tags = OrderedDict()  # performer tags, with the number of items they were found in
+		self.outputs = []  # paths of the output files written by this session
+		self.unchanged = []  # paths of the output files skipped, because their inputs didn't change
+		self.stats = RunStats()  # file, image-match and byte counters, see metrics.py
+		self.cancel_token = cancel_token or CancelToken()
+		self.temp_files = set()  # unfinished output files, removed by cleanup() if the run doesn't complete
+
+		# caches that may be shared between sessions, all keyed by (path, mtime, size):
+		# 'img_lists' holds parsed image-lists, 'metadata' holds parsed (and cleaned-up) Clips and ImageSets
+		# 'inodes' holds the same items keyed by (device, inode, mtime, size), to find other names for the same file
+		# (the last two are ordered, so core.cache_item() can drop the oldest items first)
+		self.cache = cache if cache is not None else {}
+		self.cache.setdefault('img_lists', {})
+		self.cache.setdefault('metadata', OrderedDict())
+		self.cache.setdefault('inodes', OrderedDict())
+
+		# executor used to probe the files of a directory in parallel (None means one by one)
+		self.pool = pool
+
+		# worker processes running MediaInfo when 'probe_isolation' is enabled, see isolation.py (created by run(),
+		# unless passed in)
+		self.prober = prober
+
+		# live progress, see progress.py: the callback receives a progress state dictionary a few times per second
+		# (the GUI sets its own), without one the 'show_progress' option prints a progress line on the command-line
+		self.progress = None
+		self.progress_callback = None
+
+		# exports the parsed items of every output to an SQLite database, when 'catalog_file' is set (see catalog.py)
+		self.catalog = None
+
+		# receives a result row for every item parsed, and again once its images are matched, see core.report_result()
+		self.results_callback = None
+
+		# only collect timings when profiling and/or tracing is enabled, see profiling.py and tracing.py
+		self.profiler = None
+		self.tracer = None
+		self.metrics_writer = None
+		self.setup_profiler()
+
+	def cancel(self):
+		self.cancel_token.cancel()
+
+	@property
+	def cancelled(self):
+		return self.cancel_token.is_cancelled()
+
+	@property
+	def stopping(self):
+		"""
+		True when cancelled and no partial output is wanted, so generating the output can be skipped as well.
+		"""
+		return self.cancelled and not self.opts['cancel_partial_output']
+
+	def cleanup(self):
+		"""
+		Removes the unfinished output files of a run that didn't complete (cancelled, crashed or terminated).
+		"""
+		for temp_file in list(self.temp_files):
+			try:
+				os.remove(temp_file)
+			except OSError:
+				pass
+			self.temp_files.discard(temp_file)
+
+	def setup_profiler(self):
+		"""
+		Creates the profiler, tracer and metrics writer if profiling, tracing or metrics are enabled in the options
+		(which may have been changed after initializing). The metrics need the profiler for the phase timings.
+		"""
+		metrics = self.opts['metrics_json_file'] or self.opts['metrics_prom_file']
+		if self.profiler is None and (self.opts['profile'] or self.opts['profile_stats_file'] or metrics):
+			from mediatobbcode.profiling import Profiler
+			self.profiler = Profiler()
+		if self.tracer is None and self.opts['trace_file']:
+			from mediatobbcode.tracing import Tracer
+			self.tracer = Tracer()
+		if self.metrics_writer is None and metrics:
+			from mediatobbcode.metrics import MetricsWriter
+			self.metrics_writer = MetricsWriter(self.opts['metrics_json_file'], self.opts['metrics_prom_file'])
+
+	def phase(self, name, path=None, size=0, profile=True):
+		"""
+		Returns a context manager that times a phase of the run (for a file) when profiling or tracing.
+		Spans that only make sense in a trace (because they overlap other phases) pass profile=False.
+		"""
+		profiler = self.profiler if profile else None
+		if profiler is None and self.tracer is None:
+			return null_phase
+		return Phase(profiler, name, path, size, self.tracer)
+
+	def advance(self, size=0):
+		"""
+		Reports a file as done (probed, cached or failed) to the live progress, if enabled.
+		"""
+		if self.progress:
+			self.progress.advance(size)
+
+	def timed(self, name, iterable):
+		"""
+		Times each step of an iterable as a phase when profiling, otherwise just returns the iterable.
+		"""
+		if self.profiler is None:
+			return iterable
+		return self.profiler.iterate(name, iterable)
+
+	def run(self):
+		"""
+		Sanitizes the paths and runs the full parsing process for this session.
+		If no probe pool was passed in, one is created for the duration of the run (when 'probe_workers' > 1).
+		The same goes for the worker processes used with 'probe_isolation'.
+		Once cancelled, it returns without waiting for a probe stuck in MediaInfo (see ProbePool).
+		"""
+		from mediatobbcode import core
+
+		self.setup_profiler()
+
+		own_pool = self.pool is None and self.opts['probe_workers'] > 1
+		if own_pool:
+			self.pool = make_pool(self.opts['probe_workers'])
+
+		own_prober = self.prober is None and self.opts['probe_isolation']
+		if own_prober:
+			from mediatobbcode.isolation import IsolatedProber
+			self.prober = IsolatedProber(self.opts['probe_workers'], self.opts, self.opts['probe_memory_limit'])
+
+		# cProfile only sees the calling thread, the phase timings of the profiler also cover the probe pool
+		stats = None
+		if self.opts['profile_stats_file']:
+			import cProfile
+			stats = cProfile.Profile()
+			stats.enable()
+
+		started = time.time()
+		try:
+			core.set_paths_and_run(self)
+		finally:
+			self.cleanup()
+			if stats:
+				stats.disable()
+				stats.dump_stats(self.opts['profile_stats_file'])
+				logger.info('Profile stats written to: %s', self.opts['profile_stats_file'])
+			if self.tracer:
+				self.tracer.save(self.opts['trace_file'])
+			if self.metrics_writer:
+				from mediatobbcode.metrics import run_metrics
+				self.metrics_writer.add(run_metrics(self, started, time.time() - started))
+			if own_pool:
+				# don't wait for a worker stuck in MediaInfo after cancelling, it's abandoned (see ProbePool)
+				self.pool.shutdown(wait=not self.cancelled)
+				self.pool = None
+			if own_prober:
+				self.prober.shutdown()
+				self.prober = None
+
+
+class ProbePool(object):
+	"""
+	The executor used for probing media files: a minimal concurrent.futures.ThreadPoolExecutor, with daemon worker
+	threads. A ThreadPoolExecutor joins its workers when the interpreter exits, so a file stuck in MediaInfo would keep
+	the process alive after cancelling. A stuck worker of this pool is abandoned instead: it keeps running until
+	MediaInfo returns (or the process exits), but nothing waits for it. Use 'probe_isolation' to actually stop such
+	a probe, which kills its worker process.
+	"""
+	def __init__(self, workers):
+		import queue
+		self.tasks = queue.Queue()
+		self.threads = [threading.Thread(target=self.work, name='probe-pool', daemon=True) for _ in range(workers)]
+		for thread in self.threads:
+			thread.start()
+
+	def submit(self, fn, *args, **kwargs):
+		from concurrent.futures import Future
+		future = Future()
+		self.tasks.put((future, fn, args, kwargs))
+		return future
+
+	def work(self):
+		while True:
+			task = self.tasks.get()
+			if task is None:
+				return
+			future, fn, args, kwargs = task
+			if not future.set_running_or_notify_cancel():
+				continue
+			try:
+				result = fn(*args, **kwargs)
+			except BaseException as e:
+				future.set_exception(e)
+			else:
+				future.set_result(result)
+
+	def shutdown(self, wait=True):
+		"""
+		Stops the workers once the tasks submitted so far are done, and waits for that if 'wait' is set.
+		"""
+		for _ in self.threads:
+			self.tasks.put(None)
+		if wait:
+			for thread in self.threads:
+				thread.join()
+
+
+def make_pool(workers):
+	"""
+	Creates the executor used for probing media files.
+	"""
+	return ProbePool(workers)
+
+
+def make_prober(opts_list, workers):
+	"""
+	Creates the worker processes shared by the sessions using 'probe_isolation' (if any), so they're started once,
+	rather than for every session. The memory limit of the workers is taken from the first of those sessions.
+	"""
+	isolated = [opts for opts in opts_list if opts['probe_isolation']]
+	if not isolated:
+		return None
+
+	from mediatobbcode.isolation import IsolatedProber
+	return IsolatedProber(workers, isolated[0], isolated[0]['probe_memory_limit'])
+
+
+def run_batch(opts_list, cache=None, cancel_token=None):
+	"""
+	Runs a session for each set of options (usually one per media_dir), one after another, in a single process.
+	All the sessions share the same probe pool, isolated probe workers, metadata cache and image-list cache, and each
+	session writes its output as soon as it is done. Cancelling the (optional) token stops the running session and
+	skips the rest.
+	"""
+	if cache is None:
+		cache = {}
+	workers = max(opts['probe_workers'] for opts in opts_list) if opts_list else 1
+	pool = make_pool(workers) if workers > 1 else None
+	prober = make_prober(opts_list, workers)
+
+	tracers = {}
+	metrics_writers = {}
+
+	try:
+		for opts in opts_list:
+			if cancel_token and cancel_token.is_cancelled():
+				break
+			session = Session(opts, cache, pool, cancel_token, prober if opts['probe_isolation'] else None)
+			if session.tracer:
+				# sessions tracing to the same file share a tracer, so the file ends up with the whole batch
+				session.tracer = tracers.setdefault(opts['trace_file'], session.tracer)
+			if session.metrics_writer:
+				# same for the metrics files, each session adds its own entry (labelled by media_dir)
+				metrics_key = (opts['metrics_json_file'], opts['metrics_prom_file'])
+				session.metrics_writer = metrics_writers.setdefault(metrics_key, session.metrics_writer)
+			session.run()
+	finally:
+		if pool:
+			pool.shutdown(wait=not (cancel_token and cancel_token.is_cancelled()))
+		if prober:
+			prober.shutdown()
@@ -0,0 +1,101 @@
+#!/usr/bin/env python3
+# coding=utf-8
+# Copyright 2017 PayBas
+# All Rights Reserved.
+
+import heapq
+import itertools
+import pickle
+import tempfile
+
+
+class SpillList(object):
+	"""
+	An append-only list of items (Clips, ImageSets and Separators, or the rows made from them by core.prepare_items())
+	that holds at most 'threshold' items in memory. Once the threshold is reached, the items are written to a
+	temporary file (a "run"), so the memory used stays the same however large the library is. With a sort key, every
+	run is sorted before it's written, and the runs are merged while iterating (an external merge sort).
+	The list can be iterated as often as needed, which reads the runs from disk again. The temporary files are deleted
+	when the list is closed, or garbage collected.
+	"""
+	batch_size = 500  # items per pickle, only this many items of each run are in memory while iterating
+
+	def __init__(self, threshold=0, key=None, stats=None):
+		self.threshold = threshold  # 0 means never spill (useful for sorting only)
+		self.key = key
+		self.stats = stats
+		self.buffer = []
+		self.runs = []  # (temporary file, [offset of each batch])
+		self.length = 0
+
+	def __len__(self):
+		return self.length
+
+	def __iter__(self):
+		if self.key:
+			self.buffer.sort(key=self.key)
+		if not self.runs:
+			return iter(self.buffer)
+
+		runs = [read_run(run, offsets) for run, offsets in self.runs] + [iter(self.buffer)]
+		if self.key:
+			return merge(runs, self.key)
+		return itertools.chain(*runs)
+
+	def append(self, item):
+		self.buffer.append(item)
+		self.length += 1
+		if self.threshold and len(self.buffer) >= self.threshold:
+			self.spill()
+
+	def extend(self, items):
+		for item in items:
+			self.append(item)
+
+	def spill(self):
+		"""
+		Writes the items in memory to a new run, in batches so they can be read back a batch at a time.
+		"""
+		if self.key:
+			self.buffer.sort(key=self.key)
+
+		run = tempfile.TemporaryFile(prefix='mediatobbcode-')
+		offsets = []
+		for start in range(0, len(self.buffer), self.batch_size):
+			offsets.append(run.tell())
+			pickle.dump(self.buffer[start:start + self.batch_size], run, pickle.HIGHEST_PROTOCOL)
+
+		self.runs.append((run, offsets))
+		if self.stats:
+			self.stats.add('items_spilled', len(self.buffer))
+		self.buffer = []
+
+	def close(self):
+		for run, offsets in self.runs:
+			run.close()
+		self.runs = []
+		self.buffer = []
+		self.length = 0
+
+
+def merge(iterables, key):
+	"""
+	Merges iterables that are each sorted by 'key' into one sorted iterator, like heapq.merge(*iterables, key=key)
+	(which needs Python 3.5). The merge is stable: items with equal keys keep the order of the iterables they came from,
+	and the items themselves are never compared.
+	"""
+	decorated = [decorate(iterable, key, index) for index, iterable in enumerate(iterables)]
+	return (item for _, _, item in heapq.merge(*decorated))
+
+
+def decorate(iterable, key, index):
+	# the index of the iterable breaks ties between equal keys, before the items would be compared
+	for item in iterable:
+		yield key(item), index, item
+
+
+def read_run(run, offsets):
+	# seek before every batch, so several iterations of the same list can read a run at the same time
+	for offset in offsets:
+		run.seek(offset)
+		yield from pickle.load(run)
@@ -0,0 +1,69 @@
+#!/usr/bin/env python3
+# coding=utf-8
+# Copyright 2017 PayBas
+# All Rights Reserved.
+
+import json
+import logging
+import os
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+
+class Tracer(object):
+	"""
+	Collects a span for every directory, probed file, image-list load and formatted collection of a run, and writes
+	them in the Chrome trace event format. Open the file in chrome://tracing or https://ui.perfetto.dev to see how
+	the work is spread over the probe pool, and where the pool sits idle.
+	"""
+	def __init__(self):
+		self.lock = threading.Lock()
+		self.started = time.perf_counter()
+		self.pid = os.getpid()
+		self.events = []
+		self.threads = {}  # thread id: thread name
+
+	def record(self, name, start, duration, size=0, path=None):
+		"""
+		Adds a span, using the perf_counter() value at the start and the duration (both in seconds).
+		The worker thread that ran the span is taken from the calling thread.
+		"""
+		thread = threading.current_thread()
+		event = {
+			'name': name,
+			'cat': 'mediatobbcode',
+			'ph': 'X',
+			'ts': round((start - self.started) * 1000000, 1),
+			'dur': round(duration * 1000000, 1),
+			'pid': self.pid,
+			'tid': thread.ident,
+			'args': {'path': path, 'size': size, 'worker': thread.name}
+		}
+
+		with self.lock:
+			self.events.append(event)
+			self.threads.setdefault(thread.ident, thread.name)
+
+	def trace(self):
+		"""
+		Returns the trace as a dictionary, with the thread names as metadata events so the tracks are labelled.
+		"""
+		with self.lock:
+			metadata = [{'name': 'process_name', 'ph': 'M', 'pid': self.pid, 'args': {'name': 'mediatobbcode'}}]
+			for ident, name in self.threads.items():
+				metadata.append({'name': 'thread_name', 'ph': 'M', 'pid': self.pid, 'tid': ident, 'args': {'name': name}})
+
+			return {'traceEvents': metadata + self.events, 'displayTimeUnit': 'ms'}
+
+	def save(self, file):
+		try:
+			with open(file, 'w', encoding='utf-8') as stream:
+				json.dump(self.trace(), stream)
+		except (IOError, OSError):
+			logger.error('ERROR: Couldn\'t write trace file: %s', file)
+			return False
+
+		logger.info('Trace written to: %s  (open in chrome://tracing or ui.perfetto.dev)', file)
+		return True
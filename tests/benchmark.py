@@ -0,0 +1,405 @@
+#!/usr/bin/env python3
+# coding=utf-8
+# Copyright 2017 PayBas
+# All Rights Reserved.
+
+"""
+Benchmarks the separate stages of a run (traversal, probing, ZIP analysis, image-list parsing, slug matching and
+output generation) on synthetic libraries of 1k, 10k or 100k items, built from the sample videos in tests/videos.
+With --memory, the retained memory of the Clips, ImageSets and image-list entries is measured instead (using
+tracemalloc), together with the peak RSS of the process. Budgets can be set for each, and the benchmark fails
+(exit status 1) when one of them is exceeded. The results are stored as JSON (tagged with the current commit), and
+can be compared with an earlier run:
+
+python3 -m tests.benchmark --sizes 1000,10000
+python3 -m tests.benchmark --sizes 100000 --stages traverse,zip,img_list,match,output
+python3 -m tests.benchmark --memory --sizes 10000 --max-clip-bytes 4000 --max-rss-mb 500
+python3 -m tests.benchmark --compare benchmark-results/benchmark-<commit>-<time>.json
+"""
+
+import argparse
+import gc
+import hashlib
+import io
+import json
+import logging
+import os
+import platform
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+import zipfile
+from collections import OrderedDict
+
+from mediatobbcode import config, core
+from mediatobbcode.session import Session, make_pool
+
+test_dir = os.path.dirname(os.path.abspath(__file__))
+sample_dir = os.path.join(test_dir, 'videos')
+samples = sorted(file for file in os.listdir(sample_dir) if file.lower().endswith(core.media_ext))
+
+stages = ('traverse', 'probe', 'zip', 'img_list', 'match', 'output')
+
+# image-list lines for each supported host, modelled after the real examples in tests/image-hosts
+host_templates = OrderedDict([
+	('imagebam', '[URL=http://www.imagebam.com/image/{slug}{n}][IMG]http://thumbnails117.imagebam.com/53159/'
+				'{slug}{n}.jpg[/IMG][/URL]'),
+	('pixhost', '[url=https://pixhost.org/show/1388/{n}_{slug}.jpg][img]https://t8.pixhost.org/thumbs/1388/'
+				'{n}_{slug}.jpg[/img][/url]'),
+	('postimg', '[url=https://postimg.org/image/p{n}/][img]https://s23.postimg.org/p{n}/{slug}.jpg[/img][/url]'),
+	('imagevenue', '[URL=http://img253.imagevenue.com/img.php?image={n}_{slug}_122_86lo.jpg][IMG]'
+				'http://img253.imagevenue.com/loc86/th_{n}_{slug}_122_86lo.jpg[/IMG][/URL]'),
+	('imagetwist', '[URL=http://imagetwist.com/t{n}/{slug}.jpg][IMG]http://img27.imagetwist.com/th/14336/'
+				't{n}.jpg[/IMG][/URL]'),
+	('imgchili', '[URL=http://imgchili.net/show/99925/{n}_{slug}.jpg][IMG]http://t3.imgchili.net/99925/'
+				'{n}_{slug}.jpg[/IMG][/URL]'),
+	('jerking', '[url=https://jerking.empornium.ph/image/{n}][img]https://jerking.empornium.ph/images/2017/02/09/'
+				'{slug}{n}.md.jpg[/img][/url]'),
+	('fapping', '[img]https://fapping.empornium.sx/images/2017/02/09/{slug}.jpg[/img]')
+])
+
+
+class NoCache(OrderedDict):
+	"""
+	A cache that keeps nothing. The library consists of hardlinks, which would otherwise only be probed once each.
+	"""
+	def __setitem__(self, key, value):
+		pass
+
+
+def host_slug(filename, host):
+	"""
+	The slug the image-host would use for the screenshot of a file. ImageBam uses (part of) the MD5 hash of the
+	screenshot, which we fake using the hash of the file name (the benchmark doesn't hash any screenshots).
+	"""
+	if host == 'imagebam':
+		return hashlib.md5(filename.encode('utf-8')).hexdigest()[:6]
+	return core.slugify(filename, host)
+
+
+def make_library(root, size, files_per_dir=100, depth=3, zip_images=1000):
+	"""
+	Creates a synthetic library with 'size' media files: hardlinks (or copies, if the file system doesn't support
+	hardlinks) of the sample videos, spread over a tree of 'depth' levels with 'files_per_dir' files per directory.
+	Next to that, one ZIP archive with 'zip_images' tiny images for every 1000 media files, and an image-list for
+	each supported image-host, with an entry for every media file. Returns (media files, ZIP files, image-lists).
+	"""
+	from PIL import Image
+
+	media_files = []
+	for number in range(size):
+		# spread the files over a deep tree, like a real library sorted by artist/album/etc.
+		dir_number = number // files_per_dir
+		parts = []
+		for level in range(depth):
+			parts.insert(0, 'dir{:03d}'.format(dir_number % 10))
+			dir_number //= 10
+		directory = os.path.join(root, 'library', *parts)
+		os.makedirs(directory, exist_ok=True)
+
+		sample = samples[number % len(samples)]
+		file = os.path.join(directory, '{:06d} {}'.format(number, sample))
+		try:
+			os.link(os.path.join(sample_dir, sample), file)
+		except OSError:
+			shutil.copyfile(os.path.join(sample_dir, sample), file)
+		media_files.append(file)
+
+	# every archive holds the same tiny image many times, like an image-set of thumbnails
+	image = io.BytesIO()
+	Image.new('RGB', (16, 12), (200, 100, 50)).save(image, 'PNG')
+	zip_files = []
+	os.makedirs(os.path.join(root, 'archives'), exist_ok=True)
+	for number in range(max(1, size // 1000)):
+		file = os.path.join(root, 'archives', 'set{:04d}.zip'.format(number))
+		with zipfile.ZipFile(file, 'w', zipfile.ZIP_STORED) as archive:
+			for image_number in range(zip_images):
+				archive.writestr('image{:05d}.png'.format(image_number), image.getvalue())
+		zip_files.append(file)
+
+	img_lists = OrderedDict()
+	os.makedirs(os.path.join(root, 'img-lists'), exist_ok=True)
+	for host, template in host_templates.items():
+		file = os.path.join(root, 'img-lists', host + '.txt')
+		with open(file, 'w', encoding='utf-8') as stream:
+			for number, media_file in enumerate(media_files):
+				slug = host_slug(os.path.basename(media_file), host)
+				stream.write(template.format(slug=slug, n=10000000 + number) + '\n')
+		img_lists[host] = file
+
+	return media_files, zip_files, img_lists
+
+
+def run_size(size, work_dir, selected, workers, match_sample, zip_images, dedup=False):
+	"""
+	Builds a library of the given size, and times each of the selected stages on it. Every file is probed, unless
+	'dedup' is set, in which case only one hardlink of each sample is (like in a real run).
+	"""
+	results = OrderedDict()
+
+	start = time.perf_counter()
+	media_files, zip_files, img_lists = make_library(work_dir, size, zip_images=zip_images)
+	results['setup'] = {'seconds': round(time.perf_counter() - start, 6)}
+
+	config.populate_opts()
+	session = Session(config.opts, cache=None if dedup else {'inodes': NoCache()})
+	session.opts['output_dir'] = os.path.join(work_dir, 'output')
+	os.makedirs(session.opts['output_dir'])
+	if workers > 1:
+		session.pool = make_pool(workers)
+
+	def record(stage, seconds, count, **extra):
+		results[stage] = OrderedDict([('seconds', round(seconds, 6)), ('count', count),
+									('per_second', round(count / seconds, 1) if seconds else None)])
+		results[stage].update(extra)
+		print('{:>8} items  {:<9} {:>9.3f} s  {:>10} per s'.format(size, stage, seconds, results[stage]['per_second']))
+
+	try:
+		if 'traverse' in selected:
+			start = time.perf_counter()
+			count = sum(len(files) for root, dirs, files in os.walk(os.path.join(work_dir, 'library')))
+			record('traverse', time.perf_counter() - start, count)
+
+		items = []
+		if 'probe' in selected or 'output' in selected:
+			start = time.perf_counter()
+			for root, dirs, files in os.walk(os.path.join(work_dir, 'library')):
+				items += [item for item in core.probe_files(session, root, sorted(files)) if item]
+			if 'probe' in selected:
+				record('probe', time.perf_counter() - start, len(media_files), parsed=len(items))
+
+		if 'zip' in selected:
+			start = time.perf_counter()
+			image_sets = [core.parse_zip_file(session, os.path.dirname(file), os.path.basename(file))
+						for file in zip_files]
+			record('zip', time.perf_counter() - start, len(zip_files) * zip_images,
+					archives=len(zip_files), parsed=len([image_set for image_set in image_sets if image_set]))
+
+		if 'img_list' in selected or 'match' in selected:
+			start = time.perf_counter()
+			img_data = OrderedDict((host, core.get_img_list(session, file)) for host, file in img_lists.items())
+			if 'img_list' in selected:
+				record('img_list', time.perf_counter() - start, len(img_lists) * size)
+
+		if 'match' in selected:
+			# every lookup scans the whole image-list, so only a sample of the files is matched against each list
+			names = [os.path.basename(file) for file in media_files[:match_sample]]
+			matched = 0
+			start = time.perf_counter()
+			for host, data in img_data.items():
+				for name in names:
+					if core.match_slug(session, data['img_list'], host_slug(name, host), data['file']):
+						matched += 1
+			record('match', time.perf_counter() - start, len(names) * len(img_data), matched=matched,
+					list_length=size)
+
+		if 'output' in selected:
+			# without image-lists, so this only times the formatting (matching is timed separately above)
+			session.opts['imagelist_primary'] = os.path.join(work_dir, 'no-image-list.txt')
+			session.opts['imagelist_alternative'] = os.path.join(work_dir, 'no-image-list.txt')
+			start = time.perf_counter()
+			core.generate_output(session, OrderedDict([('clips', items), ('imagesets', [])]), work_dir)
+			record('output', time.perf_counter() - start, len(items))
+	finally:
+		if session.pool:
+			session.pool.shutdown()
+
+	return results
+
+
+def run_memory(size, work_dir, zip_images, imagesets):
+	"""
+	Builds a library of the given size, and measures the memory retained by its Clips, ImageSets and image-list
+	entries (like parse_files() and get_img_list() keep them until the output is written), and the peak RSS.
+	"""
+	results = OrderedDict()
+
+	media_files, zip_files, img_lists = make_library(work_dir, size, zip_images=zip_images)
+	config.populate_opts()
+	session = Session(config.opts)
+
+	def measure(stage, build):
+		"""
+		Builds a list of objects while tracing the allocations, and returns the memory still held by it afterwards.
+		"""
+		gc.collect()
+		if hasattr(tracemalloc, 'reset_peak'):
+			tracemalloc.reset_peak()
+		before = tracemalloc.get_traced_memory()[0]
+
+		kept = build()
+		count = sum(len(item['img_list']) if isinstance(item, dict) else 1 for item in kept if item)
+
+		gc.collect()
+		current, peak = tracemalloc.get_traced_memory()
+		retained = current - before
+		results[stage] = OrderedDict([('count', count), ('bytes', retained),
+									('bytes_per_item', round(retained / count, 1) if count else None),
+									('peak_bytes', peak - before)])
+		print('{:>8} items  {:<16} {:>8} objects  {:>12} bytes  {:>9} per object  peak {:>12} bytes'.format(
+			size, stage, count, retained, results[stage]['bytes_per_item'], peak - before))
+		return kept
+
+	# warm up first, so the one-off allocations (imports, caches of compiled regexes, etc.) aren't counted
+	for file in media_files[:len(samples)] + zip_files[:1]:
+		core.probe_file(session, os.path.dirname(file), os.path.basename(file))
+	for file in img_lists.values():
+		core.read_img_list(file)
+	session.cache['metadata'].clear()
+
+	tracemalloc.start()
+	try:
+		# Clips the way probe_file() creates them, without the metadata cache (which only holds the same objects)
+		measure('clips', lambda: [core.metadata_cleanup(clip) for clip in (
+			core.parse_media_file(session, os.path.dirname(file), os.path.basename(file)) for file in media_files)
+			if clip])
+
+		# the archives are parsed repeatedly, so there are enough ImageSets to measure
+		measure('imagesets', lambda: [core.parse_zip_file(session, os.path.dirname(file), os.path.basename(file))
+									for file in (zip_files * imagesets)[:imagesets]])
+
+		measure('img_list_entries', lambda: [core.read_img_list(file) for file in img_lists.values()])
+	finally:
+		tracemalloc.stop()
+
+	results['peak_rss'] = peak_rss()
+	if results['peak_rss']:
+		print('{:>8} items  {:<16} {:>12} bytes  (for the whole process so far)'.format(size, 'peak RSS',
+																						results['peak_rss']))
+
+	return results
+
+
+def peak_rss():
+	"""
+	Returns the peak resident set size of the process in bytes, or None where it's not available (Windows).
+	"""
+	try:
+		import resource
+	except ImportError:
+		return
+
+	peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+	# kilobytes on Linux, bytes on macOS
+	return peak if sys.platform == 'darwin' else peak * 1024
+
+
+def check_budgets(results, budgets):
+	"""
+	Returns a message for each memory measurement of the results that exceeded its budget.
+	"""
+	failures = []
+	for size, size_results in results['sizes'].items():
+		for stage, budget in budgets.items():
+			if not budget:
+				continue
+
+			if stage == 'peak_rss':
+				value = size_results.get('peak_rss')
+				budget *= 1000000
+			else:
+				value = size_results.get(stage, {}).get('bytes_per_item')
+
+			if value is not None and value > budget:
+				failures.append('{} items: {} is {} bytes, the budget is {} bytes'.format(size, stage, value, budget))
+
+	return failures
+
+
+def current_commit():
+	try:
+		return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], cwd=test_dir,
+									stderr=subprocess.DEVNULL).decode('ascii').strip()
+	except (OSError, subprocess.CalledProcessError):
+		return 'unknown'
+
+
+def compare(results, previous_file):
+	"""
+	Prints the timings of this run relative to those of an earlier results file.
+	"""
+	with open(previous_file, encoding='utf-8') as stream:
+		previous = json.load(stream)
+
+	# timings are compared in seconds, memory measurements in bytes per object
+	key, unit = ('bytes_per_item', 'bytes') if results['memory'] else ('seconds', 's')
+
+	print('\nCOMPARED TO {} ({})'.format(previous['commit'], previous_file))
+	for size, size_results in results['sizes'].items():
+		for stage, stats in size_results.items():
+			before = previous['sizes'].get(size, {}).get(stage)
+			if isinstance(stats, dict) and isinstance(before, dict) and stats.get(key) and before.get(key):
+				print('{:>8} items  {:<16} {:>12.3f} {}  was {:>12.3f} {}  ({:+.1f}%)'.format(
+					size, stage, stats[key], unit, before[key], unit, (stats[key] / before[key] - 1) * 100))
+
+
+def main(argv):
+	parser = argparse.ArgumentParser(description='Benchmark the stages of a run on synthetic libraries.')
+	parser.add_argument('--sizes', default='1000', help='comma-separated library sizes (default: 1000)')
+	parser.add_argument('--stages', default=','.join(stages), help='comma-separated stages to run (default: all)')
+	parser.add_argument('--workers', type=int, default=1, help='probe workers (default: 1)')
+	parser.add_argument('--dedup', action='store_true', help='probe only one hardlink of each sample video')
+	parser.add_argument('--match-sample', type=int, default=1000, help='files matched against each image-list')
+	parser.add_argument('--zip-images', type=int, default=1000, help='images in each ZIP archive')
+	parser.add_argument('--work-dir', help='where to build the libraries (default: a temporary directory)')
+	parser.add_argument('--keep', action='store_true', help='don\'t remove the libraries afterwards')
+	parser.add_argument('--results-dir', default='benchmark-results', help='where to store the JSON results')
+	parser.add_argument('--compare', help='JSON results of an earlier run to compare with')
+	parser.add_argument('--memory', action='store_true', help='measure the memory footprint instead of the timings')
+	parser.add_argument('--imagesets', type=int, default=1000, help='ImageSets created for the memory measurement')
+	parser.add_argument('--max-clip-bytes', type=int, help='memory budget for each Clip')
+	parser.add_argument('--max-imageset-bytes', type=int, help='memory budget for each ImageSet')
+	parser.add_argument('--max-img-list-entry-bytes', type=int, help='memory budget for each image-list entry')
+	parser.add_argument('--max-rss-mb', type=int, help='budget for the peak RSS of the benchmark (in MB)')
+	args = parser.parse_args(argv)
+
+	selected = set(args.stages.split(','))
+	if not selected <= set(stages):
+		parser.error('unknown stages: {}'.format(', '.join(selected - set(stages))))
+
+	# the per-file messages would only measure the terminal
+	logging.getLogger('mediatobbcode').setLevel(logging.ERROR)
+
+	results = OrderedDict([('commit', current_commit()), ('timestamp', round(time.time())),
+						('python', platform.python_version()), ('platform', platform.platform()),
+						('workers', args.workers), ('dedup', args.dedup), ('memory', args.memory), ('sizes', OrderedDict())])
+
+	for size in (int(size) for size in args.sizes.split(',')):
+		work_dir = tempfile.mkdtemp(prefix='mtbb-bench-{}-'.format(size), dir=args.work_dir)
+		try:
+			if args.memory:
+				results['sizes'][str(size)] = run_memory(size, work_dir, args.zip_images, args.imagesets)
+			else:
+				results['sizes'][str(size)] = run_size(size, work_dir, selected, args.workers, args.match_sample,
+													args.zip_images, args.dedup)
+		finally:
+			if args.keep:
+				print('Library kept in: {}'.format(work_dir))
+			else:
+				shutil.rmtree(work_dir)
+
+	os.makedirs(args.results_dir, exist_ok=True)
+	results_file = os.path.join(args.results_dir, 'benchmark-{}{}-{}.json'.format(
+		'memory-' if args.memory else '', results['commit'], results['timestamp']))
+	with open(results_file, 'w', encoding='utf-8') as stream:
+		json.dump(results, stream, indent=1)
+	print('Results written to: {}'.format(results_file))
+
+	if args.compare:
+		compare(results, args.compare)
+
+	if args.memory:
+		failures = check_budgets(results, OrderedDict([
+			('clips', args.max_clip_bytes), ('imagesets', args.max_imageset_bytes),
+			('img_list_entries', args.max_img_list_entry_bytes), ('peak_rss', args.max_rss_mb)]))
+		for failure in failures:
+			print('OVER BUDGET: ' + failure)
+		if failures:
+			sys.exit(1)
+
+
+if __name__ == '__main__':
+	main(sys.argv[1:])
@@ -3,10 +3,27 @@
 # Copyright 2017 PayBas
 # All Rights Reserved.
 
+import io
+import json
 import os
+import re
+import shutil
+import signal
+import sqlite3
+import subprocess
+import sys
+import tempfile
+import threading
 import unittest
+from unittest import mock
 
-from mediatobbcode import core, config
+from mediatobbcode import catalog, core, config
+from mediatobbcode.iosched import order_by_locality
+from mediatobbcode.isolation import IsolatedProber
+from mediatobbcode.log import setup_logging
+from mediatobbcode.posts import PostWriter, Wrapper, end_wrapper
+from mediatobbcode.session import Session, run_batch
+from mediatobbcode.spill import SpillList
 
 test_dir = os.path.dirname(os.path.abspath(__file__))
 
@@ -71,3 +88,606 @@ class FullRunTest(unittest.TestCase):
 
 		os.remove(self.output_file)
 		self.assertEqual(correct, output)
+
+
+class SessionTest(unittest.TestCase):
+	def setUp(self):
+		self.media_dir = os.path.join(test_dir, 'videos')
+		self.output_dirs = [tempfile.mkdtemp(), tempfile.mkdtemp()]
+		self.maxDiff = None
+
+	def tearDown(self):
+		for output_dir in self.output_dirs:
+			shutil.rmtree(output_dir)
+
+	def make_session(self, output_dir, **opts):
+		config.populate_opts()
+		session = Session(config.opts)
+		session.opts['media_dir'] = self.media_dir
+		session.opts['output_dir'] = output_dir
+		session.opts['imagelist_primary'] = os.path.join(self.media_dir, 'videos.txt')
+		session.opts['imagelist_alternative'] = os.path.join(self.media_dir, 'videos_alt.txt')
+		session.opts.update(opts)
+		return session
+
+	def read_output(self, output_dir):
+		with open(os.path.join(output_dir, 'videos_output.txt'), encoding='utf-8') as file:
+			return file.read()
+
+	def testConcurrentSessions(self):
+		variants = [{}, {'parse_zip': True, 'output_as_table': False, 'whole_filename_is_link': False}]
+
+		# run sequentially first, to get the expected outputs
+		for output_dir, opts in zip(self.output_dirs, variants):
+			self.make_session(output_dir, **opts).run()
+		expected = [self.read_output(output_dir) for output_dir in self.output_dirs]
+		self.assertNotEqual(expected[0], expected[1])
+
+		# sessions with different options must not interfere with each other when running in parallel threads
+		sessions = [self.make_session(output_dir, **opts) for output_dir, opts in zip(self.output_dirs, variants)]
+		threads = [threading.Thread(target=session.run) for session in sessions]
+		for thread in threads:
+			thread.start()
+		for thread in threads:
+			thread.join()
+
+		self.assertEqual(expected, [self.read_output(output_dir) for output_dir in self.output_dirs])
+
+	def testBatchSharedCache(self):
+		opts_list = [self.make_session(output_dir, probe_workers=3).opts for output_dir in self.output_dirs]
+		cache = {}
+		run_batch(opts_list, cache)
+
+		# both media dirs are the same, so the second run only used cached metadata
+		self.assertEqual(5, len(cache['metadata']))
+		self.assertEqual(2, len(cache['img_lists']))
+		self.assertEqual(self.read_output(self.output_dirs[0]), self.read_output(self.output_dirs[1]))
+
+	def testBatchSharedProber(self):
+		opts_list = [self.make_session(output_dir, probe_isolation=True, probe_workers=2).opts
+					for output_dir in self.output_dirs]
+		probers = []
+		def make_prober(*args):
+			probers.append(IsolatedProber(*args))
+			return probers[-1]
+
+		with mock.patch('mediatobbcode.isolation.IsolatedProber', side_effect=make_prober):
+			run_batch(opts_list)
+
+		# the worker processes are started once for the whole batch, and stopped at the end of it
+		self.assertEqual(1, len(probers))
+		self.assertFalse(probers[0].workers)
+		self.assertEqual(self.read_output(self.output_dirs[0]), self.read_output(self.output_dirs[1]))
+
+	def testProfile(self):
+		session = self.make_session(self.output_dirs[0], profile=True)
+		session.run()
+
+		self.assertEqual(5, session.profiler.phases['probe'][0])
+		self.assertEqual(4, session.profiler.phases['hash'][0])
+		self.assertEqual(5, len([stats for stats in session.profiler.files.values() if stats[3] == 'probe']))
+		self.assertIn('SLOWEST 3 FILES', session.profiler.summary(3))
+
+	def testTrace(self):
+		trace_file = os.path.join(self.output_dirs[0], 'trace.json')
+		session = self.make_session(self.output_dirs[0], trace_file=trace_file, probe_workers=2)
+		session.run()
+
+		self.assertIsNone(session.profiler)
+		with open(trace_file, encoding='utf-8') as stream:
+			events = json.load(stream)['traceEvents']
+
+		spans = [event for event in events if event['ph'] == 'X']
+		self.assertEqual(5, len([span for span in spans if span['name'] == 'probe']))
+		self.assertEqual(1, len([span for span in spans if span['name'] == 'directory']))
+		self.assertEqual(['clips'], [span['args']['path'] for span in spans if span['name'] == 'collection'])
+		self.assertTrue(all(span['args']['worker'] for span in spans))
+
+	def testMetrics(self):
+		json_file = os.path.join(self.output_dirs[0], 'metrics.json')
+		prom_file = os.path.join(self.output_dirs[0], 'metrics.prom')
+		opts_list = [self.make_session(output_dir, metrics_json_file=json_file, metrics_prom_file=prom_file).opts
+					for output_dir in self.output_dirs]
+		run_batch(opts_list)
+
+		with open(json_file, encoding='utf-8') as stream:
+			runs = json.load(stream)['runs']
+
+		# the second run of the batch gets all its metadata from the cache
+		self.assertEqual(2, len(runs))
+		counters = runs[0]['counters']
+		self.assertEqual([5, 0, 0], [counters[name] for name in ('files_probed', 'files_cached', 'files_failed')])
+		self.assertEqual(counters['files_scanned'], counters['files_skipped'] + counters['files_probed'])
+		# every clip is looked up in the primary and the alternative image-list
+		self.assertEqual(10, counters['images_matched'] + counters['images_missing'] + counters['images_conflicting'])
+		self.assertEqual([0, 5], [runs[1]['counters'][name] for name in ('files_probed', 'files_cached')])
+		self.assertIn('probe', runs[0]['phases'])
+
+		with open(prom_file, encoding='utf-8') as stream:
+			prom = stream.read()
+		self.assertIn('mediatobbcode_files{{media_dir="{}",state="probed"}} 5'.format(self.media_dir), prom)
+		self.assertEqual(2, prom.count('mediatobbcode_run_duration_seconds{'))
+
+	def testJsonLog(self):
+		log_file = os.path.join(self.output_dirs[0], 'log.json')
+		session = self.make_session(self.output_dirs[0], log_level='ERROR', log_json_file=log_file)
+		logger = setup_logging(session.opts)
+		try:
+			session.run()
+		finally:
+			for handler in list(logger.handlers):
+				logger.removeHandler(handler)
+				handler.close()
+
+		with open(log_file, encoding='utf-8') as stream:
+			entries = [json.loads(line) for line in stream]
+
+		# per-file DEBUG messages end up in the JSON log, even though the console only shows errors
+		parsed = [entry for entry in entries if entry.get('event') == 'parsed']
+		self.assertEqual(5, len(parsed))
+		self.assertTrue(all(entry['level'] == 'DEBUG' and os.path.isfile(entry['path']) for entry in parsed))
+		self.assertEqual(5, [entry for entry in entries if entry.get('event') == 'run'][0]['counters']['files_probed'])
+
+	def testProgress(self):
+		states = []
+		session = self.make_session(self.output_dirs[0], parse_zip=True, probe_workers=2)
+		session.progress_callback = states.append
+		session.run()
+
+		# the pre-count found the 5 clips and 2 image-sets, and the last report is the finished state
+		self.assertEqual((7, 7, True), (states[-1]['total_files'], states[-1]['files'], states[-1]['finished']))
+		self.assertEqual(states[-1]['total_bytes'], states[-1]['bytes'])
+		self.assertFalse(any(state['finished'] for state in states[:-1]))
+
+	def testCancelledSession(self):
+		session = self.make_session(self.output_dirs[0])
+		session.cancel()
+		session.run()
+		self.assertFalse(os.path.exists(os.path.join(self.output_dirs[0], 'videos_output.txt')))
+
+	def testCancelHangingProbe(self):
+		# a probe that never returns doesn't keep a cancelled run, or the process, from exiting
+		script = (
+			'import sys, threading\n'
+			'from unittest import mock\n'
+			'from mediatobbcode import config\n'
+			'from mediatobbcode.session import Session\n'
+			'config.populate_opts()\n'
+			'session = Session(config.opts)\n'
+			'session.opts.update(media_dir=sys.argv[1], output_dir=sys.argv[2], probe_workers=2)\n'
+			'threading.Timer(0.5, session.cancel).start()\n'
+			'with mock.patch("mediatobbcode.core.probe_file", lambda *args: threading.Event().wait()):\n'
+			'	session.run()\n')
+		process = subprocess.Popen([sys.executable, '-c', script, self.media_dir, self.output_dirs[0]],
+									cwd=os.path.dirname(test_dir), stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+		try:
+			output = process.communicate(timeout=20)[0]
+		except subprocess.TimeoutExpired:
+			process.kill()
+			process.communicate()
+			self.fail('the process hangs on a stuck probe after cancelling')
+		self.assertEqual(0, process.returncode, output)
+		self.assertFalse(os.path.exists(os.path.join(self.output_dirs[0], 'videos_output.txt')))
+
+	def testResults(self):
+		rows = []
+		session = self.make_session(self.output_dirs[0])
+		session.results_callback = rows.append
+		session.run()
+
+		# every clip is reported once when parsed, and once more after matching its screenshot
+		self.assertEqual(10, len(rows))
+		self.assertEqual(['pending'] * 5, [row['columns'][5] for row in rows[:5]])
+		self.assertEqual([row['path'] for row in rows[:5]], [row['path'] for row in rows[5:]])
+		statuses = {os.path.basename(row['path']): row['columns'][5] for row in rows[5:]}
+		self.assertEqual('missing', statuses['SampleVideo_176x144_1mb.3gp'])
+		self.assertEqual('matched', statuses['SampleVideo_1280x720_1mb.mp4'])
+
+		# the size sort key comes from the parsed item, the file isn't read again
+		with mock.patch('os.path.getsize', side_effect=AssertionError):
+			core.report_result(session, core.probe_file(session, self.media_dir, 'SampleVideo_176x144_1mb.3gp'))
+		self.assertEqual(os.path.getsize(rows[-1]['path']), rows[-1]['keys'][1])
+
+	def testCancelPartialOutput(self):
+		for output_dir, partial in zip(self.output_dirs, (False, True)):
+			session = self.make_session(output_dir, cancel_partial_output=partial)
+
+			# cancel halfway, once the second file has been probed (which is then dropped)
+			def advance(size=0, session=session):
+				if session.stats['files_probed'] == 2:
+					session.cancel()
+			session.advance = advance
+			session.run()
+
+			self.assertFalse(session.temp_files)
+			self.assertFalse(any(file.endswith('.part') for file in os.listdir(output_dir)))
+
+		self.assertFalse(os.path.exists(os.path.join(self.output_dirs[0], 'videos_output.txt')))
+		self.assertIn('File information for 1 items', self.read_output(self.output_dirs[1]))
+
+	def testHtmlOutput(self):
+		session = self.make_session(self.output_dirs[0], output_html=True)
+		with mock.patch('webbrowser.open') as open_browser:
+			session.run()
+
+		html_file = os.path.join(self.output_dirs[0], 'videos_output.html')
+		open_browser.assert_called_once_with(html_file, new=2)
+		with open(html_file, encoding='utf-8') as file:
+			self.assertIn('SampleVideo_1280x720_1mb.mp4', file.read())
+		self.assertFalse(session.temp_files)
+		self.assertFalse(any(file.endswith('.part') for file in os.listdir(self.output_dirs[0])))
+
+	def testUnchangedOutput(self):
+		output_file = os.path.join(self.output_dirs[0], 'videos_output.txt')
+		manifest_file = os.path.join(self.output_dirs[0], '.mediatobbcode-outputs.json')
+
+		# without the option, nothing is kept next to the outputs
+		self.make_session(self.output_dirs[0]).run()
+		self.assertFalse(os.path.exists(manifest_file))
+
+		self.make_session(self.output_dirs[0], skip_unchanged=True).run()
+		self.assertTrue(os.path.exists(manifest_file))
+		mtime = os.stat(output_file).st_mtime_ns
+
+		# same files, image-lists and options, so the output is skipped
+		session = self.make_session(self.output_dirs[0], skip_unchanged=True)
+		session.run()
+		self.assertEqual(([], [output_file]), (session.outputs, session.unchanged))
+		self.assertEqual(mtime, os.stat(output_file).st_mtime_ns)
+
+		# neither do options that only change how the files are read
+		session = self.make_session(self.output_dirs[0], skip_unchanged=True, probe_isolation=True, readahead=True,
+									locality_order=True, device_reads=1)
+		session.run()
+		self.assertEqual(([], [output_file]), (session.outputs, session.unchanged))
+		self.assertEqual(mtime, os.stat(output_file).st_mtime_ns)
+
+		# a different layout (or a forced run) writes it again
+		for opts in ({'skip_unchanged': True, 'output_table_titles': False}, {'output_table_titles': False}):
+			session = self.make_session(self.output_dirs[0], **opts)
+			session.run()
+			self.assertEqual(([output_file], []), (session.outputs, session.unchanged))
+		self.assertNotIn('FILE DETAILS', self.read_output(self.output_dirs[0]))
+
+	def testUnchangedScreenshots(self):
+		# ImageBam images are matched by the hash of the screenshots, so a changed screenshot changes the output
+		media_dir = os.path.join(self.output_dirs[1], 'videos')
+		shutil.copytree(self.media_dir, media_dir)
+		output_file = os.path.join(self.output_dirs[0], 'videos_output.txt')
+		self.make_session(self.output_dirs[0], media_dir=media_dir, skip_unchanged=True).run()
+
+		with open(os.path.join(media_dir, 'Screens', 'SampleVideo_360x240_1mb.jpg'), 'ab') as file:
+			file.write(b'\0')
+		session = self.make_session(self.output_dirs[0], media_dir=media_dir, skip_unchanged=True)
+		session.run()
+		self.assertEqual(([output_file], []), (session.outputs, session.unchanged))
+
+	@unittest.skipUnless(hasattr(os, 'link') and hasattr(os, 'symlink'), 'needs hardlinks and symlinks')
+	def testLinksAndDuplicates(self):
+		# a file, a hardlink of it, a copy of it, and a symlink loop back to the top
+		media_dir = self.output_dirs[1]
+		sample = os.path.join(media_dir, 'sample.mkv')
+		shutil.copy(os.path.join(self.media_dir, 'SampleVideo_640x360_1mb.mkv'), sample)
+		os.mkdir(os.path.join(media_dir, 'sub'))
+		os.link(sample, os.path.join(media_dir, 'sub', 'hardlink.mkv'))
+		shutil.copy(sample, os.path.join(media_dir, 'sub', 'copy.mkv'))
+		os.symlink(media_dir, os.path.join(media_dir, 'sub', 'loop'))
+
+		catalog_file = os.path.join(self.output_dirs[0], 'catalog.db')
+		session = self.make_session(self.output_dirs[0], media_dir=media_dir, recursive=True, follow_links=True,
+									flag_duplicates=True, catalog_file=catalog_file)
+		session.run()
+
+		self.assertEqual([2, 1], [session.stats[name] for name in ('files_probed', 'files_linked')])
+		with open(os.path.join(self.output_dirs[0], os.path.basename(media_dir) + '_output.txt')) as file:
+			output = file.read()
+		self.assertIn('File information for 3 items', output)
+		self.assertIn('hardlink.mkv', output)
+		self.assertIn('DUPLICATE FILES:\n  {} = {}\n'.format('sample.mkv', os.path.join('sub', 'copy.mkv')), output)
+
+		# rendering from a catalog doesn't touch the files to look for duplicates
+		with mock.patch('mediatobbcode.core.find_duplicates') as find_duplicates:
+			self.make_session(self.output_dirs[0], media_dir='', render_from=catalog_file, flag_duplicates=True,
+							skip_unchanged=False).run()
+		self.assertFalse(find_duplicates.called)
+
+		# hardlinks in the same directory are probed once, also when probing in parallel
+		os.link(sample, os.path.join(media_dir, 'hardlink.mkv'))
+		session = self.make_session(self.output_dirs[0], media_dir=media_dir, probe_workers=2)
+		session.run()
+		self.assertEqual([1, 1], [session.stats[name] for name in ('files_probed', 'files_linked')])
+
+	def testLocalityScheduling(self):
+		self.make_session(self.output_dirs[0]).run()
+		session = self.make_session(self.output_dirs[1], locality_order=True, device_reads=1, readahead=True,
+									probe_workers=3)
+		session.run()
+
+		# probed in on-disk order, one file at a time, but the output is in the normal order
+		self.assertEqual(1, len(session.cache['device_slots']))
+		self.assertEqual(self.read_output(self.output_dirs[0]), self.read_output(self.output_dirs[1]))
+
+		files = sorted(os.listdir(self.media_dir))
+		self.assertEqual(files, sorted(order_by_locality(self.media_dir, files)))
+
+	def testSortOrder(self):
+		names = ['SampleVideo_176x144_1mb.3gp', 'SampleVideo_360x240_1mb.flv', 'SampleVideo_640x360_1mb.mkv',
+				'SampleVideo_720x480_1mb.mp4', 'SampleVideo_1280x720_1mb.mp4']
+		for sort_order in ('name', 'resolution'):
+			rows = []
+			session = self.make_session(self.output_dirs[0], sort_order=sort_order, skip_unchanged=False)
+			session.results_callback = rows.append
+			session.run()
+
+			# natural order, so 1280x720 comes last, and the output is in the same order
+			self.assertEqual(names, [os.path.basename(row['path']) for row in rows[5:]])
+			output = self.read_output(self.output_dirs[0])
+			self.assertEqual(sorted(names, key=output.index), names)
+
+	def testSortDirsFirst(self):
+		media_dir = self.output_dirs[1]
+		for directory in ('a', os.path.join('b', 'c')):
+			os.makedirs(os.path.join(media_dir, directory))
+			shutil.copy(os.path.join(self.media_dir, 'SampleVideo_176x144_1mb.3gp'), os.path.join(media_dir, directory))
+		shutil.copy(os.path.join(self.media_dir, 'SampleVideo_360x240_1mb.flv'), media_dir)
+
+		for dirs_first, expected in ((False, ['.', 'a', 'b/c']), (True, ['a', 'b/c', '.'])):
+			rows = []
+			session = self.make_session(self.output_dirs[0], media_dir=media_dir, recursive=True, sort_order='name',
+										sort_dirs_first=dirs_first)
+			session.results_callback = rows.append
+			session.run()
+			self.assertEqual([os.path.normpath(directory) for directory in expected],
+							[os.path.relpath(os.path.dirname(row['path']), media_dir) for row in rows[:3]])
+
+	def testRecursiveSeparators(self):
+		media_dir = self.output_dirs[1]
+		os.makedirs(os.path.join(media_dir, 'a'))
+		shutil.copy(os.path.join(self.media_dir, 'SampleVideo_176x144_1mb.3gp'), os.path.join(media_dir, 'a'))
+		shutil.copy(os.path.join(self.media_dir, 'SampleVideo_360x240_1mb.flv'), media_dir)
+
+		self.make_session(self.output_dirs[0], media_dir=media_dir, recursive=True, sort_order='name').run()
+
+		# the files in media_dir itself come first, without a separator row
+		with open(os.path.join(self.output_dirs[0], os.path.basename(media_dir) + '_output.txt')) as file:
+			output = file.read()
+		self.assertNotIn('[b].[/b]', output)
+		self.assertLess(output.index('SampleVideo_360x240_1mb.flv'), output.index('[b]a[/b]'))
+
+	def testSpill(self):
+		opts = {'parse_zip': True, 'use_imagelist_fullsize': True, 'use_primary_as_fullsize': True}
+		self.make_session(self.output_dirs[0], **opts).run()
+		session = self.make_session(self.output_dirs[1], spill_threshold=2, **opts)
+		session.run()
+
+		self.assertGreater(session.stats['items_spilled'], 0)
+		self.assertEqual(self.read_output(self.output_dirs[0]), self.read_output(self.output_dirs[1]))
+		# the caches of parsed files are bounded by the threshold as well
+		self.assertEqual(2, len(session.cache['metadata']))
+		self.assertEqual(2, len(session.cache['inodes']))
+
+	def testSpillMergeIsStable(self):
+		# items with equal keys keep the order they were added in, and are never compared themselves
+		items = [{'key': key, 'added': added} for added, key in enumerate((2, 1, 2, 1, 2, 1, 2))]
+		spill_list = SpillList(threshold=2, key=lambda item: item['key'])
+		spill_list.extend(items)
+		try:
+			self.assertEqual(sorted(items, key=lambda item: item['key']), list(spill_list))
+		finally:
+			spill_list.close()
+
+	def testSortLibrary(self):
+		media_dir = self.output_dirs[1]
+		names = ['SampleVideo_176x144_1mb.3gp', 'SampleVideo_360x240_1mb.flv', 'SampleVideo_1280x720_1mb.mp4']
+		for directory, name in zip(('b', '', 'a'), names):
+			os.makedirs(os.path.join(media_dir, directory), exist_ok=True)
+			shutil.copy(os.path.join(self.media_dir, name), os.path.join(media_dir, directory))
+
+		for spill_threshold in (0, 1):
+			session = self.make_session(self.output_dirs[0], media_dir=media_dir, recursive=True, sort_order='resolution',
+										sort_library=True, spill_threshold=spill_threshold, skip_unchanged=False)
+			session.run()
+
+			# one sorted list across the directories, without separators
+			with open(os.path.join(self.output_dirs[0], os.path.basename(media_dir) + '_output.txt')) as file:
+				output = file.read()
+			self.assertEqual(sorted(names, key=output.index), names)
+			self.assertNotIn('[b]a[/b]', output)
+
+	def testCatalog(self):
+		catalog_file = os.path.join(self.output_dirs[0], 'catalog.db')
+		session = self.make_session(self.output_dirs[0], parse_zip=True, catalog_file=catalog_file)
+		session.run()
+
+		connection = sqlite3.connect(catalog_file)
+		self.assertEqual(5, connection.execute('SELECT COUNT(*) FROM clips').fetchone()[0])
+		self.assertEqual(('SampleVideo_1280x720_1mb.mp4', 'AVC', 1280, 720), connection.execute(
+			'SELECT path, vcodec, vwidth, vheight FROM clips WHERE vwidth = 1280').fetchone())
+		self.assertGreater(connection.execute('SELECT COUNT(*) FROM image_matches').fetchone()[0], 0)
+		connection.close()
+
+		# the same output, without the media files
+		session = self.make_session(self.output_dirs[1], media_dir='', parse_zip=True)
+		with mock.patch('mediatobbcode.core.probe_file') as probe_file:
+			self.assertTrue(catalog.render_catalog(session, catalog_file))
+		self.assertFalse(probe_file.called)
+		self.assertEqual(self.read_output(self.output_dirs[0]), self.read_output(self.output_dirs[1]))
+
+	def testRenderFrom(self):
+		catalog_file = os.path.join(self.output_dirs[0], 'catalog.db')
+		self.make_session(self.output_dirs[0], catalog_file=catalog_file).run()
+
+		# a different layout, taking the media_dir from the catalog
+		session = self.make_session(self.output_dirs[1], media_dir='', render_from=catalog_file,
+									output_table_titles=False, skip_unchanged=True)
+		with mock.patch('mediatobbcode.core.parse_files') as parse_files:
+			session.run()
+		self.assertFalse(parse_files.called)
+		self.assertEqual(self.media_dir, session.opts['media_dir'])
+		self.assertNotIn('FILE DETAILS', self.read_output(self.output_dirs[1]))
+		self.assertIn('SampleVideo_1280x720_1mb.mp4', self.read_output(self.output_dirs[1]))
+
+		# nothing changed, so nothing is written again
+		session = self.make_session(self.output_dirs[1], media_dir='', render_from=catalog_file,
+									output_table_titles=False, skip_unchanged=True)
+		session.run()
+		self.assertEqual(1, len(session.unchanged))
+
+		# the items are sorted again by the sort order of the render
+		self.make_session(self.output_dirs[1], media_dir='', render_from=catalog_file, sort_order='resolution').run()
+		output = self.read_output(self.output_dirs[1])
+		names = ['SampleVideo_176x144_1mb.3gp', 'SampleVideo_360x240_1mb.flv', 'SampleVideo_640x360_1mb.mkv',
+				'SampleVideo_720x480_1mb.mp4', 'SampleVideo_1280x720_1mb.mp4']
+		self.assertEqual(names, sorted(names, key=output.index))
+
+		# and the catalog to render from is never saved with the other options
+		config_file = os.path.join(self.output_dirs[0], 'config.ini')
+		config.opts['render_from'] = catalog_file
+		config.save_config_file(config_file)
+		with open(config_file) as file:
+			self.assertNotIn('render_from', file.read())
+
+	def testDiff(self):
+		media_dir = self.output_dirs[1]
+		for name in ('SampleVideo_176x144_1mb.3gp', 'SampleVideo_360x240_1mb.flv', 'SampleVideo_640x360_1mb.mkv'):
+			shutil.copy(os.path.join(self.media_dir, name), media_dir)
+		old_catalog = os.path.join(self.output_dirs[0], 'old.db')
+		self.make_session(self.output_dirs[0], media_dir=media_dir, catalog_file=old_catalog).run()
+
+		# one removed, one added, and one "re-encoded" to another resolution (but the same name)
+		os.remove(os.path.join(media_dir, 'SampleVideo_176x144_1mb.3gp'))
+		shutil.copy(os.path.join(self.media_dir, 'SampleVideo_720x480_1mb.mp4'), media_dir)
+		shutil.copy(os.path.join(self.media_dir, 'SampleVideo_1280x720_1mb.mp4'),
+					os.path.join(media_dir, 'SampleVideo_640x360_1mb.mkv'))
+
+		session = self.make_session(self.output_dirs[0], media_dir=media_dir, diff_from=old_catalog)
+		session.run()
+
+		with open(os.path.join(self.output_dirs[0], os.path.basename(media_dir) + '_diff.txt')) as file:
+			output = file.read()
+		sections = [output.index(title) for title in ('[b]Added (1)[/b]', '[b]Removed (1)[/b]', '[b]Changed (1)[/b]')]
+		names = ['SampleVideo_720x480_1mb.mp4', 'SampleVideo_176x144_1mb.3gp', 'SampleVideo_640x360_1mb.mkv']
+		bounds = sections + [len(output)]
+		for number, name in enumerate(names):
+			self.assertTrue(bounds[number] < output.index(name) < bounds[number + 1])
+		self.assertIn('1280×720', output)
+		self.assertNotIn('SampleVideo_360x240_1mb.flv', output)
+
+	def testDiffAndRefreshCatalog(self):
+		media_dir = self.output_dirs[1]
+		for name in ('SampleVideo_176x144_1mb.3gp', 'SampleVideo_360x240_1mb.flv'):
+			shutil.copy(os.path.join(self.media_dir, name), media_dir)
+		catalog_file = os.path.join(self.output_dirs[0], 'catalog.db')
+		self.make_session(self.output_dirs[0], media_dir=media_dir, catalog_file=catalog_file).run()
+
+		# diffing against the catalog that the run replaces compares with the old one, not with itself
+		os.remove(os.path.join(media_dir, 'SampleVideo_176x144_1mb.3gp'))
+		self.make_session(self.output_dirs[0], media_dir=media_dir, catalog_file=catalog_file,
+						diff_from=catalog_file).run()
+
+		with open(os.path.join(self.output_dirs[0], os.path.basename(media_dir) + '_diff.txt')) as file:
+			self.assertIn('[b]Removed (1)[/b]', file.read())
+		self.assertEqual(1, sqlite3.connect(catalog_file).execute('SELECT COUNT(*) FROM clips').fetchone()[0])
+
+	def testDiffRemovesTemporaryCatalog(self):
+		temp_dir = self.output_dirs[1]
+		session = self.make_session(self.output_dirs[0], diff_from=os.path.join(self.output_dirs[0], 'old.db'))
+		with mock.patch('tempfile.tempdir', temp_dir), mock.patch('mediatobbcode.core.parse_files',
+																side_effect=RuntimeError):
+			self.assertRaises(RuntimeError, session.run)
+		self.assertEqual([], os.listdir(temp_dir))
+
+	def testPostSizeLimit(self):
+		for limit in (2500, 700):
+			session = self.make_session(self.output_dirs[0], parse_zip=True, use_imagelist_fullsize=True,
+										use_primary_as_fullsize=True, post_size_limit=limit)
+			session.run()
+
+			posts = re.split(r'\n\n-+ post \d+ -+\n\n', self.read_output(self.output_dirs[0]))
+			self.assertGreater(len(posts), 1)
+			for post in posts:
+				self.assertLessEqual(len(post.encode('utf-8')), limit)
+				# every post is valid BBCode on its own, without empty blocks at the end
+				for tag in ('table', 'spoiler', 'size', 'align', 'bg'):
+					self.assertEqual(len(re.findall(r'\[{}[=\]]'.format(tag), post)), post.count('[/{}]'.format(tag)))
+				self.assertNotRegex(post.rstrip(), r'\[(table|spoiler)[^\]]*\](\[/?(size|align|bg)[^\]]*\]|\s)*$')
+
+			# a table continued in the next post gets its header row again
+			self.assertTrue(any(post.startswith('[size=0][align=center][table=') for post in posts[1:]))
+			for name in os.listdir(self.media_dir):
+				if name.lower().endswith(core.media_ext + core.zip_ext):
+					self.assertIn(name, ''.join(posts))
+
+	def testPostWriterOpensBlocksWithRows(self):
+		for limit in (60, 70, 80):
+			output = io.StringIO()
+			writer = PostWriter(output, limit)
+			writer.writelines(['x' * 50, Wrapper('<T>' + 'h' * 30, '</T>'), 'r' * 20, 'r' * 20, end_wrapper])
+
+			posts = re.split(r'\n\n-+ post \d+ -+\n\n', output.getvalue())
+			self.assertEqual('x' * 50, posts[0])
+			for post in posts[1:]:
+				self.assertLessEqual(len(post), limit)
+				self.assertRegex(post, r'^<T>h{30}(r{20})+</T>$')
+
+		# blocks without rows are still nested properly
+		for limit in (0, 10):
+			output = io.StringIO()
+			writer = PostWriter(output, limit)
+			writer.writelines([Wrapper('<A>', '</A>'), Wrapper('<B>', '</B>'), end_wrapper, end_wrapper])
+			self.assertEqual('<A><B></B></A>', output.getvalue())
+
+	def testIsolatedProbe(self):
+		self.make_session(self.output_dirs[0]).run()
+		session = self.make_session(self.output_dirs[1], probe_isolation=True, probe_workers=2)
+		session.run()
+
+		self.assertEqual(5, session.stats['files_probed'])
+		self.assertEqual(self.read_output(self.output_dirs[0]), self.read_output(self.output_dirs[1]))
+
+	@unittest.skipUnless(hasattr(signal, 'SIGSTOP'), 'needs SIGSTOP')
+	def testIsolatedProbeTimeout(self):
+		session = self.make_session(self.output_dirs[0], probe_isolation=True, probe_timeout=1)
+		session.prober = IsolatedProber(1, session.opts)
+
+		# the first worker hangs (like MediaInfo can on some corrupt files), so it's killed and replaced
+		start_worker = session.prober.start_worker
+		workers = []
+		def start_stuck_worker():
+			workers.append(start_worker())
+			if len(workers) == 1:
+				os.kill(workers[0].process.pid, signal.SIGSTOP)
+			return workers[-1]
+		session.prober.start_worker = start_stuck_worker
+
+		try:
+			session.run()
+		finally:
+			session.prober.shutdown()
+
+		self.assertEqual(2, len(workers))
+		self.assertFalse(workers[0].process.is_alive())
+		self.assertEqual([5, 1], [session.stats[name] for name in ('files_probed', 'files_failed')])
+		self.assertIn('File information for 4 items', self.read_output(self.output_dirs[0]))
+
+
+class TagsTest(unittest.TestCase):
+	def setUp(self):
+		config.populate_opts()
+		self.session = Session(config.opts)
+		for filename in ['Michael Jackson, Bruno Mars - Song.mp4',
+						'Bruno Mars & Michael Jackson & Michael Jackson - Other.mp4',
+						'Adele - Hello (feat. Bruno Mars).mkv',
+						'Various Artists - Mix.mkv',
+						'no_performer_here.avi']:
+			core.generate_tags(self.session, filename)
+
+	def testOrderOfAppearance(self):
+		self.assertEqual(['michael.jackson', 'bruno.mars', 'adele'], core.select_tags(self.session))
+		self.assertEqual(3, self.session.tags['bruno.mars'])
+		self.assertEqual(2, self.session.tags['michael.jackson'])
+
+	def testByFrequency(self):
+		self.session.opts['tags_by_frequency'] = True
+		self.session.opts['tags_limit'] = 2
+		self.assertEqual(['bruno.mars', 'michael.jackson'], core.select_tags(self.session))
@@ -0,0 +1,99 @@
+#!/usr/bin/env python3
+# coding=utf-8
+# Copyright 2017 PayBas
+# All Rights Reserved.
+
+import json
+import os
+import shutil
+import tempfile
+import threading
+import unittest
+from http.client import HTTPConnection
+
+from mediatobbcode import config, daemon
+
+test_dir = os.path.dirname(os.path.abspath(__file__))
+
+
+class DaemonTest(unittest.TestCase):
+	def setUp(self):
+		self.media_dir = os.path.join(test_dir, 'videos')
+		self.output_dir = tempfile.mkdtemp()
+
+		config.populate_opts()
+		config.opts['imagelist_primary'] = os.path.join(self.media_dir, 'videos.txt')
+		self.scan_daemon = daemon.ScanDaemon(config.opts, jobs=2)
+		self.server = daemon.make_server('127.0.0.1:0', self.scan_daemon)
+		self.thread = threading.Thread(target=self.server.serve_forever)
+		self.thread.start()
+
+	def tearDown(self):
+		self.server.shutdown()
+		self.server.server_close()
+		self.thread.join()
+		self.scan_daemon.close()
+		shutil.rmtree(self.output_dir)
+
+	def request(self, method, path, body=None):
+		connection = HTTPConnection(*self.server.server_address)
+		connection.request(method, path, json.dumps(body) if body is not None else None)
+		response = connection.getresponse()
+		data = response.read().decode('utf-8')
+		connection.close()
+		return response.status, data
+
+	def testScanAndMetrics(self):
+		request = {'media_dir': self.media_dir, 'output_dir': self.output_dir, 'opts': {'output_as_table': True}}
+		status, data = self.request('POST', '/scan', request)
+		self.assertEqual(200, status)
+		outputs = json.loads(data)['outputs']
+
+		with open(os.path.join(self.output_dir, 'videos_output.txt'), encoding='utf-8') as file:
+			self.assertEqual([{'file': file.name, 'bbcode': file.read()}], outputs)
+
+		# the second scan is served from the resident metadata cache
+		status, bbcode = self.request('POST', '/scan?format=bbcode', request)
+		self.assertEqual(200, status)
+		self.assertEqual(outputs[0]['bbcode'], bbcode)
+
+		status, data = self.request('GET', '/metrics')
+		metrics = json.loads(data)
+		self.assertEqual(0, metrics['queue_depth'])
+		self.assertEqual(2, metrics['requests_total'])
+		self.assertEqual(5, metrics['cached_files'])
+		self.assertEqual(2, metrics['latency']['count'])
+
+	def testOverlappingRequests(self):
+		requests = [{'media_dir': self.media_dir, 'output_dir': self.output_dir, 'opts': {'output_table_titles': titles}}
+					for titles in (True, False)]
+		expected = [self.request('POST', '/scan?format=bbcode', request)[1] for request in requests]
+		self.assertNotEqual(expected[0], expected[1])
+
+		# different layouts into the same output file at the same time, each gets back (only) its own output
+		responses = [None] * 6
+		def send(number):
+			responses[number] = self.request('POST', '/scan?format=bbcode', requests[number % 2])
+		threads = [threading.Thread(target=send, args=(number,)) for number in range(len(responses))]
+		for thread in threads:
+			thread.start()
+		for thread in threads:
+			thread.join()
+
+		for number, (status, bbcode) in enumerate(responses):
+			self.assertEqual((200, expected[number % 2]), (status, bbcode))
+		with open(os.path.join(self.output_dir, 'videos_output.txt'), encoding='utf-8') as file:
+			self.assertIn(file.read(), expected)
+		self.assertFalse([file for file in os.listdir(self.output_dir) if file.endswith('.part')])
+
+	def testInvalidRequests(self):
+		self.assertEqual(400, self.request('POST', '/scan', {'output_dir': self.output_dir})[0])
+		self.assertEqual(400, self.request('POST', '/scan', {'media_dir': self.media_dir, 'opts': {'nope': 1}})[0])
+		self.assertEqual(400, self.request('POST', '/scan', {'media_dir': self.media_dir, 'opts': {'recursive': 1}})[0])
+		# nor may a request make the daemon write (or read) files elsewhere
+		for opt in ('log_json_file', 'trace_file', 'metrics_prom_file', 'catalog_file', 'render_from',
+					'imagelist_primary'):
+			request = {'media_dir': self.media_dir, 'opts': {opt: os.path.join(self.output_dir, 'file')}}
+			self.assertEqual(400, self.request('POST', '/scan', request)[0])
+		self.assertEqual([], os.listdir(self.output_dir))
+		self.assertEqual(404, self.request('GET', '/nope')[0])
@@ -0,0 +1,48 @@
+#!/usr/bin/env python3
+# coding=utf-8
+# Copyright 2017 PayBas
+# All Rights Reserved.
+
+import os
+import subprocess
+import sys
+import unittest
+
+package_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# maximum cumulative import time of the command-line entry point (in seconds), override for slow CI machines
+startup_threshold = float(os.environ.get('MTBB_STARTUP_THRESHOLD', '0.1'))
+
+# modules that should only be imported once they are actually used
+heavy_modules = ('pymediainfo', 'PIL', 'zipfile', 'hashlib', 'PyQt5', 'dottorrentGUI', 'bbcode')
+
+
+def import_times(module):
+	"""
+	Runs 'python -X importtime' for a module, and returns a {module: cumulative seconds} dictionary.
+	"""
+	output = subprocess.check_output([sys.executable, '-X', 'importtime', '-c', 'import ' + module], cwd=package_dir,
+									stderr=subprocess.STDOUT, universal_newlines=True)
+	times = {}
+	for line in output.splitlines():
+		# import time: self [us] | cumulative | imported package
+		if not line.startswith('import time:') or 'cumulative' in line:
+			continue
+		self_us, cumulative_us, name = line[len('import time:'):].split('|')
+		times[name.strip()] = int(cumulative_us) / 1000000
+	return times
+
+
+@unittest.skipUnless(sys.version_info >= (3, 7), '-X importtime requires Python 3.7+')
+class StartupTest(unittest.TestCase):
+	def testLazyImports(self):
+		for module in ('mediatobbcode.cli', 'mediatobbcode.core'):
+			imported = import_times(module)
+			for heavy in heavy_modules:
+				self.assertNotIn(heavy, imported, '{} imports {} at startup'.format(module, heavy))
+
+	def testStartupTime(self):
+		# take the best of a few runs, to filter out noise from a busy machine
+		best = min(import_times('mediatobbcode.cli')['mediatobbcode.cli'] for _ in range(3))
+		self.assertLess(best, startup_threshold, 'cli.py import time: {:.1f} ms (threshold: {:.1f} ms)'.format(
+			best * 1000, startup_threshold * 1000))